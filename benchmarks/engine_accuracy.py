@@ -0,0 +1,119 @@
+"""
+Accuracy and speed of the analytical solar engine compared to the Skyfield reference engine.
+
+    python benchmarks/engine_accuracy.py --ephemeris de421.bsp --days 365
+
+For every latitude, the events of `--days` days are computed by both engines (the reported times),
+then the variable values of every day are compared and the maximum deviation per variable is reported.
+Without `--ephemeris`, the synthetic ephemeris of fixtures.py is used, which has an error of its own
+of the same order as the analytical model, so use a JPL ephemeris for the actual accuracy.
+"""
+import argparse
+import collections
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+import pytz
+import skyfield.api
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twilight_scheduled_jobs.datetime_variables import DatetimeVariableValuesDictFactory  # noqa: E402
+from twilight_scheduled_jobs.engines import AnalyticalSolarEngine, SkyfieldEventEngine  # noqa: E402
+from twilight_scheduled_jobs.event_table import datetime_to_epoch_us  # noqa: E402
+from twilight_scheduled_jobs.variables import NUMBER_VARIABLE_NAMES  # noqa: E402
+
+from fixtures import get_synthetic_ephemeris  # noqa: E402
+
+DEFAULT_LATITUDES = (-45., 0., 20., 39.3384, 50., 60., 65.)
+# the twilight variables are computed together with day_end
+DEFAULT_VARIABLE_NAMES = (
+    'sun_meridian_transit', 'sun_antimeridian_transit', 'day_end',
+    'sun_alt_-9deg_start', 'sun_alt_-9deg_end', 'moonrise', 'moonset', 'moon_illumination',
+)
+START_DATETIME = pytz.UTC.localize(datetime.datetime(2024, 1, 1))
+
+
+def time_engine(engine, families, start_us, end_us):
+    tic = time.perf_counter()
+    engine.compute_events_many(families, start_us, end_us)
+    return time.perf_counter() - tic
+
+
+def compare_latitude(latitude, longitude, days, ephemeris, ts, variable_names):
+    station_geographic_position = skyfield.api.wgs84.latlon(latitude, longitude, elevation_m=0)
+    start_us = datetime_to_epoch_us(START_DATETIME)
+    end_us = datetime_to_epoch_us(START_DATETIME + datetime.timedelta(days=days + 2))
+
+    engines = dict(
+        skyfield=SkyfieldEventEngine(station_geographic_position, eph=ephemeris, ts=ts),
+        analytical=AnalyticalSolarEngine(station_geographic_position),
+    )
+    factories = {
+        name: DatetimeVariableValuesDictFactory(
+            station_geographic_position, timezone=pytz.UTC, engine=engine,
+            horizon=datetime.timedelta(days=days + 2), background_extension=False,
+        )
+        for name, engine in engines.items()
+    }
+    families = set(factories['skyfield']._variable_family(variable_name) for variable_name in variable_names)
+    times = {name: time_engine(engine, families, start_us, end_us) for name, engine in engines.items()}
+    deviations = collections.defaultdict(float)
+    mismatches = collections.Counter()
+    for i in range(days):
+        t0 = START_DATETIME + datetime.timedelta(days=i)
+        reference_dict, analytical_dict = [
+            factories[name].create_dict(t0, use_cache=False, required_variable_names=variable_names)
+            for name in ('skyfield', 'analytical')
+        ]
+        for variable_name in set(reference_dict) | set(analytical_dict):
+            if variable_name not in reference_dict or variable_name not in analytical_dict:
+                # e.g. a threshold grazed by the Sun at high latitudes
+                mismatches[variable_name] += 1
+                continue
+            deviation = analytical_dict[variable_name] - reference_dict[variable_name]
+            # seconds, or the difference of the numbers (moon_illumination)
+            deviation = abs(deviation.total_seconds() if isinstance(deviation, datetime.timedelta) else deviation)
+            deviations[variable_name] = max(deviations[variable_name], deviation)
+    return times, deviations, mismatches
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ephemeris', default=None, help='.bsp file (a synthetic ephemeris by default)')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--longitude', type=float, default=-112.70082)
+    parser.add_argument('--latitudes', type=float, nargs='+', default=DEFAULT_LATITUDES)
+    parser.add_argument('--variables', nargs='+', default=DEFAULT_VARIABLE_NAMES)
+    parsed_args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        ephemeris = parsed_args.ephemeris \
+            if parsed_args.ephemeris is not None \
+            else get_synthetic_ephemeris(directory)
+        ts = skyfield.api.load.timescale()
+
+        for latitude in parsed_args.latitudes:
+            times, deviations, mismatches = compare_latitude(
+                latitude, parsed_args.longitude, parsed_args.days, ephemeris, ts, frozenset(parsed_args.variables)
+            )
+            print(
+                f'latitude {latitude:7.2f}: skyfield {times["skyfield"]:8.3f} s, '
+                f'analytical {times["analytical"]:8.4f} s ({times["skyfield"] / times["analytical"]:.0f}x)'
+            )
+            for variable_name in sorted(deviations):
+                mismatch_str = f' ({mismatches[variable_name]} days found by one engine only)' \
+                    if mismatches[variable_name] \
+                    else ''
+                unit_str = ' s' if variable_name not in NUMBER_VARIABLE_NAMES else '  '
+                print(f'    {variable_name:40s} {deviations[variable_name]:8.3f}{unit_str}{mismatch_str}')
+            for variable_name in sorted(set(mismatches) - set(deviations)):
+                print(f'    {variable_name:40s}        - ({mismatches[variable_name]} days found by one engine only)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
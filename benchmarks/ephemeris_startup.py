@@ -0,0 +1,69 @@
+"""
+Startup time and resident memory of DatetimeVariableValuesDictFactory with different ephemeris files.
+
+Every ephemeris is measured in a fresh interpreter, e.g.:
+
+    python -m twilight_scheduled_jobs.ephemeris de421.bsp de421_excerpt.bsp 2024-01-01 2026-01-01
+    python benchmarks/ephemeris_startup.py de421.bsp de421_excerpt.bsp
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MEASUREMENT_CODE = '''
+import datetime, json, resource, sys, time
+tic = time.perf_counter()
+import pytz
+import skyfield.api
+from twilight_scheduled_jobs.datetime_variables import DatetimeVariableValuesDictFactory
+import_time = time.perf_counter() - tic
+
+station_geographic_position = skyfield.api.wgs84.latlon(39.3384, -112.70082, elevation_m=1400)
+tic = time.perf_counter()
+factory = DatetimeVariableValuesDictFactory(
+    station_geographic_position, eph=sys.argv[1], lazy_ephemeris=sys.argv[2] == 'lazy'
+)
+init_time = time.perf_counter() - tic
+
+tic = time.perf_counter()
+factory.create_dict(pytz.UTC.localize(datetime.datetime.fromisoformat(sys.argv[3])))
+first_create_dict_time = time.perf_counter() - tic
+
+print(json.dumps(dict(
+    import_time=import_time,
+    init_time=init_time,
+    first_create_dict_time=first_create_dict_time,
+    max_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+)))
+'''
+
+
+def measure(ephemeris_pathname, mode, t0_isoformat):
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASUREMENT_CODE, ephemeris_pathname, mode, t0_isoformat],
+    )
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('ephemeris', nargs='+', help='.bsp files to compare (e.g. de421.bsp and its excerpt)')
+    parser.add_argument('--t0', default='2024-05-10T00:00:00', help='t0 of the measured create_dict call (UTC)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parsed_args = parser.parse_args(args)
+
+    print(f'{"ephemeris":40s} {"mode":6s} {"import [s]":>10s} {"init [s]":>10s} '
+          f'{"create_dict [s]":>15s} {"max RSS [MiB]":>13s}')
+    for ephemeris_pathname in parsed_args.ephemeris:
+        for mode in ('eager', 'lazy'):
+            results = [measure(ephemeris_pathname, mode, parsed_args.t0) for _ in range(parsed_args.repeat)]
+            best = {key: min(result[key] for result in results) for key in results[0]}
+            print(
+                f'{ephemeris_pathname:40s} {mode:6s} {best["import_time"]:10.3f} {best["init_time"]:10.3f} '
+                f'{best["first_create_dict_time"]:15.3f} {best["max_rss_kib"] / 1024:13.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
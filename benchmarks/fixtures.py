@@ -0,0 +1,172 @@
+"""
+Offline fixtures of the benchmarks: a synthetic ephemeris and generated schedules.
+
+The synthetic ephemeris stores low-precision analytic positions of the Sun and the Moon
+(accurate to about 0.01 and 0.5 degrees, referred to J2000) as SPK type 2 segments, so the benchmarks exercise the same code paths
+as with de421.bsp without downloading it. It must not be used for actual scheduling.
+"""
+import os
+import struct
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+AU_KM = 149597870.7
+J2000 = 2451545.0
+SECONDS_PER_DAY = 86400.0
+J2000_OBLIQUITY_DEGREES = 23.4392911
+
+# 2023-01-01 - 2027-04-05
+DEFAULT_START_JD = 2459945.5
+DEFAULT_END_JD = 2461500.5
+
+
+def _precession_in_longitude(jd):
+    # the longitudes of the models are referred to the equinox of date, the SPK segments to J2000 (ICRS)
+    return np.radians(1.396971 * (jd - J2000) / 36525.0)
+
+
+def _sun_geocentric_km(jd):
+    n = jd - J2000
+    mean_longitude = np.radians(280.460 + 0.9856474 * n)
+    mean_anomaly = np.radians(357.528 + 0.9856003 * n)
+    ecliptic_longitude = mean_longitude \
+        + np.radians(1.915) * np.sin(mean_anomaly) + np.radians(0.020) * np.sin(2 * mean_anomaly) \
+        - _precession_in_longitude(jd)
+    distance = (1.00014 - 0.01671 * np.cos(mean_anomaly) - 0.00014 * np.cos(2 * mean_anomaly)) * AU_KM
+    obliquity = np.radians(J2000_OBLIQUITY_DEGREES)
+    return np.array([
+        distance * np.cos(ecliptic_longitude),
+        distance * np.cos(obliquity) * np.sin(ecliptic_longitude),
+        distance * np.sin(obliquity) * np.sin(ecliptic_longitude),
+    ])
+
+
+def _moon_geocentric_km(jd):
+    t = (jd - J2000) / 36525.0
+    d = np.radians
+    ecliptic_longitude = d(
+        218.32 + 481267.881 * t
+        + 6.29 * np.sin(d(135.0 + 477198.87 * t)) - 1.27 * np.sin(d(259.3 - 413335.36 * t))
+        + 0.66 * np.sin(d(235.7 + 890534.22 * t)) + 0.21 * np.sin(d(269.9 + 954397.74 * t))
+        - 0.19 * np.sin(d(357.5 + 35999.05 * t)) - 0.11 * np.sin(d(186.5 + 966404.03 * t))
+    ) - _precession_in_longitude(jd)
+    ecliptic_latitude = d(
+        5.13 * np.sin(d(93.3 + 483202.02 * t)) + 0.28 * np.sin(d(228.2 + 960400.89 * t))
+        - 0.28 * np.sin(d(318.3 + 6003.15 * t)) - 0.17 * np.sin(d(217.6 - 407332.21 * t))
+    )
+    parallax = d(
+        0.9508 + 0.0518 * np.cos(d(135.0 + 477198.87 * t)) + 0.0095 * np.cos(d(259.3 - 413335.36 * t))
+        + 0.0078 * np.cos(d(235.7 + 890534.22 * t)) + 0.0028 * np.cos(d(269.9 + 954397.74 * t))
+    )
+    distance = 6378.14 / np.sin(parallax)
+    obliquity = d(J2000_OBLIQUITY_DEGREES)
+    x = distance * np.cos(ecliptic_latitude) * np.cos(ecliptic_longitude)
+    y = distance * np.cos(ecliptic_latitude) * np.sin(ecliptic_longitude)
+    z = distance * np.sin(ecliptic_latitude)
+    return np.array([x, y * np.cos(obliquity) - z * np.sin(obliquity), y * np.sin(obliquity) + z * np.cos(obliquity)])
+
+
+def _circular_orbit_km(semi_major_axis_au, period_days):
+    def position(jd):
+        angle = 2 * np.pi * (jd - J2000) / period_days
+        return np.array([
+            semi_major_axis_au * AU_KM * np.cos(angle),
+            semi_major_axis_au * AU_KM * np.sin(angle),
+            np.zeros_like(jd),
+        ])
+    return position
+
+
+def _zero_km(jd):
+    return np.zeros((3,) + np.shape(jd))
+
+
+def _chebyshev_segment(position_func, start_jd, end_jd, interval_days=8.0, coefficient_count=13):
+    record_count = int(np.ceil((end_jd - start_jd) / interval_days))
+    interval_seconds = interval_days * SECONDS_PER_DAY
+    init = (start_jd - J2000) * SECONDS_PER_DAY
+    nodes = np.cos(np.pi * (np.arange(coefficient_count * 2) + 0.5) / (coefficient_count * 2))
+    records = []
+    for i in range(record_count):
+        midpoint = init + (i + 0.5) * interval_seconds
+        radius = interval_seconds / 2
+        positions = position_func(J2000 + (midpoint + nodes * radius) / SECONDS_PER_DAY)
+        record = [midpoint, radius]
+        for component in positions:
+            record.extend(chebyshev.chebfit(nodes, component, coefficient_count - 1))
+        records.append(record)
+    array = np.concatenate([
+        np.array(records).ravel(),
+        [init, interval_seconds, 2 + 3 * coefficient_count, record_count]
+    ])
+    return init, init + record_count * interval_seconds, array
+
+
+def create_synthetic_ephemeris(pathname, start_jd=DEFAULT_START_JD, end_jd=DEFAULT_END_JD, with_moon=True):
+    """
+    Write a synthetic SPK file with the Sun, the Earth-Moon barycenter, the Earth, the Jupiter and Saturn barycenters
+    (light deflectors of Skyfield apparent()) and optionally the Moon.
+    """
+    from jplephem.daf import DAF, FTPSTR, K
+
+    file_record = struct.pack(
+        '<8sII60sIII8s603s28s297s',
+        b'DAF/SPK ', 2, 6, b'synthetic ephemeris fixture'.ljust(60), 3, 3, 0, b'LTL-IEEE',
+        b'\0' * 603, FTPSTR, b'\0' * 297,
+    )
+    bodies = [
+        (10, 0, _zero_km),
+        (3, 0, lambda jd: -_sun_geocentric_km(jd)),
+        (399, 3, _zero_km),
+        (5, 0, _circular_orbit_km(5.2, 4332.6)),
+        (6, 0, _circular_orbit_km(9.54, 10759.2)),
+    ]
+    if with_moon:
+        bodies.append((301, 3, _moon_geocentric_km))
+
+    with open(pathname, 'w+b') as f:
+        f.write(file_record)
+        f.write(b'synthetic ephemeris fixture\0\4'.ljust(K, b' '))
+        f.write(b'\0' * K)
+        f.write(b' ' * K)
+        f.seek(0)
+        daf = DAF(f)
+        daf.free = 3 * (K // 8) + 1
+        daf.write_file_record()
+        for target, center, position_func in bodies:
+            start_seconds, end_seconds, array = _chebyshev_segment(position_func, start_jd, end_jd)
+            daf.add_array(b'synthetic', (start_seconds, end_seconds, target, center, 1, 2), array)
+    return pathname
+
+
+def get_synthetic_ephemeris(directory):
+    pathname = os.path.join(directory, 'synthetic_ephemeris.bsp')
+    if not os.path.exists(pathname):
+        create_synthetic_ephemeris(pathname)
+    return pathname
+
+
+def create_schedule_dict(key_count, variable_marker='@'):
+    """
+    Schedule with `key_count` keys spread over the twilight variables, e.g. '@nautical_twilight_start + 3m'.
+    """
+    base_variable_names = (
+        'civil_twilight_start', 'nautical_twilight_start', 'astronomical_twilight_start', 'night_start',
+        'next_day_astronomical_twilight_start', 'next_day_nautical_twilight_start', 'next_day_civil_twilight_start',
+    )
+    schedule_dict = {}
+    for i in range(key_count):
+        base_variable_name = base_variable_names[i % len(base_variable_names)]
+        offset_seconds = (i // len(base_variable_names)) % 3600
+        shift = f' + {offset_seconds // 60}m {offset_seconds % 60}s' if offset_seconds else ''
+        schedule_dict[f'{variable_marker}{base_variable_name}{shift}'] = dict(gain=i % 70)
+    return schedule_dict
+
+
+def write_schedule_file(pathname, key_count, variable_marker='@'):
+    import yaml
+
+    with open(pathname, 'w') as f:
+        yaml.safe_dump(create_schedule_dict(key_count, variable_marker), f)
+    return pathname
@@ -0,0 +1,287 @@
+"""
+Benchmarks of the scheduling hot paths, running offline with a synthetic ephemeris (see fixtures.py).
+
+    python benchmarks/hot_paths.py --output results.json
+    python benchmarks/hot_paths.py --baseline results.json --threshold 0.25
+
+Every case reports the best time of `--repeat` runs and the peak memory allocated by Python (tracemalloc)
+in a separate run. With `--baseline`, the exit status is 1 when a case is slower than the baseline
+by more than `--threshold` (relative).
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+import pytz
+import skyfield
+import skyfield.api
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schedule  # noqa: E402
+
+from twilight_scheduled_jobs import __version__  # noqa: E402
+from twilight_scheduled_jobs.datetime_variables import DatetimeVariableValuesDictFactory  # noqa: E402
+from twilight_scheduled_jobs.floating_next_run_job import CustomizableScheduler  # noqa: E402
+from twilight_scheduled_jobs.jobs import initialize_jobs  # noqa: E402
+from twilight_scheduled_jobs.parser import (  # noqa: E402
+    compile_datetime_expression, load_job_settings_dict_yaml, parse_timestamp_syntax
+)
+
+from fixtures import create_schedule_dict, get_synthetic_ephemeris, write_schedule_file  # noqa: E402
+
+STATION_GEOGRAPHIC_POSITION = skyfield.api.wgs84.latlon(39.3384, -112.70082, elevation_m=1400)
+START_T0 = pytz.UTC.localize(datetime.datetime(2024, 1, 1, 7, 13, 11, 123456))
+T0_STEP = datetime.timedelta(hours=23)
+NEXT_T0_EXPRESSION = '@sun_meridian_transit'
+
+logger = logging.getLogger('benchmarks')
+
+
+class BenchmarkContext:
+
+    def __init__(self, directory, ephemeris, ts):
+        self.directory = directory
+        self.ephemeris = ephemeris
+        self.ts = ts
+        self.schedule_files = {}
+
+    def create_factory(self, **kwargs):
+        return DatetimeVariableValuesDictFactory(
+            STATION_GEOGRAPHIC_POSITION, timezone=pytz.UTC, ts=self.ts, eph=self.ephemeris, **kwargs
+        )
+
+    def schedule_file(self, key_count):
+        if key_count not in self.schedule_files:
+            self.schedule_files[key_count] = write_schedule_file(
+                os.path.join(self.directory, f'schedule_{key_count}.yaml'), key_count
+            )
+        return self.schedule_files[key_count]
+
+    def initialize_jobs(self, factory, key_count):
+        job_settings_by_datetime_expression = load_job_settings_dict_yaml(
+            self.schedule_file(key_count), fallback_timezone=pytz.UTC
+        )
+        return initialize_jobs(
+            datetime_expression=job_settings_by_datetime_expression,
+            next_t0_datetime_expression=compile_datetime_expression(parse_timestamp_syntax(NEXT_T0_EXPRESSION)),
+            start_t0=START_T0,
+            settings_job_func=lambda **kwargs: None,
+            create_dict_func=partial(factory.create_dict, use_cache=True),
+            logger=logger,
+            scheduler=CustomizableScheduler(),
+            t0_step=T0_STEP,
+        )
+
+
+def create_dict_cold(context):
+    factory = context.create_factory()
+    yield
+    factory.create_dict(START_T0)
+
+
+def create_dict_warm(context):
+    factory = context.create_factory()
+    factory.create_dict(START_T0)
+    yield
+    for i in range(1000):
+        factory.create_dict(START_T0 + datetime.timedelta(microseconds=i))
+
+
+def create_dict_year(context, horizon=None):
+    factory = context.create_factory(horizon=horizon, background_extension=False)
+    yield
+    for i in range(365):
+        factory.create_dict(START_T0 + datetime.timedelta(days=i))
+
+
+def parse_timestamp_syntax_keys(context, key_count):
+    keys = list(create_schedule_dict(key_count).keys())
+    yield
+    for key in keys:
+        parse_timestamp_syntax(key)
+
+
+def load_job_settings_dict_yaml_keys(context, key_count):
+    pathname = context.schedule_file(key_count)
+    yield
+    load_job_settings_dict_yaml(pathname, fallback_timezone=pytz.UTC)
+
+
+def load_job_settings_dict_yaml_cached_keys(context, key_count):
+    pathname = context.schedule_file(key_count)
+    cache_dir = os.path.join(context.directory, 'schedule_cache')
+    # the first load fills the cache
+    load_job_settings_dict_yaml(pathname, fallback_timezone=pytz.UTC, cache_dir=cache_dir)
+    yield
+    load_job_settings_dict_yaml(pathname, fallback_timezone=pytz.UTC, cache_dir=cache_dir)
+
+
+def initialize_jobs_keys(context, key_count):
+    factory = context.create_factory()
+    # the events are computed outside of the measurement
+    factory.create_dict(START_T0)
+    yield
+    context.initialize_jobs(factory, key_count)
+
+
+def schedule_next_run_throughput(context, key_count):
+    factory = context.create_factory()
+    jobs = list(context.initialize_jobs(factory, key_count).values())
+    for job in jobs:
+        job._schedule_next_run()
+    yield
+    for _ in range(10):
+        for job in jobs:
+            job._schedule_next_run()
+
+
+def simulated_year(context, key_count):
+    factory = context.create_factory()
+    yield
+    jobs = list(context.initialize_jobs(factory, key_count).values())
+    end_datetime = (START_T0 + datetime.timedelta(days=365)).replace(tzinfo=None)
+    while jobs:
+        for job in jobs:
+            job._schedule_next_run()
+        jobs = [job for job in jobs if job.next_run < end_datetime]
+
+
+CASES = [
+    ('create_dict cold', create_dict_cold),
+    ('create_dict warm x1000', create_dict_warm),
+    ('create_dict 365 days', create_dict_year),
+    ('create_dict 365 days horizon=366d', partial(create_dict_year, horizon=datetime.timedelta(days=366))),
+] + [
+    (f'parse_timestamp_syntax {key_count} keys', partial(parse_timestamp_syntax_keys, key_count=key_count))
+    for key_count in (10, 100, 1000, 10000)
+] + [
+    (f'load_job_settings_dict_yaml {key_count} keys', partial(load_job_settings_dict_yaml_keys, key_count=key_count))
+    for key_count in (10, 100, 1000, 10000)
+] + [
+    (
+        f'load_job_settings_dict_yaml cached {key_count} keys',
+        partial(load_job_settings_dict_yaml_cached_keys, key_count=key_count)
+    )
+    for key_count in (1000, 10000)
+] + [
+    (f'initialize_jobs {key_count} keys', partial(initialize_jobs_keys, key_count=key_count))
+    for key_count in (10, 100, 1000)
+] + [
+    (f'_schedule_next_run x10 {key_count} jobs', partial(schedule_next_run_throughput, key_count=key_count))
+    for key_count in (10, 100)
+] + [
+    (f'simulated year {key_count} jobs', partial(simulated_year, key_count=key_count))
+    for key_count in (10, 100)
+]
+
+
+def run_case(case_func, context, trace_memory=False):
+    """
+    Run the setup of the case (up to its yield) and measure the rest.
+    """
+    case = case_func(context)
+    next(case)
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    tic = time.perf_counter()
+    try:
+        next(case)
+    except StopIteration:
+        pass
+    elapsed = time.perf_counter() - tic
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak_memory
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ephemeris', default=None, help='.bsp file (a synthetic ephemeris by default)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--max-repeated-time', type=float, default=5.,
+        help='cases slower than this (in seconds) are run only once'
+    )
+    parser.add_argument('--filter', default=None, help='run only the cases containing this string')
+    parser.add_argument('--output', default=None, help='write the results to a JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument(
+        '--min-time', type=float, default=0.005,
+        help='cases faster than this (in seconds) in the baseline are not checked for regressions'
+    )
+    parsed_args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    # the job initialization logs every job
+    logging.getLogger('benchmarks').setLevel(logging.WARNING)
+    logging.getLogger('scheduled_camera_settings_changer').setLevel(logging.WARNING)
+
+    baseline = None
+    if parsed_args.baseline is not None:
+        with open(parsed_args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    with tempfile.TemporaryDirectory() as directory:
+        ephemeris = parsed_args.ephemeris \
+            if parsed_args.ephemeris is not None \
+            else get_synthetic_ephemeris(directory)
+        context = BenchmarkContext(directory, ephemeris, skyfield.api.load.timescale())
+
+        results = {}
+        regressions = []
+        print(f'{"case":45s} {"time [s]":>10s} {"peak [MiB]":>10s} {"baseline":>10s}')
+        for case_name, case_func in CASES:
+            if parsed_args.filter is not None and parsed_args.filter not in case_name:
+                continue
+            elapsed = run_case(case_func, context)[0]
+            if elapsed < parsed_args.max_repeated_time:
+                for _ in range(parsed_args.repeat - 1):
+                    elapsed = min(elapsed, run_case(case_func, context)[0])
+            _, peak_memory = run_case(case_func, context, trace_memory=True)
+            results[case_name] = dict(time=elapsed, peak_memory=peak_memory)
+
+            baseline_str = ''
+            if baseline is not None and case_name in baseline:
+                ratio = elapsed / baseline[case_name]['time']
+                baseline_str = f'{ratio:9.2f}x'
+                # the timer noise dominates the shortest cases
+                if ratio > 1 + parsed_args.threshold and baseline[case_name]['time'] >= parsed_args.min_time:
+                    regressions.append(case_name)
+                    baseline_str += ' REGRESSION'
+            print(f'{case_name:45s} {elapsed:10.4f} {peak_memory / 2 ** 20:10.2f} {baseline_str}')
+
+    if parsed_args.output is not None:
+        with open(parsed_args.output, 'w') as f:
+            json.dump(dict(
+                versions=dict(
+                    twilight_scheduled_jobs=__version__,
+                    skyfield=skyfield.__version__,
+                    schedule=getattr(schedule, '__version__', None),
+                    python=sys.version.split()[0],
+                ),
+                ephemeris=os.path.basename(parsed_args.ephemeris) if parsed_args.ephemeris else 'synthetic',
+                results=results,
+            ), f, indent=2)
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) above the {parsed_args.threshold:.0%} threshold: '
+              f'{", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
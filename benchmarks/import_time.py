@@ -0,0 +1,72 @@
+"""
+Import time of the package and of its entry points, and the heavy dependencies they load.
+
+Every import is measured in a fresh interpreter (the best of `--repeat` runs), e.g.:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --max-seconds 0.05  # exit status 1 if `import twilight_scheduled_jobs` is slower
+
+`python -X importtime -c "import twilight_scheduled_jobs"` shows the time of every imported module.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('skyfield', 'numpy', 'yaml', 'dateutil', 'schedule', 'tzlocal')
+
+DEFAULT_STATEMENTS = (
+    'import twilight_scheduled_jobs',
+    'from twilight_scheduled_jobs import parse_timestamp_syntax',
+    'from twilight_scheduled_jobs import load_job_settings_dict_yaml',
+    'from twilight_scheduled_jobs import twilight_scheduled_jobs_main',
+)
+
+MEASUREMENT_CODE = '''
+import json, sys, time
+tic = time.perf_counter()
+exec(sys.argv[1])
+import_time = time.perf_counter() - tic
+heavy_modules = [module_name for module_name in sys.argv[2].split(',') if module_name in sys.modules]
+print(json.dumps(dict(import_time=import_time, heavy_modules=heavy_modules)))
+'''
+
+
+def measure(statement):
+    python_path = os.pathsep.join(filter(None, (PACKAGE_DIRECTORY, os.environ.get('PYTHONPATH'))))
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASUREMENT_CODE, statement, ','.join(HEAVY_MODULES)],
+        env=dict(os.environ, PYTHONPATH=python_path),
+    )
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--statements', nargs='+', default=DEFAULT_STATEMENTS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--max-seconds', type=float, default=None,
+        help='Maximum import time of the first statement, the exit status is 1 if it is exceeded'
+    )
+    parsed_args = parser.parse_args(args)
+
+    import_times = []
+    print(f'{"statement":65s} {"import [ms]":>11s}  heavy modules')
+    for statement in parsed_args.statements:
+        results = [measure(statement) for _ in range(parsed_args.repeat)]
+        import_time = min(result['import_time'] for result in results)
+        import_times.append(import_time)
+        print(f'{statement:65s} {import_time * 1e3:11.1f}  {", ".join(results[0]["heavy_modules"]) or "-"}')
+
+    if parsed_args.max_seconds is not None and import_times[0] > parsed_args.max_seconds:
+        print(f'{parsed_args.statements[0]} took {import_times[0]:.3f} s (maximum {parsed_args.max_seconds} s)')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,7 @@ setup(
     packages=find_packages(),
     setup_requires=['wheel'],
     install_requires=[
+        'numpy',
         'python-dateutil==2.8.2',
         'pytimeparse==1.1.8',
         'pytz==2023.3',
@@ -26,5 +27,10 @@ setup(
         'Intended Audience :: Science/Research',
         'Programming Language :: Python :: 3.9',
     ],
-    scripts=[]
+    scripts=[],
+    entry_points={
+        'console_scripts': [
+            'twilight-scheduled-jobs = twilight_scheduled_jobs.__main__:main',
+        ],
+    },
 )
\ No newline at end of file
@@ -1,8 +1,60 @@
-from .parser import resolve_variables, evaluate_resolved_expression, load_job_settings_dict_yaml, parse_timestamp_syntax
-from .defaults import DEFAULTS
-from .datetime_variables import DatetimeVariableValuesDictFactory
-from .jobs import initialize_jobs, run_pending_loop
-from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob
-from .main import twilight_scheduled_jobs_main
+import importlib
 
 __version__ = '0.1.4'
+
+# the public names are imported from their modules when they are first accessed (PEP 562),
+# so that importing the package (e.g. only for parse_timestamp_syntax) does not import Skyfield, numpy or schedule
+_LAZY_ATTRIBUTES = {
+    '.parser': (
+        'resolve_variables', 'evaluate_resolved_expression', 'load_job_settings_dict_yaml', 'parse_timestamp_syntax',
+        'CompiledDatetimeExpression', 'compile_datetime_expression', 'evaluate_datetime_expressions',
+        'MissingEventError',
+    ),
+    '.defaults': ('DEFAULTS',),
+    '.datetime_variables': ('DatetimeVariableValuesDictFactory',),
+    '.engines': ('AnalyticalSolarEngine', 'EventEngine', 'SkyfieldEventEngine'),
+    '.jobs': ('initialize_jobs', 'run_pending_loop', 'update_jobs'),
+    '.floating_next_run_job': ('CustomizableScheduler', 'FloatingNextRunJob'),
+    '.main': ('twilight_scheduled_jobs_main',),
+    '.schedule_file_watcher': ('ScheduleFileWatcher',),
+    '.schedule_cache': ('CompiledScheduleCache',),
+    '.asyncio_scheduler': (
+        'AsyncCustomizableScheduler', 'AsyncFloatingNextRunJob', 'run_pending_loop_async',
+        'twilight_scheduled_jobs_main_async',
+    ),
+    '.executors': ('InlineJobExecutor', 'ProcessPoolJobExecutor', 'ThreadPoolJobExecutor'),
+    '.metrics': ('CallbackSink', 'MetricsRegistry', 'PrometheusTextfileSink', 'configure_metrics'),
+    '.multi_station': ('StationGroupEvents', 'twilight_scheduled_jobs_multi_station_main'),
+    '.clock': ('SystemClock', 'VirtualClock'),
+    '.settings_state': ('DifferentialSettingsApplier',),
+    '.journal': ('RunJournal', 'catch_up_missed_runs'),
+    '.simulation': ('run_simulation', 'twilight_scheduled_jobs_simulate'),
+    '.occurrences': (
+        'iter_occurrences', 'schedule_file_occurrences', 'write_occurrences_csv', 'write_occurrences_json',
+    ),
+    '.sharding': (
+        'SharedEventTableEngine', 'attach_event_tables', 'publish_event_tables', 'twilight_scheduled_jobs_sharded_main',
+    ),
+}
+_ATTRIBUTE_MODULES = {
+    attribute_name: (module_name, attribute_name)
+    for module_name, attribute_names in _LAZY_ATTRIBUTES.items()
+    for attribute_name in attribute_names
+}
+_ATTRIBUTE_MODULES['METRICS_REGISTRY'] = ('.metrics', 'REGISTRY')
+
+__all__ = sorted(_ATTRIBUTE_MODULES) + ['__version__']
+
+
+def __getattr__(name):
+    if name not in _ATTRIBUTE_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attribute_name = _ATTRIBUTE_MODULES[name]
+    value = getattr(importlib.import_module(module_name, __name__), attribute_name)
+    # the next accesses do not call __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_ATTRIBUTE_MODULES))
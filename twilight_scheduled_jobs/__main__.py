@@ -0,0 +1,203 @@
+import argparse
+import importlib
+import json
+import logging
+import sys
+
+from .defaults import DEFAULTS
+
+
+def log_settings(settings_dict, logger, **kwargs):
+    """
+    Default settings job function of the command line: only logs the settings.
+    """
+    logger.info('Settings: %s', json.dumps(settings_dict, default=str))
+
+
+def import_func(func_path):
+    """
+    :return: function given as 'module:function' (e.g. 'my_camera.control:change_camera_settings')
+    """
+    module_name, _, func_name = func_path.partition(':')
+    if not module_name or not func_name:
+        raise ValueError(f'Expected module:function, got {func_path}.')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def get_station_geographic_position(parsed_args):
+    import skyfield.api
+
+    if parsed_args.latitude is not None and parsed_args.longitude is not None:
+        return skyfield.api.wgs84.latlon(parsed_args.latitude, parsed_args.longitude, elevation_m=parsed_args.elevation)
+    from .skyfield_demo_calculaton import station_locations
+
+    if parsed_args.station not in station_locations:
+        raise ValueError(
+            f'Unknown station {parsed_args.station}, expected one of {", ".join(station_locations)} '
+            f'or --latitude and --longitude.'
+        )
+    return station_locations[parsed_args.station]
+
+
+def check_schedule_file(parsed_args):
+    """
+    Load and compile the schedule file (without computing any events).
+    """
+    from .parser import load_job_settings_dict_yaml
+
+    job_settings_by_datetime_expression = load_job_settings_dict_yaml(
+        pathname=parsed_args.schedule_file,
+        fallback_timezone=parsed_args.timezone,
+        variable_marker=parsed_args.variable_marker,
+        cache_dir=parsed_args.schedule_cache_dir,
+    )
+    print(f'{parsed_args.schedule_file}: {len(job_settings_by_datetime_expression)} keys OK')
+
+
+def simulate_schedule_file(parsed_args, settings_job_func):
+    from .simulation import twilight_scheduled_jobs_simulate
+
+    dispatches = twilight_scheduled_jobs_simulate(
+        schedule_file=parsed_args.schedule_file,
+        station_geographic_position=get_station_geographic_position(parsed_args),
+        start_datetime=parsed_args.simulate[0],
+        end_datetime=parsed_args.simulate[1],
+        settings_job_func=settings_job_func,
+        timezone=parsed_args.timezone,
+        variable_marker=parsed_args.variable_marker,
+        ephemeris=parsed_args.ephemeris,
+        engine=parsed_args.engine,
+        schedule_cache_dir=parsed_args.schedule_cache_dir,
+        coalesce_window=parsed_args.coalesce_window,
+    )
+    for dispatch in dispatches:
+        error_str = f' ERROR [{type(dispatch["error"]).__name__}] {dispatch["error"]}' \
+            if dispatch['error'] is not None \
+            else ''
+        print(f'{dispatch["datetime"].isoformat()} {json.dumps(dispatch["settings_dict"], default=str)}{error_str}')
+    return 1 if any(dispatch['error'] is not None for dispatch in dispatches) else 0
+
+
+def write_schedule_file_occurrences(parsed_args):
+    from .occurrences import schedule_file_occurrences, write_occurrences_csv, write_occurrences_json
+
+    occurrences = schedule_file_occurrences(
+        schedule_file=parsed_args.schedule_file,
+        station_geographic_position=get_station_geographic_position(parsed_args),
+        start_datetime=parsed_args.occurrences[0],
+        end_datetime=parsed_args.occurrences[1],
+        timezone=parsed_args.timezone,
+        variable_marker=parsed_args.variable_marker,
+        schedule_cache_dir=parsed_args.schedule_cache_dir,
+        horizon=parsed_args.horizon,
+        event_store_dir=parsed_args.event_store_dir,
+        ephemeris=parsed_args.ephemeris,
+        engine=parsed_args.engine,
+    )
+    write_occurrences = write_occurrences_json \
+        if parsed_args.format == 'json' \
+        else write_occurrences_csv
+    write_occurrences(occurrences, sys.stdout)
+    return 0
+
+
+def run_schedule_file(parsed_args, settings_job_func):
+    from . import safe_termination
+    from .main import twilight_scheduled_jobs_main
+
+    safe_termination.init()
+    twilight_scheduled_jobs_main(
+        schedule_file=parsed_args.schedule_file,
+        station_geographic_position=get_station_geographic_position(parsed_args),
+        settings_job_func=settings_job_func,
+        timezone=parsed_args.timezone,
+        variable_marker=parsed_args.variable_marker,
+        horizon=parsed_args.horizon,
+        event_store_dir=parsed_args.event_store_dir,
+        ephemeris=parsed_args.ephemeris,
+        lazy_ephemeris=parsed_args.lazy_ephemeris,
+        engine=parsed_args.engine,
+        schedule_cache_dir=parsed_args.schedule_cache_dir,
+        journal_file=parsed_args.journal_file,
+        catch_up_policy=parsed_args.catch_up_policy,
+        coalesce_window=parsed_args.coalesce_window,
+        watch_schedule_file=parsed_args.watch_schedule_file,
+    )
+    return 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='twilight-scheduled-jobs',
+        description='Run (or check, or simulate) the jobs of a twilight schedule file.',
+    )
+    parser.add_argument('schedule_file', help='Schedule file (YAML)')
+    parser.add_argument('--station', default='tara', help='Station name (default: %(default)s)')
+    parser.add_argument('--latitude', type=float, default=None, help='Station latitude (instead of --station)')
+    parser.add_argument('--longitude', type=float, default=None, help='Station longitude (instead of --station)')
+    parser.add_argument('--elevation', type=float, default=0., help='Station elevation in meters')
+    parser.add_argument('--timezone', default=DEFAULTS['timezone'], help='Timezone (default: %(default)s)')
+    parser.add_argument(
+        '--settings-job-func', default=None,
+        help='Settings job function as module:function (the settings are only logged by default)'
+    )
+    parser.add_argument(
+        '--check', action='store_true',
+        help='Only load and compile the schedule file, the exit status is 1 if it is invalid'
+    )
+    parser.add_argument(
+        '--simulate', nargs=2, metavar=('START', 'END'), default=None,
+        help='Simulate the schedule between two datetimes and print the dispatches'
+    )
+    parser.add_argument(
+        '--occurrences', nargs=2, metavar=('START', 'END'), default=None,
+        help='Print the occurrences of the jobs between two datetimes (without running them)'
+    )
+    parser.add_argument('--format', default='csv', choices=('csv', 'json'), help='Format of --occurrences')
+    parser.add_argument('--variable-marker', default=DEFAULTS['variable_marker'])
+    parser.add_argument('--ephemeris', default=DEFAULTS['ephemeris'])
+    parser.add_argument(
+        '--lazy-ephemeris', action='store_true', default=DEFAULTS['lazy_ephemeris'],
+        help='Open the ephemeris only when the first event search is needed (e.g. with a populated event store)'
+    )
+    parser.add_argument('--engine', default=DEFAULTS['engine'], help='Event engine (skyfield or analytical)')
+    parser.add_argument('--horizon', default=DEFAULTS['horizon'], help='Event horizon (e.g. 30d)')
+    parser.add_argument('--event-store-dir', default=DEFAULTS['event_store_dir'])
+    parser.add_argument('--schedule-cache-dir', default=DEFAULTS['schedule_cache_dir'])
+    parser.add_argument('--journal-file', default=DEFAULTS['journal_file'])
+    parser.add_argument('--catch-up-policy', default=DEFAULTS['catch_up_policy'], choices=('latest', 'all', 'skip'))
+    parser.add_argument('--coalesce-window', type=float, default=DEFAULTS['coalesce_window'])
+    parser.add_argument('--watch-schedule-file', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parsed_args = parser.parse_args(args)
+
+    # the job logs of a check, a simulation or the occurrences are shown with --verbose only
+    quiet = parsed_args.check or parsed_args.simulate is not None or parsed_args.occurrences is not None
+    logging.basicConfig(
+        level=logging.DEBUG if parsed_args.verbose
+        else logging.WARNING if quiet
+        else logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    )
+
+    if parsed_args.check:
+        try:
+            check_schedule_file(parsed_args)
+        except Exception as e:
+            print(f'{parsed_args.schedule_file}: [{type(e).__name__}] {e}', file=sys.stderr)
+            return 1
+        return 0
+    if parsed_args.occurrences is not None:
+        return write_schedule_file_occurrences(parsed_args)
+
+    settings_job_func = import_func(parsed_args.settings_job_func) \
+        if parsed_args.settings_job_func is not None \
+        else None
+    if parsed_args.simulate is not None:
+        # the simulated settings are only recorded by default
+        return simulate_schedule_file(parsed_args, settings_job_func)
+    return run_schedule_file(parsed_args, settings_job_func if settings_job_func is not None else log_settings)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
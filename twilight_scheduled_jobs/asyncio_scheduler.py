@@ -0,0 +1,327 @@
+import asyncio
+import datetime
+import inspect
+import logging
+import time
+from functools import partial
+
+import dateutil.parser
+import pytimeparse.timeparse
+import pytz
+import schedule
+
+from . import metrics, safe_termination
+from .datetime_variables import DatetimeVariableValuesDictFactory
+from .defaults import DEFAULTS
+from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob, coalesce_job_funcs
+from .main import DEFAULT_LOGGER_NAME, create_schedule_file_watcher, initialize_schedule_file_jobs
+from .metrics import configure_metrics
+
+
+class AsyncFloatingNextRunJob(FloatingNextRunJob):
+
+    async def run(self, job_func=None):
+        """
+        Run the job (or `job_func` instead of the job function, see coalesce_job_funcs),
+        awaiting its result if it is awaitable, and immediately reschedule it.
+        The awaited result is limited by the scheduler job_timeout (if set): a timed-out run-once job is cancelled,
+        a timed-out recurring job fails (TimeoutError) and is retried as the other failed jobs.
+        The next run is resolved in the default executor of the event loop, so that the event computation
+        does not block the other coroutines.
+
+        :return: The return value returned by the `job_func`, or CancelJob if the job's
+                 deadline is reached.
+
+        """
+        now = self.clock.now()
+        if self._is_overdue(now):
+            self.logger.debug("Cancelling job %s", self)
+            return schedule.CancelJob
+
+        self.logger.debug("Running job %s", self)
+        if self.next_run is not None:
+            metrics.job_dispatch_lateness_seconds.observe(max(0., (now - self.next_run).total_seconds()))
+        metrics.jobs_run_total.inc()
+        tic = time.perf_counter()
+        job_func = job_func if job_func is not None else self.job_func
+        ret = job_func()
+        if inspect.isawaitable(ret):
+            job_timeout = getattr(self.scheduler, 'job_timeout', None)
+            try:
+                ret = await asyncio.wait_for(ret, timeout=job_timeout)
+            except asyncio.TimeoutError:
+                metrics.job_duration_seconds.observe(time.perf_counter() - tic)
+                self.last_run = self.clock.now()
+                if self.run_once:
+                    # rescheduling would resolve the same (past) datetime again
+                    self.logger.error('Job %s timed out after %s s, cancelling the run-once job', self, job_timeout)
+                    return schedule.CancelJob
+                # the job is not rescheduled, run_pending_loop_async retries it after the check interval
+                raise asyncio.TimeoutError(f'Timed out after {job_timeout} s') from None
+        metrics.job_duration_seconds.observe(time.perf_counter() - tic)
+        self.last_run = self.clock.now()
+
+        if not (isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob):
+            await asyncio.get_running_loop().run_in_executor(None, self._schedule_next_run)
+
+            if self._is_overdue(self.next_run):
+                self.logger.debug("Cancelling job %s", self)
+                return schedule.CancelJob
+
+        return ret
+
+
+class _AsyncioEventSetter:
+    """
+    Thread-safe (and signal handler safe) setter of an asyncio.Event, usable as a safe termination wakeup event.
+    """
+
+    def __init__(self, event, loop):
+        self.event = event
+        self.loop = loop
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class AsyncCustomizableScheduler(CustomizableScheduler):
+    """
+    Scheduler running all pending jobs concurrently in the running asyncio event loop.
+    """
+
+    def __init__(
+            self, job_class=AsyncFloatingNextRunJob, job_timeout=None, clock=None,
+            coalesce_window=DEFAULTS['coalesce_window'],
+    ):
+        super().__init__(job_class=job_class, clock=clock, coalesce_window=coalesce_window)
+        self.job_timeout = job_timeout
+        self.async_wakeup_event = None
+        self._loop = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.async_wakeup_event = asyncio.Event()
+        return self.async_wakeup_event
+
+    def notify_jobs_changed(self):
+        super().notify_jobs_changed()
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.async_wakeup_event.set)
+
+    async def run_pending(self) -> int:
+        """
+        Run the pending jobs concurrently and wait for all of them, the errors are logged by the failed jobs.
+        A failed job is not rescheduled (it is still due), so run_pending_loop_async retries it.
+
+        :return: number of the failed job groups
+        """
+        self.cancel_requested_jobs()
+        job_groups = self.runnable_job_groups()
+        results = await asyncio.gather(
+            *(self._run_coalesced_jobs(jobs) for jobs in job_groups),
+            return_exceptions=True,
+        )
+        failed_count = 0
+        for jobs, result in zip(job_groups, results):
+            if isinstance(result, Exception):
+                failed_count += 1
+                jobs[0].logger.error('Error in job [%s]: %s', type(result).__name__, str(result), exc_info=result)
+            elif isinstance(result, BaseException):
+                raise result
+        return failed_count
+
+    async def _run_coalesced_jobs(self, jobs) -> None:
+        job_func = coalesce_job_funcs(jobs) \
+            if len(jobs) > 1 \
+            else None
+        await self._run_job(jobs[0], job_func=job_func)
+        for job in jobs[1:]:
+            # rescheduled in the default executor, as by AsyncFloatingNextRunJob.run
+            ret = await asyncio.get_running_loop().run_in_executor(None, job.run_coalesced, jobs[0])
+            if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+                self.cancel_job(job)
+
+    async def _run_job(self, job, job_func=None) -> None:
+        ret = job.run(job_func=job_func)
+        if inspect.isawaitable(ret):
+            ret = await ret
+        if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+            self.cancel_job(job)
+
+
+async def run_pending_loop_async(
+        scheduler,
+        logger,
+        schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        watchers=None,
+):
+    logger.debug('Starting scheduled camera settings loop (asyncio)')
+    wakeup_event = scheduler._bind_loop()
+    wakeup_event_setter = _AsyncioEventSetter(wakeup_event, asyncio.get_running_loop())
+    safe_termination.register_wakeup_event(wakeup_event_setter)
+    try:
+        while not safe_termination.terminate_flag:
+            wakeup_event.clear()
+            metrics.loop_wakeups_total.inc()
+            for watcher in watchers or []:
+                watcher.poll()
+            run_pending_failed = False
+            try:
+                failed_count = await scheduler.run_pending()
+                if failed_count:
+                    run_pending_failed = True
+                    metrics.loop_errors_total.inc(failed_count)
+            except Exception as e:
+                run_pending_failed = True
+                metrics.loop_errors_total.inc()
+                logger.exception('Error in scheduled camera settings loop [%s]: %s', type(e).__name__, str(e))
+            metrics.REGISTRY.export_if_due()
+
+            idle_seconds = scheduler.idle_seconds
+            sleep_interval = max_sleep_interval \
+                if idle_seconds is None \
+                else min(max(idle_seconds, 0), max_sleep_interval)
+            if run_pending_failed:
+                # a failed job is not rescheduled (it is still due), it is retried after the check interval
+                sleep_interval = max(sleep_interval, schedule_pending_check_interval)
+            sleep_interval = min([sleep_interval] + [watcher.poll_interval for watcher in watchers or []])
+            metrics.loop_sleep_seconds.observe(sleep_interval)
+            await scheduler.clock.sleep_async(sleep_interval, wakeup_event)
+    finally:
+        safe_termination.unregister_wakeup_event(wakeup_event_setter)
+        metrics.REGISTRY.export()
+
+
+async def async_run_job_wrapper(
+        settings_dict,
+        logger,
+        settings_job_func,
+        datetime_variable_values_dict_factory,
+        run_once=False,
+        **kwargs
+):
+    ret = settings_job_func(**{
+        **kwargs,
+        **dict(
+            settings_dict=settings_dict,
+            logger=logger,
+        )
+    })
+    if inspect.isawaitable(ret):
+        await ret
+    datetime_variable_values_dict_factory.auto_prune_cache()
+    if run_once:
+        return schedule.CancelJob
+    return None
+
+
+async def twilight_scheduled_jobs_main_async(
+        schedule_file,
+        station_geographic_position,
+        settings_job_func,
+        current_datetime=None,
+        timezone=DEFAULTS['timezone'],
+        variable_marker=DEFAULTS['variable_marker'],
+        next_t0_expression=DEFAULTS['next_t0_expression'],
+        delta_t=DEFAULTS['delta_t'],
+        t0_step=DEFAULTS['t0_step'],
+        group_planning=DEFAULTS['group_planning'],
+        horizon=DEFAULTS['horizon'],
+        event_store_dir=DEFAULTS['event_store_dir'],
+        ephemeris=DEFAULTS['ephemeris'],
+        lazy_ephemeris=DEFAULTS['lazy_ephemeris'],
+        engine=DEFAULTS['engine'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        job_timeout=DEFAULTS['job_timeout'],
+        schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        coalesce_window=DEFAULTS['coalesce_window'],
+        metrics_sinks=None,
+        metrics_export_interval=DEFAULTS['metrics_export_interval'],
+        watch_schedule_file=DEFAULTS['watch_schedule_file'],
+        watch_poll_interval=DEFAULTS['watch_poll_interval'],
+        job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
+        logger=None,
+):
+    """
+    asyncio variant of twilight_scheduled_jobs_main, `settings_job_func` can be a coroutine function.
+    Jobs due at the same time are awaited concurrently, each limited by `job_timeout` seconds (if set).
+    It can be awaited or run as a task in an existing event loop.
+    """
+    current_datetime = dateutil.parser.parse(current_datetime) \
+        if isinstance(current_datetime, str) \
+        else current_datetime
+
+    if logger is None:
+        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+    current_datetime = datetime.datetime.now(pytz.timezone(timezone)) \
+        if current_datetime is None \
+        else current_datetime
+
+    timezone = pytz.timezone(timezone)
+    delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
+    t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+    horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon)) \
+        if horizon is not None \
+        else None
+
+    datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+        station_geographic_position=station_geographic_position,
+        timezone=timezone,
+        delta_t=delta_t,
+        horizon=horizon,
+        event_store=event_store_dir,
+        eph=ephemeris,
+        lazy_ephemeris=lazy_ephemeris,
+        engine=engine,
+        missing_event_policy=missing_event_policy,
+    )
+
+    scheduler = AsyncCustomizableScheduler(
+        job_class=AsyncFloatingNextRunJob, job_timeout=job_timeout, coalesce_window=coalesce_window,
+    )
+
+    initialize_schedule_file_jobs_partial_func = partial(
+        initialize_schedule_file_jobs,
+        scheduler=scheduler,
+        schedule_file=schedule_file,
+        datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+        settings_job_func=settings_job_func,
+        timezone=timezone,
+        variable_marker=variable_marker,
+        next_t0_expression=next_t0_expression,
+        t0_step=t0_step,
+        group_planning=group_planning,
+        schedule_cache_dir=schedule_cache_dir,
+        job_logger_name_format=job_logger_name_format,
+        logger=logger,
+        run_job_wrapper_func=async_run_job_wrapper,
+    )
+    scheduled_camera_settings_jobs_dict = initialize_schedule_file_jobs_partial_func(current_datetime=current_datetime)
+
+    watchers = [
+        create_schedule_file_watcher(
+            initialize_schedule_file_jobs_partial_func, schedule_file, scheduled_camera_settings_jobs_dict, timezone,
+            poll_interval=watch_poll_interval, logger=logger, clock=scheduler.clock,
+        )
+    ] \
+        if watch_schedule_file \
+        else []
+
+    configure_metrics(sinks=metrics_sinks, export_interval=metrics_export_interval)
+
+    await run_pending_loop_async(
+        scheduler=scheduler,
+        logger=logger,
+        schedule_pending_check_interval=schedule_pending_check_interval,
+        max_sleep_interval=max_sleep_interval,
+        watchers=watchers,
+    )
+
+    # returns when safe termination flag is set
+    return scheduled_camera_settings_jobs_dict
@@ -0,0 +1,84 @@
+import asyncio
+import datetime
+import threading
+
+import pytz
+import tzlocal
+
+
+class SystemClock:
+    """
+    Wall clock of the scheduler: naive local datetimes (as in the schedule library) and real sleeps.
+    """
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def now_aware(self):
+        return datetime.datetime.now(pytz.UTC)
+
+    def local_timezone(self):
+        return tzlocal.get_localzone()
+
+    def sleep(self, seconds, wakeup_event=None):
+        """
+        Sleep for `seconds` or until the wakeup event is set.
+        """
+        if wakeup_event is None:
+            wakeup_event = threading.Event()
+        wakeup_event.wait(seconds)
+
+    async def sleep_async(self, seconds, wakeup_event=None):
+        if wakeup_event is None:
+            await asyncio.sleep(seconds)
+            return
+        try:
+            await asyncio.wait_for(wakeup_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+
+class VirtualClock(SystemClock):
+    """
+    Clock advanced only by the sleeps and advance_to(), used to fast-forward the scheduler (see the simulation module).
+    The local timezone is UTC by default, so that the simulation does not depend on the machine.
+    """
+
+    def __init__(self, start_datetime, timezone=pytz.UTC):
+        if start_datetime.tzinfo is None:
+            raise ValueError('The start datetime of the virtual clock must be timezone-aware.')
+        self.timezone = timezone
+        self.current_datetime = start_datetime.astimezone(pytz.UTC)
+
+    def now(self):
+        return self.current_datetime.astimezone(self.timezone).replace(tzinfo=None)
+
+    def now_aware(self):
+        return self.current_datetime
+
+    def local_timezone(self):
+        return self.timezone
+
+    def advance(self, seconds):
+        self.current_datetime += datetime.timedelta(seconds=seconds)
+
+    def advance_to(self, local_datetime):
+        """
+        Move the clock to a naive local datetime (e.g. the next_run of a job), never backwards.
+        """
+        if local_datetime.tzinfo is None:
+            local_datetime = self.timezone.localize(local_datetime) \
+                if hasattr(self.timezone, 'localize') \
+                else local_datetime.replace(tzinfo=self.timezone)
+        self.current_datetime = max(self.current_datetime, local_datetime.astimezone(pytz.UTC))
+
+    def sleep(self, seconds, wakeup_event=None):
+        self.advance(seconds)
+
+    async def sleep_async(self, seconds, wakeup_event=None):
+        self.advance(seconds)
+        # let the other tasks run
+        await asyncio.sleep(0)
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -1,35 +1,130 @@
+import collections
 import datetime
+import logging
+import threading
+import time
 
+import numpy as np
 import pytz
-import skyfield.api
+import skyfield
 from skyfield import almanac
 
+from . import metrics
+from .engines import SUN_TRANSIT_FAMILY, TWILIGHT_FAMILY, SkyfieldEventEngine, create_engine
+from .ephemeris import DEFAULT_EPHEMERIS, get_ephemeris_name, get_ephemeris_pathname
+from .event_store import EventStore
+from .variable_values_cache import IntervalCache
+from .variables import (
+    ALTITUDE_ASCENDING, ALTITUDE_DESCENDING, MOON_ILLUMINATION, SUN, altitude_family, altitude_variable_names,
+    parse_altitude_family, parse_altitude_variable,
+)
+
+from .event_table import (
+    EventTable, ONE_MICROSECOND, datetime_to_epoch_us, epoch_us_to_datetime, epoch_us_to_datetimes,
+)
+
+
+class VariableValuesDict(dict):
+    """
+    Variable values with the names of the variables skipped by the missing event policy.
+    """
+
+    def __init__(self, *args, skipped_variable_names=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.skipped_variable_names = set(skipped_variable_names)
+
+    def copy(self):
+        return VariableValuesDict(self, skipped_variable_names=self.skipped_variable_names)
+
 
 class DatetimeVariableValuesDictFactory:
 
     sun_meridian_transit_key = 'sun_meridian_transit'
     sun_antimeridian_transit_key = 'sun_antimeridian_transit'
+    moon_illumination_key = MOON_ILLUMINATION
     next_day_prefix = 'next_day_'
     end_suffix = '_end'
     start_suffix = '_start'
 
+    sun_transit_family = SUN_TRANSIT_FAMILY
+    twilight_family = TWILIGHT_FAMILY
+    meridian_transit_index = almanac.MERIDIAN_TRANSITS.index('Meridian transit')
+    antimeridian_transit_index = almanac.MERIDIAN_TRANSITS.index('Antimeridian transit')
+
+    # Sun altitudes of the boundaries between the almanac.TWILIGHTS states (as in almanac.dark_twilight_day)
+    twilight_boundary_altitudes = (-18.0, -12.0, -6.0, -0.8333)
+    # the altitude at the Sun transits approximates the daily altitude extrema only up to the declination change
+    altitude_bound_margin = 0.1
+    missing_event_policies = ('search', 'skip', 'fallback', 'clamp')
+
     def __init__(
             self, station_geographic_position, timezone=pytz.UTC,
             delta_t=datetime.timedelta(hours=25),
             ts=None,
             max_cache_size=5,
+            cache_ttl=None,
+            horizon=None,
+            background_extension=True,
+            event_store=None,
+            logger=None,
+            eph=None,
+            lazy_ephemeris=False,
+            engine=None,
+            missing_event_policy='skip',
+            missing_event_fallbacks=None,
     ):
-        eph = skyfield.api.load('de421.bsp')
-        self.sun_meridian_transit_func = almanac.meridian_transits(eph, eph['Sun'], station_geographic_position)
-        self.dark_twilight_day_func = almanac.dark_twilight_day(eph, station_geographic_position)
-        if ts is None:
-            self.ts = skyfield.api.load.timescale()
-        else:
-            self.ts = ts
+        self.logger = logger if logger else logging.getLogger('DatetimeVariableValuesDictFactory')
+        self.station_geographic_position = station_geographic_position
+        self._eph_source = eph if eph is not None else DEFAULT_EPHEMERIS
+        self.ephemeris_name = get_ephemeris_name(self._eph_source)
+        # the source of the events: the Skyfield reference engine (default), 'analytical' or an EventEngine
+        # (e.g. computed for a group of stations at once)
+        self.engine = create_engine(
+            engine, station_geographic_position, eph=self._eph_source, ts=ts, lazy_ephemeris=lazy_ephemeris
+        )
         self.timezone = timezone
-        self.variable_values_dict_cache = dict()
+        # variable values dicts keyed by the interval between the events surrounding t0,
+        # any t0 inside the interval results in the same variable values
+        self.variable_values_dict_cache = IntervalCache(max_size=max_cache_size, ttl=cache_ttl)
         self.delta_t = delta_t
         self.max_cache_size = max_cache_size
+        # horizon mode: events are computed for the whole horizon in a single find_discrete pass per family
+        self.horizon = horizon
+        self.background_extension = background_extension
+        # the altitude families (e.g. sun_alt_-9deg) are added when their variables are first required
+        self.event_tables = {
+            self.sun_transit_family: EventTable(),
+            self.twilight_family: EventTable(),
+        }
+        self._events_lock = threading.RLock()
+        self._extension_thread = None
+        if isinstance(event_store, str):
+            event_store = EventStore(event_store)
+        self.event_store = event_store
+        if missing_event_policy not in self.missing_event_policies:
+            raise ValueError(
+                f'Unknown missing event policy {missing_event_policy}, expected one of {self.missing_event_policies}.'
+            )
+        # handling of the twilight variables whose events cannot occur in the searched window
+        self.missing_event_policy = missing_event_policy
+        self.missing_event_fallbacks = missing_event_fallbacks if missing_event_fallbacks is not None else {}
+        self._event_store_key, self._event_store_key_dict = EventStore.create_key(
+            station_geographic_position=station_geographic_position,
+            ephemeris_name=self.ephemeris_name,
+            skyfield_version=skyfield.__version__,
+            # the event store keys of the reference engine are those of the ephemeris only
+            engine_name=self.engine.name if self.engine.name != SkyfieldEventEngine.name else None,
+            ephemeris_pathname=get_ephemeris_pathname(self._eph_source),
+        )
+        self._stored_families = set()
+
+    @property
+    def ts(self):
+        return getattr(self.engine, 'ts', None)
+
+    @property
+    def eph(self):
+        return self.engine.eph
 
     @property
     def timezone(self):
@@ -50,11 +145,295 @@ class DatetimeVariableValuesDictFactory:
 
     def _has_required_variables(self, required_variable_names, variable_values_dict):
         if required_variable_names is not None:
+            skipped_variable_names = getattr(variable_values_dict, 'skipped_variable_names', ())
             for variable_name in required_variable_names:
-                if variable_name not in variable_values_dict:
+                if variable_name not in variable_values_dict and variable_name not in skipped_variable_names:
                     return False
         return True
 
+    def _compute_events_many(self, families, start_us, end_us):
+        return self.engine.compute_events_many(families, start_us, end_us)
+
+    def _load_stored_events(self, family):
+        self._stored_families.add(family)
+        try:
+            stored_table = self.event_store.load(self._event_store_key, family)
+        except (OSError, ValueError) as e:
+            self.logger.warning('Could not load stored %s events [%s]: %s', family, type(e).__name__, str(e))
+            return
+        if stored_table is not None and not stored_table.is_empty:
+            self.event_tables[family].merge(
+                stored_table.times, stored_table.codes, stored_table.start, stored_table.end
+            )
+
+    def _save_stored_events(self, family):
+        try:
+            self.event_store.save(
+                self._event_store_key, family, self.event_tables[family],
+                key_dict=self._event_store_key_dict,
+            )
+        except OSError as e:
+            self.logger.warning('Could not store %s events [%s]: %s', family, type(e).__name__, str(e))
+
+    def _ensure_events(self, start_us, end_us, families=None):
+        max_gap_us = max(self.delta_t, self.horizon or datetime.timedelta(0)) // ONE_MICROSECOND
+        with self._events_lock:
+            # the families missing the same range are computed together (e.g. the altitude thresholds in one pass)
+            missing_range_families = collections.defaultdict(list)
+            for family in list(self.event_tables.keys()) if families is None else families:
+                table = self.event_tables.setdefault(family, EventTable())
+                if table.covers(start_us, end_us):
+                    continue
+                if self.event_store is not None and family not in self._stored_families:
+                    self._load_stored_events(family)
+                    if table.covers(start_us, end_us):
+                        continue
+                family_end_us = max(end_us, start_us + self.horizon // ONE_MICROSECOND) \
+                    if self.horizon is not None \
+                    else end_us
+                for missing_range in table.missing_ranges(start_us, family_end_us, max_gap=max_gap_us):
+                    missing_range_families[missing_range].append(family)
+        if not missing_range_families:
+            return
+
+        # the events are computed without the lock, so the covered events stay readable meanwhile
+        # (e.g. by create_dict while the tables are extended in the background),
+        # a range computed concurrently by two threads is merged twice with the same events
+        computed_events = []
+        for (missing_start_us, missing_end_us), range_families in missing_range_families.items():
+            with metrics.event_compute_seconds.time():
+                events = self._compute_events_many(range_families, missing_start_us, missing_end_us)
+            computed_events.append((missing_start_us, missing_end_us, events))
+
+        with self._events_lock:
+            computed_families = set()
+            for missing_start_us, missing_end_us, events in computed_events:
+                for family, (times, codes) in events.items():
+                    self.event_tables[family].merge(times, codes, missing_start_us, missing_end_us)
+                    computed_families.add(family)
+            if self.event_store is not None:
+                for family in computed_families:
+                    self._save_stored_events(family)
+
+    def ensure_events(self, start_datetime, end_datetime, variable_names=None):
+        """
+        Compute (or load from the event store) the events of the families of the variables
+        (all the families if None) between the datetimes, e.g. to publish them to other processes.
+        """
+        families = set(self._variable_family(variable_name) for variable_name in variable_names) \
+            if variable_names is not None \
+            else None
+        self._ensure_events(datetime_to_epoch_us(start_datetime), datetime_to_epoch_us(end_datetime), families=families)
+
+    def replace_event_tables(self, event_tables):
+        """
+        Replace the event tables of the families (e.g. by the tables published by another process).
+        The cached variable values stay valid as long as the new tables contain the same events.
+        """
+        with self._events_lock:
+            self.event_tables.update(event_tables)
+
+    def _maybe_extend_in_background(self, t0_us, families):
+        horizon_us = self.horizon // ONE_MICROSECOND
+        with self._events_lock:
+            covered_end_us = min((
+                self.event_tables[family].end for family in families
+                if not self.event_tables[family].is_empty
+            ), default=None)
+        if covered_end_us is None or covered_end_us - t0_us >= horizon_us // 2:
+            return
+        if self._extension_thread is not None and self._extension_thread.is_alive():
+            return
+        self._extension_thread = threading.Thread(
+            target=self._ensure_events,
+            args=(covered_end_us, t0_us + horizon_us, frozenset(families)),
+            name='DatetimeVariableValuesDictFactory.extension',
+            daemon=True,
+        )
+        self._extension_thread.start()
+
+    def _variable_family(self, variable_name):
+        if variable_name == self.moon_illumination_key:
+            # evaluated at the Sun antimeridian transit
+            return self.sun_transit_family
+        altitude_variable = parse_altitude_variable(variable_name)
+        if altitude_variable is not None:
+            body, altitude_degrees, _ = altitude_variable
+            return altitude_family(body, altitude_degrees)
+        if variable_name.startswith(self.next_day_prefix):
+            variable_name = variable_name[len(self.next_day_prefix):]
+        if variable_name in (self.sun_meridian_transit_key, self.sun_antimeridian_transit_key):
+            return self.sun_transit_family
+        return self.twilight_family
+
+    def _required_families(self, required_variable_names, variable_values_dict):
+        if required_variable_names is None:
+            return set(self.event_tables.keys())
+        return set(
+            self._variable_family(variable_name) for variable_name in required_variable_names
+            if variable_name not in variable_values_dict
+            and variable_name not in variable_values_dict.skipped_variable_names
+        )
+
+    def _twilight_variable_boundary(self, variable_name):
+        """
+        Return the index of the twilight boundary crossed by the event of the variable
+        and whether the Sun is descending, None if it is not a twilight variable.
+        """
+        ascending = variable_name.startswith(self.next_day_prefix)
+        if ascending:
+            variable_name = variable_name[len(self.next_day_prefix):]
+        for suffix, state_offset in ((self.start_suffix, 0), (self.end_suffix, -1)):
+            if not variable_name.endswith(suffix):
+                continue
+            base_variable_name = variable_name[:-len(suffix)]
+            for state, twilight in almanac.TWILIGHTS.items():
+                if base_variable_name == twilight.lower().replace(' ', '_'):
+                    # e.g. night_start and astronomical_twilight_end cross the -18 degrees boundary descending,
+                    # next_day_night_end and next_day_astronomical_twilight_start cross it ascending
+                    boundary = state + state_offset if not ascending else state - 1 - state_offset
+                    if 0 <= boundary < len(self.twilight_boundary_altitudes):
+                        return boundary, not ascending
+            return None
+        return None
+
+    def _sun_altitude_variable_threshold(self, variable_name):
+        """
+        Return the Sun altitude crossed by the event of the variable, whether the Sun is descending
+        and the index of the twilight boundary (None for the sun_alt variables), None if it is not such a variable.
+        """
+        altitude_variable = parse_altitude_variable(variable_name)
+        if altitude_variable is not None:
+            body, altitude_degrees, descending = altitude_variable
+            return (altitude_degrees, descending, None) if body == SUN else None
+        boundary_and_direction = self._twilight_variable_boundary(variable_name)
+        if boundary_and_direction is None:
+            return None
+        boundary, descending = boundary_and_direction
+        return self.twilight_boundary_altitudes[boundary], descending, boundary
+
+    def _twilight_boundary_variable_name(self, boundary, descending):
+        if descending:
+            return almanac.TWILIGHTS[boundary].lower().replace(' ', '_') + self.start_suffix
+        return self.next_day_prefix + almanac.TWILIGHTS[boundary + 1].lower().replace(' ', '_') + self.start_suffix
+
+    def _sun_altitudes(self, times_us):
+        return self.engine.sun_altitudes(times_us)
+
+    def _apply_missing_event_policy(self, variable_names, start_us, end_us, variable_values_dict):
+        """
+        Check with the Sun altitudes at the transits in the (start, end] range whether the events
+        of the missing twilight (and sun_alt) variables can occur at all, and apply the missing event policy
+        if they cannot.
+        """
+        self._ensure_events(start_us, end_us, families={self.sun_transit_family})
+        with self._events_lock:
+            transit_times, transit_events = \
+                self.event_tables[self.sun_transit_family].events_between(start_us, end_us)
+        if len(transit_times) == 0:
+            return
+        altitudes = self._sun_altitudes(transit_times)
+        is_antimeridian = transit_events == self.antimeridian_transit_index
+        if not is_antimeridian.any() or is_antimeridian.all():
+            return
+        min_altitude = altitudes[is_antimeridian].min()
+        max_altitude = altitudes[~is_antimeridian].max()
+
+        for variable_name in variable_names:
+            threshold = self._sun_altitude_variable_threshold(variable_name)
+            if threshold is None:
+                continue
+            boundary_altitude, descending, boundary = threshold
+            too_bright = min_altitude > boundary_altitude + self.altitude_bound_margin
+            too_dark = max_altitude < boundary_altitude - self.altitude_bound_margin
+            if not too_bright and not too_dark:
+                # the event can occur, it is searched in the next window
+                continue
+
+            if self.missing_event_policy == 'clamp':
+                # the nearest extremum of the Sun depression (or altitude)
+                extremum_times = transit_times[is_antimeridian] if too_bright else transit_times[~is_antimeridian]
+                variable_values_dict[variable_name] = epoch_us_to_datetime(extremum_times[0], self.timezone)
+                continue
+
+            if self.missing_event_policy == 'fallback':
+                fallback_variable_name = self.missing_event_fallbacks.get(variable_name)
+                if fallback_variable_name is None and boundary is not None:
+                    # the nearest boundary in the same direction, which the Sun reaches
+                    step = 1 if too_bright else -1
+                    fallback_boundary = boundary + step
+                    while 0 <= fallback_boundary < len(self.twilight_boundary_altitudes):
+                        candidate_variable_name = self._twilight_boundary_variable_name(fallback_boundary, descending)
+                        if candidate_variable_name in variable_values_dict:
+                            fallback_variable_name = candidate_variable_name
+                            break
+                        fallback_boundary += step
+                if fallback_variable_name in variable_values_dict:
+                    self.logger.debug('Event of %s does not occur, using %s', variable_name, fallback_variable_name)
+                    variable_values_dict[variable_name] = variable_values_dict[fallback_variable_name]
+                    continue
+
+            self.logger.debug('Event of %s does not occur in the searched window, skipping it', variable_name)
+            variable_values_dict.skipped_variable_names.add(variable_name)
+
+    def _add_sun_transit_variables(self, variable_values_dict, meridian_times, meridian_events):
+        first_times = {}
+        for sun_transit_time, sun_transit_event in zip(meridian_times, meridian_events):
+            if sun_transit_event == self.antimeridian_transit_index:
+                first_times.setdefault(self.sun_antimeridian_transit_key, sun_transit_time)
+            elif sun_transit_event == self.meridian_transit_index:
+                first_times.setdefault(self.sun_meridian_transit_key, sun_transit_time)
+            if len(first_times) == 2:
+                break
+
+        if self.sun_antimeridian_transit_key not in first_times:
+            raise ValueError('No meridian transit of the Sun found')
+
+        return {
+            variable_name: first_time for variable_name, first_time in first_times.items()
+            if variable_name not in variable_values_dict
+        }
+
+    def _add_altitude_variables(self, variable_values_dict, family, required_variable_names, times, codes):
+        # the canonical names of the family and the required spellings (e.g. sun_alt_-9.0deg_start)
+        descending_by_variable_name = altitude_variable_names(family)
+        for variable_name in required_variable_names or ():
+            if self._variable_family(variable_name) == family:
+                descending_by_variable_name[variable_name] = parse_altitude_variable(variable_name)[2]
+
+        first_times = {}
+        for variable_name, descending in descending_by_variable_name.items():
+            if variable_name in variable_values_dict:
+                continue
+            event_i = np.flatnonzero(codes == (ALTITUDE_DESCENDING if descending else ALTITUDE_ASCENDING))
+            if len(event_i) > 0:
+                first_times[variable_name] = times[event_i[0]]
+        return first_times
+
+    def _add_twilight_variables(self, variable_values_dict, twilight_times, twilight_events):
+        first_times = {}
+        for twilight_time, twilight_event_code in zip(twilight_times, twilight_events):
+            previous_twilight_event, twilight_event = divmod(int(twilight_event_code), len(almanac.TWILIGHTS))
+            previous_base_variable_name = almanac.TWILIGHTS[previous_twilight_event]  # day
+            previous_variable_suffix = '_end'  # day_end
+            this_base_variable_name = almanac.TWILIGHTS[twilight_event]  # civil twilight
+            this_variable_suffix = '_start'  # civil_twilight_start
+
+            variable_prefix = self.next_day_prefix if previous_twilight_event < twilight_event else ''
+
+            previous_variable_name = (
+                    variable_prefix + previous_base_variable_name.lower().replace(' ', '_') +
+                    previous_variable_suffix)
+            this_variable_name = (
+                    variable_prefix + this_base_variable_name.lower().replace(' ', '_') +
+                    this_variable_suffix)
+
+            for variable_name in (previous_variable_name, this_variable_name):
+                if variable_name not in variable_values_dict and variable_name not in first_times:
+                    first_times[variable_name] = twilight_time
+
+        return first_times
+
     def create_dict(
             self, t0_datetime, use_cache=True,
             required_variable_names=None,
@@ -63,101 +442,149 @@ class DatetimeVariableValuesDictFactory:
         # next_day_sun_meridian_transit_key = self.next_day_sun_meridian_transit_key
         # next_day_sun_antimeridian_transit_key = self.next_day_sun_antimeridian_transit_key
 
-        variable_values_dict = dict()
-
-        if use_cache and t0_datetime in self.variable_values_dict_cache:
-            if self._has_required_variables(required_variable_names, self.variable_values_dict_cache[t0_datetime]):
-                return self.variable_values_dict_cache[t0_datetime]
-            else:
-                variable_values_dict = self.variable_values_dict_cache[t0_datetime]
-
-        # delta_t=datetime.timedelta(days=1)
-        # delta_t=datetime.timedelta(hours=12)
-        # t0_datetime = self.timezone.localize(
-        #     datetime.datetime.combine(t0_datetime, datetime.datetime.min.time())
-        # )
-
-        # searched_base_variable_names = set()
-        #
-        # for variable_name in variable_names:
-        #     base_variable_name, variable_type = variable_name.rsplit('_')[-1]
-        #     searched_base_variable_names.add(base_variable_name)
-        #     if variable_type == 'start' and delta_t.days == 0:
-        #         delta_t = datetime.timedelta(days=1)
-
-        t_t0_datetime = t0_datetime
+        variable_values_dict = VariableValuesDict()
+        t0_us = datetime_to_epoch_us(t0_datetime)
 
+        if use_cache:
+            cached_variable_values_dict = self.variable_values_dict_cache.get(t0_us)
+            if cached_variable_values_dict is not None:
+                if self._has_required_variables(required_variable_names, cached_variable_values_dict):
+                    metrics.variable_cache_hits_total.inc()
+                    return cached_variable_values_dict
+                else:
+                    # the cached dict can be shared by a wider event interval, it is extended as a copy
+                    variable_values_dict = cached_variable_values_dict.copy()
+            metrics.variable_cache_misses_total.inc()
+
+        tic = time.perf_counter()
+
+        # only the event families of the missing variables are computed
+        computed_families = set(
+            self._variable_family(variable_name)
+            for variable_name in set(variable_values_dict.keys()) | variable_values_dict.skipped_variable_names
+        )
+        families = self._required_families(required_variable_names, variable_values_dict)
+
+        t_t0_us = t0_us
+        delta_t_us = self.delta_t // ONE_MICROSECOND
+
+        missing_sun_altitude_variable_names = []
         for delta_t_iteration in range(delta_t_iterations):
-            t1_datetime = t_t0_datetime + self.delta_t
-            t1 = self.ts.from_datetime(t1_datetime)
-            t0 = self.ts.from_datetime(t_t0_datetime)
-
-            meridian_times, meridian_events = almanac.find_discrete(t0, t1, self.sun_meridian_transit_func)
-
-            meridian_transit_index = almanac.MERIDIAN_TRANSITS.index('Meridian transit')
-            antimeridian_transit_index = almanac.MERIDIAN_TRANSITS.index('Antimeridian transit')
-
-            sun_antimeridian_transit_time = None
-            for sun_transit_time, sun_transit_event in zip(meridian_times, meridian_events):
-                if sun_transit_event == antimeridian_transit_index:
-                    if sun_antimeridian_transit_time is None:
-                        sun_antimeridian_transit_time = sun_transit_time
-                    if self.sun_antimeridian_transit_key not in variable_values_dict:
-                        variable_values_dict[self.sun_antimeridian_transit_key] = sun_transit_time.astimezone(self.timezone)
-                    # elif next_day_sun_antimeridian_transit_key not in variable_values_dict:
-                    #     variable_values_dict[next_day_sun_antimeridian_transit_key] = sun_transit_time.astimezone(self.timezone)
-                elif sun_transit_event == meridian_transit_index:
-                    if self.sun_meridian_transit_key not in variable_values_dict:
-                        variable_values_dict[self.sun_meridian_transit_key] = sun_transit_time.astimezone(self.timezone)
-                    # elif next_day_sun_meridian_transit_key not in variable_values_dict:
-                    #     variable_values_dict[next_day_sun_meridian_transit_key] = sun_transit_time.astimezone(self.timezone)
-
-            if sun_antimeridian_transit_time is None:
-                raise ValueError('No meridian transit of the Sun found')
-
-            twilight_times, twilight_events = almanac.find_discrete(t0, t1, self.dark_twilight_day_func)
-            previous_twilight_event = self.dark_twilight_day_func(t0).item()
-            for twilight_time, twilight_event in zip(twilight_times, twilight_events):
-                previous_base_variable_name = almanac.TWILIGHTS[previous_twilight_event]  # day
-                previous_variable_suffix = '_end'  # day_end
-                this_base_variable_name = almanac.TWILIGHTS[twilight_event]  # civil twilight
-                this_variable_suffix = '_start'  # civil_twilight_start
-
-                variable_prefix = self.next_day_prefix if previous_twilight_event < twilight_event else ''
-
-                previous_variable_name = (
-                        variable_prefix + previous_base_variable_name.lower().replace(' ', '_') +
-                        previous_variable_suffix)
-                this_variable_name = (
-                        variable_prefix + this_base_variable_name.lower().replace(' ', '_') +
-                        this_variable_suffix)
-
-                twilight_time_as_datetime = twilight_time.astimezone(self.timezone)
-
-                if previous_variable_name not in variable_values_dict:
-                    variable_values_dict[previous_variable_name] = twilight_time_as_datetime
-                if this_variable_name not in variable_values_dict:
-                    variable_values_dict[this_variable_name] = twilight_time_as_datetime
-
-                previous_twilight_event = twilight_event
+            t1_us = t_t0_us + delta_t_us
+
+            self._ensure_events(t_t0_us, t1_us, families=families)
+            computed_families.update(families)
+
+            new_variable_times = {}
+            with self._events_lock:
+                if self.sun_transit_family in families:
+                    meridian_times, meridian_events = \
+                        self.event_tables[self.sun_transit_family].events_between(t_t0_us, t1_us)
+                    new_variable_times.update(self._add_sun_transit_variables(
+                        variable_values_dict, meridian_times, meridian_events
+                    ))
+                if self.twilight_family in families:
+                    twilight_times, twilight_events = \
+                        self.event_tables[self.twilight_family].events_between(t_t0_us, t1_us)
+                    new_variable_times.update(self._add_twilight_variables(
+                        variable_values_dict, twilight_times, twilight_events
+                    ))
+                for family in families:
+                    if parse_altitude_family(family) is None:
+                        continue
+                    altitude_times, altitude_events = self.event_tables[family].events_between(t_t0_us, t1_us)
+                    new_variable_times.update(self._add_altitude_variables(
+                        variable_values_dict, family, required_variable_names, altitude_times, altitude_events
+                    ))
+
+            # the event times are converted to the timezone in a single call
+            variable_values_dict.update(zip(
+                new_variable_times.keys(),
+                epoch_us_to_datetimes(list(new_variable_times.values()), self.timezone)
+            ))
+            if required_variable_names is not None \
+                    and self.moon_illumination_key in required_variable_names \
+                    and self.moon_illumination_key not in variable_values_dict \
+                    and self.sun_antimeridian_transit_key in variable_values_dict:
+                # a single value per cycle (and per cached event interval)
+                variable_values_dict[self.moon_illumination_key] = float(self.engine.moon_illuminations([
+                    datetime_to_epoch_us(variable_values_dict[self.sun_antimeridian_transit_key])
+                ])[0])
 
             if self._has_required_variables(required_variable_names, variable_values_dict):
                 break
 
-            t_t0_datetime = t1_datetime
-
+            missing_sun_altitude_variable_names = [
+                variable_name for variable_name in required_variable_names
+                if variable_name not in variable_values_dict
+                and self._sun_altitude_variable_threshold(variable_name) is not None
+            ] \
+                if self.missing_event_policy != 'search' \
+                else []
+            if missing_sun_altitude_variable_names:
+                # the policy is only applied to the events which cannot occur in the rest of the searched windows,
+                # the events found by a further search are kept
+                self._apply_missing_event_policy(
+                    missing_sun_altitude_variable_names, t_t0_us, t0_us + delta_t_iterations * delta_t_us,
+                    variable_values_dict,
+                )
+                if self._has_required_variables(required_variable_names, variable_values_dict):
+                    break
+
+            families = self._required_families(required_variable_names, variable_values_dict)
+            t_t0_us = t1_us
+        else:
+            if missing_sun_altitude_variable_names:
+                # the events which the bound did not rule out were not found in any of the searched windows either,
+                # the policy skips them instead of failing the job
+                for variable_name in missing_sun_altitude_variable_names:
+                    if variable_name not in variable_values_dict:
+                        self.logger.debug('Event of %s not found in the searched windows, skipping it', variable_name)
+                        variable_values_dict.skipped_variable_names.add(variable_name)
+
+        if self.horizon is not None and self.background_extension:
+            self._maybe_extend_in_background(t0_us, computed_families)
+
+        compute_time = time.perf_counter() - tic
+        metrics.create_dict_compute_seconds.observe(compute_time)
         if use_cache:
-            self.variable_values_dict_cache[t0_datetime] = variable_values_dict
+            self.variable_values_dict_cache.record_compute_time(compute_time)
+            event_interval = self._event_interval(t0_us, computed_families)
+            if event_interval is not None:
+                self.variable_values_dict_cache.put(*event_interval, variable_values_dict)
 
         return variable_values_dict
 
+    def _event_interval(self, t0_us, families):
+        """
+        Return the (lo, hi] interval of the t0 values with the same events of the given families as t0
+        (the events after t0, see EventTable.events_between), None if t0 is not covered:
+        lo is just before the last event at or before t0, hi just before the first event after t0.
+        """
+        lo = None
+        hi = None
+        with self._events_lock:
+            for family in families:
+                table = self.event_tables[family]
+                if not table.covers(t0_us, t0_us + 1):
+                    return None
+                i = table.index(t0_us)
+                table_lo = int(table.times[i - 1]) - 1 if i > 0 else table.start - 1
+                table_hi = int(table.times[i]) - 1 if i < len(table) else table.end - 1
+                lo = table_lo if lo is None else max(lo, table_lo)
+                hi = table_hi if hi is None else min(hi, table_hi)
+        if lo is None:
+            return None
+        return lo, hi
+
+    def cache_stats(self):
+        return self.variable_values_dict_cache.stats()
+
     def prune_cache(self, valid_datetimes):
-        for date in list(self.variable_values_dict_cache.keys()):
-            if date not in valid_datetimes:
-                del self.variable_values_dict_cache[date]
+        self.variable_values_dict_cache.retain([datetime_to_epoch_us(value) for value in valid_datetimes])
 
     def auto_prune_cache(self):
-        if len(self.variable_values_dict_cache) > self.max_cache_size:
-            self.prune_cache(sorted(self.variable_values_dict_cache.keys())[-self.max_cache_size:])
+        # the size and the age of the entries are bounded on every insertion, only the expired entries are removed
+        self.variable_values_dict_cache.evict()
 
 
@@ -1,9 +1,34 @@
 DEFAULTS = dict(
         schedule_pending_check_interval=10,
+        deadline_driven=True,
+        max_sleep_interval=300,
+        coalesce_window=0,
+        job_timeout=None,
         next_t0_expression='@sun_meridian_transit',
         variable_marker='@',
         scheduled_job_logger_name_format='scheduled_camera_settings_changer.job_{datetime_expression}_{settings_hash}',
+        multi_station_scheduled_job_logger_name_format=(
+            'scheduled_camera_settings_changer.{station_name}.job_{datetime_expression}_{settings_hash}'
+        ),
         delta_t='25h',
         t0_step='23h',
+        group_planning=True,
         timezone='UTC',
+        horizon=None,
+        event_store_dir=None,
+        ephemeris='de421.bsp',
+        lazy_ephemeris=False,
+        engine='skyfield',
+        missing_event_policy='skip',
+        metrics_export_interval=60,
+        watch_schedule_file=False,
+        watch_poll_interval=5,
+        schedule_cache_dir=None,
+        journal_file=None,
+        journal_fsync_interval=1,
+        catch_up_policy='latest',
+        shard_worker_count=None,
+        shard_horizon='30d',
+        shard_supervise_interval=5,
+        shard_stop_timeout=30,
 )
\ No newline at end of file
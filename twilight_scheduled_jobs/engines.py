@@ -0,0 +1,439 @@
+import collections
+import datetime
+
+import numpy as np
+import pytz
+import skyfield.api
+from skyfield import almanac
+
+from .ephemeris import DEFAULT_EPHEMERIS, load_ephemeris
+from .event_table import (
+    ONE_MICROSECOND, epoch_us_to_datetime, epoch_us_to_skyfield_times, skyfield_times_to_epoch_us,
+)
+from .variables import ALTITUDE_ASCENDING, ALTITUDE_DESCENDING, MOON, SUN, parse_altitude_family
+
+SUN_TRANSIT_FAMILY = 'sun_transit'
+TWILIGHT_FAMILY = 'twilight'
+
+# thresholds of almanac.dark_twilight_day, the state is the number of thresholds the Sun altitude is above
+TWILIGHT_THRESHOLDS_DEGREES = np.array([-18.0, -12.0, -6.0, -0.8333])
+
+UNIX_EPOCH_JD = 2440587.5
+SECONDS_PER_DAY = 86400.0
+
+
+def find_altitude_crossings(
+        altitudes_func, thresholds_degrees, start_us, end_us, step, epsilon,
+        max_iterations=32,
+):
+    """
+    Find the crossings of any of the thresholds by an altitude in [start_us, end_us): the altitude is evaluated once
+    on the `step` grid for all the thresholds, then the brackets of all the crossings are refined together
+    by a vectorized false position search (Illinois), so another threshold only adds a few evaluations
+    per crossing instead of another search.
+
+    :param altitudes_func: altitudes in degrees at an array of epoch microseconds (floats)
+    :return: (int64 epoch microseconds, threshold indices, ascending flags) sorted by time
+    """
+    thresholds_degrees = np.asarray(thresholds_degrees, dtype=np.float64)
+    step_us = step // ONE_MICROSECOND
+    sample_count = max(int(np.ceil((end_us - start_us) / step_us)), 1) + 1
+    grid_us = np.linspace(start_us, end_us, sample_count)
+
+    grid_altitudes = altitudes_func(grid_us)
+    above = grid_altitudes[:, None] >= thresholds_degrees[None, :]
+    sample_i, threshold_i = np.nonzero(above[1:, :] != above[:-1, :])
+    ascending = above[sample_i + 1, threshold_i]
+    thresholds = thresholds_degrees[threshold_i]
+
+    lo_us, hi_us = grid_us[sample_i], grid_us[sample_i + 1]
+    lo_values, hi_values = grid_altitudes[sample_i] - thresholds, grid_altitudes[sample_i + 1] - thresholds
+    # the side replaced in the previous iteration, -1 lo, 1 hi
+    last_side = np.zeros(len(lo_us), dtype=np.int8)
+    epsilon_us = epsilon / ONE_MICROSECOND
+    active = np.ones(len(lo_us), dtype=bool)
+    for _ in range(max_iterations):
+        i = np.flatnonzero(active)
+        if len(i) == 0:
+            break
+        # the values of the sides have opposite signs (one of them >= 0), the denominator is not zero
+        t_us = hi_us[i] - hi_values[i] * (hi_us[i] - lo_us[i]) / (hi_values[i] - lo_values[i])
+        values = altitudes_func(t_us) - thresholds[i]
+        # the hi side of the bracket is in the state after the crossing
+        is_hi_side = (values >= 0) == ascending[i]
+        replaced_hi, replaced_lo = i[is_hi_side], i[~is_hi_side]
+        # Illinois: the value of the side kept twice in a row is halved
+        lo_values[replaced_hi[last_side[replaced_hi] == 1]] /= 2.0
+        hi_values[replaced_lo[last_side[replaced_lo] == -1]] /= 2.0
+        hi_us[replaced_hi], hi_values[replaced_hi], last_side[replaced_hi] = t_us[is_hi_side], values[is_hi_side], 1
+        lo_us[replaced_lo], lo_values[replaced_lo], last_side[replaced_lo] = t_us[~is_hi_side], values[~is_hi_side], -1
+        active[i] = (hi_us[i] - lo_us[i] > epsilon_us) & (values != 0)
+
+    times_us = np.round(hi_us).astype(np.int64)
+    order = np.argsort(times_us, kind='stable')
+    times_us, threshold_i, ascending = times_us[order], threshold_i[order], ascending[order]
+    selected = (times_us >= start_us) & (times_us < end_us)
+    return times_us[selected], threshold_i[selected], ascending[selected]
+
+
+def skyfield_altitudes(eph, ts, station_geographic_position, body, times_us):
+    """
+    Topocentric apparent altitudes (without refraction, as almanac.dark_twilight_day) of a body in degrees.
+    """
+    t = epoch_us_to_skyfield_times(ts, times_us)
+    topos_at = (eph['earth'] + station_geographic_position).at
+    return topos_at(t).observe(eph[body]).apparent().altaz()[0].degrees
+
+
+def skyfield_moon_illuminations(eph, ts, station_geographic_position, times_us):
+    t = epoch_us_to_skyfield_times(ts, times_us)
+    topos_at = (eph['earth'] + station_geographic_position).at
+    return topos_at(t).observe(eph[MOON]).apparent().fraction_illuminated(eph[SUN])
+
+
+class EventEngine:
+    """
+    Source of the events of a station used by DatetimeVariableValuesDictFactory.
+
+    compute_events returns the events of a family in [start_us, end_us) as (int64 epoch microseconds, codes):
+    the Sun transits are coded as the almanac.MERIDIAN_TRANSITS index, the twilight transitions
+    as previous_state * len(almanac.TWILIGHTS) + state of almanac.dark_twilight_day.
+    The altitude families (e.g. sun_alt_-9deg, see variables.py) are coded as ALTITUDE_ASCENDING
+    or ALTITUDE_DESCENDING, all of them are found by compute_events_many in one pass per body.
+    The name is part of the event store key.
+    """
+
+    name = None
+    families = (SUN_TRANSIT_FAMILY, TWILIGHT_FAMILY)
+    # sampling grid and precision of the altitude families
+    step = datetime.timedelta(minutes=30)
+    epsilon = datetime.timedelta(milliseconds=10)
+
+    def compute_events(self, family, start_us, end_us):
+        raise NotImplementedError
+
+    def compute_events_many(self, families, start_us, end_us):
+        """
+        Compute the events of several families in [start_us, end_us) as a dict keyed by the family,
+        the thresholds of the altitude families of a body share a single altitude evaluation.
+        """
+        events = {}
+        altitude_families = collections.defaultdict(list)
+        for family in families:
+            body_and_altitude = parse_altitude_family(family)
+            if body_and_altitude is None:
+                events[family] = self.compute_events(family, start_us, end_us)
+            else:
+                body, altitude_degrees = body_and_altitude
+                altitude_families[body].append((family, altitude_degrees))
+
+        for body, body_families in altitude_families.items():
+            times_us, threshold_i, ascending = find_altitude_crossings(
+                lambda t_us, b=body: self.altitudes(b, t_us),
+                [altitude_degrees for _, altitude_degrees in body_families],
+                start_us, end_us, self.step, self.epsilon,
+            )
+            codes = np.where(ascending, ALTITUDE_ASCENDING, ALTITUDE_DESCENDING)
+            for i, (family, _) in enumerate(body_families):
+                selected = threshold_i == i
+                events[family] = times_us[selected], codes[selected]
+        return events
+
+    def altitudes(self, body, times_us):
+        """
+        Topocentric altitudes of the Sun or the Moon in degrees (as used by the twilight states) at epoch microseconds.
+        """
+        raise NotImplementedError
+
+    def sun_altitudes(self, times_us):
+        return self.altitudes(SUN, times_us)
+
+    def moon_illuminations(self, times_us):
+        """
+        Illuminated fractions of the Moon disc at epoch microseconds.
+        """
+        raise NotImplementedError
+
+
+class SkyfieldEventEngine(EventEngine):
+    """
+    Reference engine: almanac.find_discrete root search with a JPL ephemeris.
+    """
+
+    name = 'skyfield'
+
+    def __init__(self, station_geographic_position, eph=None, ts=None, lazy_ephemeris=False):
+        self.station_geographic_position = station_geographic_position
+        self._eph_source = eph if eph is not None else DEFAULT_EPHEMERIS
+        self._eph = None
+        self._sun_meridian_transit_func = None
+        self._dark_twilight_day_func = None
+        self.ts = ts if ts is not None else skyfield.api.load.timescale()
+        if not lazy_ephemeris:
+            self._load_ephemeris()
+
+    def _load_ephemeris(self):
+        if self._eph is None:
+            eph = load_ephemeris(self._eph_source)
+            self._sun_meridian_transit_func = almanac.meridian_transits(
+                eph, eph['Sun'], self.station_geographic_position
+            )
+            self._dark_twilight_day_func = almanac.dark_twilight_day(eph, self.station_geographic_position)
+            self._eph = eph
+        return self._eph
+
+    @property
+    def eph(self):
+        return self._load_ephemeris()
+
+    @property
+    def sun_meridian_transit_func(self):
+        self._load_ephemeris()
+        return self._sun_meridian_transit_func
+
+    @property
+    def dark_twilight_day_func(self):
+        self._load_ephemeris()
+        return self._dark_twilight_day_func
+
+    def _compute_sun_transit_events(self, t0, t1):
+        times, events = almanac.find_discrete(t0, t1, self.sun_meridian_transit_func)
+        return skyfield_times_to_epoch_us(times), events
+
+    def _compute_twilight_events(self, t0, t1):
+        times, events = almanac.find_discrete(t0, t1, self.dark_twilight_day_func)
+        # each event is encoded together with the preceding state, so that any slice of the table is self-contained
+        previous_events = np.empty_like(events)
+        if len(events) > 0:
+            previous_events[0] = self.dark_twilight_day_func(t0).item()
+            previous_events[1:] = events[:-1]
+        return skyfield_times_to_epoch_us(times), previous_events * len(almanac.TWILIGHTS) + events
+
+    def compute_events(self, family, start_us, end_us):
+        t0 = self.ts.from_datetime(epoch_us_to_datetime(start_us, pytz.UTC))
+        t1 = self.ts.from_datetime(epoch_us_to_datetime(end_us, pytz.UTC))
+        if family == SUN_TRANSIT_FAMILY:
+            return self._compute_sun_transit_events(t0, t1)
+        elif family == TWILIGHT_FAMILY:
+            return self._compute_twilight_events(t0, t1)
+        raise ValueError(f'Unknown event family {family}.')
+
+    def altitudes(self, body, times_us):
+        return skyfield_altitudes(self.eph, self.ts, self.station_geographic_position, body, times_us)
+
+    def moon_illuminations(self, times_us):
+        return skyfield_moon_illuminations(self.eph, self.ts, self.station_geographic_position, times_us)
+
+
+class AnalyticalSolarEngine(EventEngine):
+    """
+    Fast engine without an ephemeris file: the NOAA solar position equations (a truncated VSOP87-class model,
+    about 0.01 degree) are evaluated on a `step` grid, the changes of the transit and twilight states are refined
+    by a vectorized bisection of all brackets together (as StationGroupEvents does).
+    The event times deviate from the reference engine by seconds (see benchmarks/engine_accuracy.py),
+    the moonrise and moonset of the low-precision lunar ephemeris by minutes.
+    """
+
+    name = 'analytical'
+
+    def __init__(
+            self, station_geographic_position,
+            step=datetime.timedelta(minutes=30),
+            epsilon=datetime.timedelta(milliseconds=10),
+    ):
+        self.station_geographic_position = station_geographic_position
+        self.latitude_radians = station_geographic_position.latitude.radians
+        self.longitude_degrees = station_geographic_position.longitude.degrees
+        self.step = step
+        self.epsilon = epsilon
+
+    @staticmethod
+    def solar_position(epoch_seconds):
+        """
+        :return: (declination in radians, Greenwich hour angle in degrees) of the Sun at Unix epoch seconds
+        """
+        julian_century = (epoch_seconds / SECONDS_PER_DAY + UNIX_EPOCH_JD - 2451545.0) / 36525.0
+        mean_longitude = np.radians((280.46646 + julian_century * (36000.76983 + julian_century * 0.0003032)) % 360)
+        mean_anomaly = np.radians(357.52911 + julian_century * (35999.05029 - 0.0001537 * julian_century))
+        eccentricity = 0.016708634 - julian_century * (0.000042037 + 0.0000001267 * julian_century)
+        equation_of_center = np.radians(
+            np.sin(mean_anomaly) * (1.914602 - julian_century * (0.004817 + 0.000014 * julian_century))
+            + np.sin(2 * mean_anomaly) * (0.019993 - 0.000101 * julian_century)
+            + np.sin(3 * mean_anomaly) * 0.000289
+        )
+        omega = np.radians(125.04 - 1934.136 * julian_century)
+        apparent_longitude = mean_longitude + equation_of_center - np.radians(0.00569 + 0.00478 * np.sin(omega))
+        mean_obliquity = 23 + (26 + (21.448 - julian_century * (
+                46.815 + julian_century * (0.00059 - julian_century * 0.001813)
+        )) / 60) / 60
+        obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+        declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+
+        y = np.tan(obliquity / 2) ** 2
+        equation_of_time_radians = (
+            y * np.sin(2 * mean_longitude)
+            - 2 * eccentricity * np.sin(mean_anomaly)
+            + 4 * eccentricity * y * np.sin(mean_anomaly) * np.cos(2 * mean_longitude)
+            - 0.5 * y * y * np.sin(4 * mean_longitude)
+            - 1.25 * eccentricity * eccentricity * np.sin(2 * mean_anomaly)
+        )
+        seconds_of_day = np.mod(epoch_seconds, SECONDS_PER_DAY)
+        greenwich_hour_angle_degrees = seconds_of_day / 240.0 + np.degrees(equation_of_time_radians) - 180.0
+        return declination, greenwich_hour_angle_degrees
+
+    def _hour_angle_degrees(self, greenwich_hour_angle_degrees):
+        return np.mod(greenwich_hour_angle_degrees + self.longitude_degrees, 360.0)
+
+    def _altitude_degrees(self, declination, greenwich_hour_angle_degrees):
+        hour_angle = np.radians(self._hour_angle_degrees(greenwich_hour_angle_degrees))
+        sin_altitude = (
+                np.sin(self.latitude_radians) * np.sin(declination) +
+                np.cos(self.latitude_radians) * np.cos(declination) * np.cos(hour_angle)
+        )
+        return np.degrees(np.arcsin(np.clip(sin_altitude, -1.0, 1.0)))
+
+    @staticmethod
+    def moon_position(epoch_seconds):
+        """
+        Low-precision lunar ephemeris of the Astronomical Almanac (about 0.3 degree).
+
+        :return: (declination in radians, Greenwich hour angle in degrees, horizontal parallax in radians)
+                 of the Moon at Unix epoch seconds
+        """
+        days = epoch_seconds / SECONDS_PER_DAY + UNIX_EPOCH_JD - 2451545.0
+        julian_century = days / 36525.0
+        d = np.radians
+        ecliptic_longitude = d(
+            218.32 + 481267.881 * julian_century
+            + 6.29 * np.sin(d(135.0 + 477198.87 * julian_century))
+            - 1.27 * np.sin(d(259.3 - 413335.36 * julian_century))
+            + 0.66 * np.sin(d(235.7 + 890534.22 * julian_century))
+            + 0.21 * np.sin(d(269.9 + 954397.74 * julian_century))
+            - 0.19 * np.sin(d(357.5 + 35999.05 * julian_century))
+            - 0.11 * np.sin(d(186.5 + 966404.03 * julian_century))
+        )
+        ecliptic_latitude = d(
+            5.13 * np.sin(d(93.3 + 483202.02 * julian_century))
+            + 0.28 * np.sin(d(228.2 + 960400.89 * julian_century))
+            - 0.28 * np.sin(d(318.3 + 6003.15 * julian_century))
+            - 0.17 * np.sin(d(217.6 - 407332.21 * julian_century))
+        )
+        horizontal_parallax = d(
+            0.9508
+            + 0.0518 * np.cos(d(135.0 + 477198.87 * julian_century))
+            + 0.0095 * np.cos(d(259.3 - 413335.36 * julian_century))
+            + 0.0078 * np.cos(d(235.7 + 890534.22 * julian_century))
+            + 0.0028 * np.cos(d(269.9 + 954397.74 * julian_century))
+        )
+        obliquity = d(23.439291 - 0.0130042 * julian_century)
+        declination = np.arcsin(
+            np.sin(ecliptic_latitude) * np.cos(obliquity)
+            + np.cos(ecliptic_latitude) * np.sin(obliquity) * np.sin(ecliptic_longitude)
+        )
+        right_ascension = np.arctan2(
+            np.sin(ecliptic_longitude) * np.cos(obliquity) - np.tan(ecliptic_latitude) * np.sin(obliquity),
+            np.cos(ecliptic_longitude)
+        )
+        greenwich_mean_sidereal_time_degrees = 280.46061837 + 360.98564736629 * days
+        greenwich_hour_angle_degrees = greenwich_mean_sidereal_time_degrees - np.degrees(right_ascension)
+        return declination, greenwich_hour_angle_degrees, horizontal_parallax
+
+    def altitudes(self, body, times_us):
+        epoch_seconds = np.asarray(times_us, dtype=np.float64) / 1e6
+        if body == SUN:
+            return self._altitude_degrees(*self.solar_position(epoch_seconds))
+        elif body == MOON:
+            declination, greenwich_hour_angle_degrees, horizontal_parallax = self.moon_position(epoch_seconds)
+            geocentric_altitude = np.radians(self._altitude_degrees(declination, greenwich_hour_angle_degrees))
+            return np.degrees(geocentric_altitude - horizontal_parallax * np.cos(geocentric_altitude))
+        raise ValueError(f'Unknown body {body}.')
+
+    def moon_illuminations(self, times_us):
+        epoch_seconds = np.asarray(times_us, dtype=np.float64) / 1e6
+        sun_declination, sun_greenwich_hour_angle_degrees = self.solar_position(epoch_seconds)
+        moon_declination, moon_greenwich_hour_angle_degrees, _ = self.moon_position(epoch_seconds)
+        cos_elongation = (
+                np.sin(sun_declination) * np.sin(moon_declination) +
+                np.cos(sun_declination) * np.cos(moon_declination) *
+                np.cos(np.radians(sun_greenwich_hour_angle_degrees - moon_greenwich_hour_angle_degrees))
+        )
+        # the phase angle is approximated by 180 degrees minus the elongation
+        return (1.0 - cos_elongation) / 2.0
+
+    def _west_of_meridian(self, greenwich_hour_angle_degrees):
+        return self._hour_angle_degrees(greenwich_hour_angle_degrees) < 180.0
+
+    def _bisect(self, lo, hi, hi_state, state_func):
+        epsilon_seconds = self.epsilon.total_seconds()
+        while len(lo) > 0 and np.max(hi - lo) > epsilon_seconds:
+            mid = (lo + hi) / 2.0
+            is_hi_state = state_func(mid) == hi_state
+            hi = np.where(is_hi_state, mid, hi)
+            lo = np.where(is_hi_state, lo, mid)
+        return hi
+
+    def _grid(self, start_us, end_us):
+        step_seconds = self.step.total_seconds()
+        start_seconds, end_seconds = start_us / 1e6, end_us / 1e6
+        sample_count = max(int(np.ceil((end_seconds - start_seconds) / step_seconds)), 1) + 1
+        return np.linspace(start_seconds, end_seconds, sample_count)
+
+    def _compute_sun_transit_events(self, grid):
+        west_of_meridian = self._west_of_meridian(self.solar_position(grid)[1])
+        sample_i = np.nonzero(west_of_meridian[1:] != west_of_meridian[:-1])[0]
+        hi_state = west_of_meridian[sample_i + 1]
+        times = self._bisect(
+            grid[sample_i], grid[sample_i + 1], hi_state,
+            lambda t: self._west_of_meridian(self.solar_position(t)[1]),
+        )
+        # west of the meridian after the meridian transit, east of it after the antimeridian transit
+        codes = np.where(
+            hi_state,
+            almanac.MERIDIAN_TRANSITS.index('Meridian transit'),
+            almanac.MERIDIAN_TRANSITS.index('Antimeridian transit'),
+        )
+        return times, codes
+
+    def _compute_twilight_events(self, grid):
+        altitudes = self._altitude_degrees(*self.solar_position(grid))
+        above = altitudes[:, None] >= TWILIGHT_THRESHOLDS_DEGREES[None, :]
+        sample_i, threshold_i = np.nonzero(above[1:, :] != above[:-1, :])
+        hi_state = above[sample_i + 1, threshold_i]
+        times = self._bisect(
+            grid[sample_i], grid[sample_i + 1], hi_state,
+            lambda t: self._altitude_degrees(*self.solar_position(t)) >= TWILIGHT_THRESHOLDS_DEGREES[threshold_i],
+        )
+        # crossing the threshold h separates the states h and h + 1
+        previous_states = np.where(hi_state, threshold_i, threshold_i + 1)
+        states = np.where(hi_state, threshold_i + 1, threshold_i)
+        return times, previous_states * len(almanac.TWILIGHTS) + states
+
+    def compute_events(self, family, start_us, end_us):
+        grid = self._grid(start_us, end_us)
+        if family == SUN_TRANSIT_FAMILY:
+            times, codes = self._compute_sun_transit_events(grid)
+        elif family == TWILIGHT_FAMILY:
+            times, codes = self._compute_twilight_events(grid)
+        else:
+            raise ValueError(f'Unknown event family {family}.')
+        times_us = np.round(times * 1e6).astype(np.int64)
+        order = np.argsort(times_us, kind='stable')
+        times_us, codes = times_us[order], codes[order]
+        selected = (times_us >= start_us) & (times_us < end_us)
+        return times_us[selected], codes[selected]
+
+
+def create_engine(engine, station_geographic_position, eph=None, ts=None, lazy_ephemeris=False):
+    """
+    Create an engine from its name ('skyfield' or 'analytical'), None is the reference engine
+    and engine instances are returned unchanged.
+    """
+    if engine is None or engine == SkyfieldEventEngine.name:
+        return SkyfieldEventEngine(station_geographic_position, eph=eph, ts=ts, lazy_ephemeris=lazy_ephemeris)
+    elif engine == AnalyticalSolarEngine.name:
+        return AnalyticalSolarEngine(station_geographic_position)
+    elif isinstance(engine, str):
+        raise ValueError(
+            f'Unknown engine {engine}, expected one of {(SkyfieldEventEngine.name, AnalyticalSolarEngine.name)}.'
+        )
+    return engine
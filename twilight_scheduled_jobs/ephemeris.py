@@ -0,0 +1,106 @@
+import argparse
+import datetime
+import os
+
+import skyfield.api
+
+DEFAULT_EPHEMERIS = 'de421.bsp'
+
+# Earth-Moon barycenter, Sun and Earth are needed for the Sun positions,
+# Jupiter and Saturn barycenters are the light deflectors used by Skyfield apparent()
+EXCERPT_TARGETS = (3, 10, 399, 5, 6)
+MOON_TARGET = 301
+
+
+def load_ephemeris(ephemeris=DEFAULT_EPHEMERIS):
+    if not isinstance(ephemeris, str):
+        return ephemeris
+    pathname = os.path.expanduser(ephemeris)
+    if os.path.exists(pathname):
+        # SPK segments are memory-mapped by jplephem when they are first used
+        return skyfield.api.load_file(pathname)
+    return skyfield.api.load(ephemeris)
+
+
+def get_ephemeris_name(ephemeris):
+    if isinstance(ephemeris, str):
+        return os.path.basename(ephemeris)
+    return getattr(ephemeris, 'filename', type(ephemeris).__name__)
+
+
+def get_ephemeris_pathname(ephemeris):
+    """
+    Pathname of the ephemeris file, None if it is not known (e.g. not downloaded yet).
+    """
+    if isinstance(ephemeris, str):
+        pathname = os.path.expanduser(ephemeris)
+        return pathname if os.path.exists(pathname) else None
+    return getattr(ephemeris, 'path', None)
+
+
+def _date_to_julian_date(date):
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    # proleptic Gregorian ordinal 1 (0001-01-01) is JD 1721425.5
+    return date.toordinal() + 1721424.5
+
+
+def create_ephemeris_excerpt(
+        source_pathname,
+        output_pathname,
+        start_date,
+        end_date,
+        targets=EXCERPT_TARGETS,
+):
+    from jplephem.daf import DAF
+    from jplephem.excerpter import write_excerpt
+    from jplephem.spk import SPK
+
+    targets = set(int(target) for target in targets)
+
+    with open(os.path.expanduser(source_pathname), 'rb') as f:
+        spk = SPK(DAF(f))
+        summaries = [
+            summary for summary, segment in zip(spk.daf.summaries(), spk.segments)
+            if segment.target in targets
+        ]
+        missing_targets = targets - set(segment.target for segment in spk.segments)
+        if missing_targets:
+            raise ValueError(f'Targets {sorted(missing_targets)} not found in {source_pathname}.')
+        with open(os.path.expanduser(output_pathname), 'w+b') as output_file:
+            write_excerpt(
+                spk, output_file,
+                _date_to_julian_date(start_date), _date_to_julian_date(end_date),
+                summaries
+            )
+
+    return output_pathname
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Create an ephemeris excerpt with only the bodies needed by twilight scheduled jobs.'
+    )
+    parser.add_argument('source', help='Source .bsp file (e.g. de421.bsp)')
+    parser.add_argument('output', help='Output .bsp file')
+    parser.add_argument('start_date', help='Start date (YYYY-MM-DD)')
+    parser.add_argument('end_date', help='End date (YYYY-MM-DD)')
+    parser.add_argument(
+        '--with-moon', action='store_true',
+        help='Include the Moon segment'
+    )
+    parsed_args = parser.parse_args(args)
+
+    targets = EXCERPT_TARGETS + ((MOON_TARGET,) if parsed_args.with_moon else ())
+    create_ephemeris_excerpt(
+        source_pathname=parsed_args.source,
+        output_pathname=parsed_args.output,
+        start_date=parsed_args.start_date,
+        end_date=parsed_args.end_date,
+        targets=targets,
+    )
+    print(skyfield.api.load_file(parsed_args.output).spk)
+
+
+if __name__ == '__main__':
+    main()
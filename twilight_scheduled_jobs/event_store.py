@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .event_table import EventTable
+
+
+class EventStore:
+    """
+    Persistent store of computed event tables.
+    Every event family is stored as a .npy file of (int64 epoch microseconds, int16 event code) records,
+    which is memory-mapped when loaded. Tables are keyed by the station position, the ephemeris and the Skyfield version.
+    The ephemeris is identified by its file name, size and modification time, so a replaced file
+    (e.g. an excerpt or a newer version with the same name) does not reuse the events of the previous one.
+    """
+
+    format_version = 1
+    record_dtype = np.dtype([('time', EventTable.times_dtype), ('code', EventTable.codes_dtype)])
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def create_key(
+            cls, station_geographic_position, ephemeris_name, skyfield_version, engine_name=None,
+            ephemeris_pathname=None,
+    ):
+        key_dict = dict(
+            latitude=round(float(station_geographic_position.latitude.degrees), 9),
+            longitude=round(float(station_geographic_position.longitude.degrees), 9),
+            elevation=round(float(station_geographic_position.elevation.m), 3),
+            ephemeris=os.path.basename(str(ephemeris_name)),
+            skyfield_version=str(skyfield_version),
+            format_version=cls.format_version,
+        )
+        if ephemeris_pathname is not None:
+            # the file is not read (it may be opened lazily), its size and modification time tell the versions apart
+            ephemeris_stat = os.stat(ephemeris_pathname)
+            key_dict['ephemeris_size'] = ephemeris_stat.st_size
+            key_dict['ephemeris_mtime_ns'] = ephemeris_stat.st_mtime_ns
+        if engine_name is not None:
+            key_dict['engine'] = engine_name
+        key_json_str = json.dumps(key_dict, sort_keys=True)
+        return hashlib.sha1(key_json_str.encode('utf-8')).hexdigest()[:16], key_dict
+
+    def _key_directory(self, key):
+        return os.path.join(self.directory, key)
+
+    def _events_pathname(self, key, family):
+        return os.path.join(self._key_directory(key), f'{family}.npy')
+
+    def _coverage_pathname(self, key, family):
+        return os.path.join(self._key_directory(key), f'{family}.json')
+
+    def load(self, key, family):
+        events_pathname = self._events_pathname(key, family)
+        coverage_pathname = self._coverage_pathname(key, family)
+        if not os.path.exists(events_pathname) or not os.path.exists(coverage_pathname):
+            return None
+        with open(coverage_pathname) as f:
+            coverage = json.load(f)
+        records = np.load(events_pathname, mmap_mode='r')
+        if records.dtype != self.record_dtype or len(records) != coverage['count']:
+            # interrupted save, the table is computed again
+            return None
+        return EventTable(
+            times=records['time'],
+            codes=records['code'],
+            start=coverage['start'],
+            end=coverage['end'],
+        )
+
+    def save(self, key, family, table, key_dict=None):
+        key_directory = self._key_directory(key)
+        os.makedirs(key_directory, exist_ok=True)
+        if key_dict is not None:
+            self._write_atomic(
+                os.path.join(key_directory, 'key.json'),
+                lambda f: f.write(json.dumps(key_dict, indent=2).encode('utf-8'))
+            )
+
+        records = np.empty(len(table), dtype=self.record_dtype)
+        records['time'] = table.times
+        records['code'] = table.codes
+        coverage = dict(start=int(table.start), end=int(table.end), count=len(records))
+        self._write_atomic(self._events_pathname(key, family), lambda f: np.save(f, records))
+        self._write_atomic(
+            self._coverage_pathname(key, family),
+            lambda f: f.write(json.dumps(coverage).encode('utf-8'))
+        )
+
+    @staticmethod
+    def _write_atomic(pathname, write_func):
+        fd, tmp_pathname = tempfile.mkstemp(dir=os.path.dirname(pathname), prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_func(f)
+            os.replace(tmp_pathname, pathname)
+        except BaseException:
+            if os.path.exists(tmp_pathname):
+                os.remove(tmp_pathname)
+            raise
@@ -0,0 +1,115 @@
+import datetime
+
+import numpy as np
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def datetime_to_epoch_us(value):
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def epoch_us_to_datetime(value, timezone):
+    utc_datetime = EPOCH + datetime.timedelta(microseconds=int(value))
+    local_datetime = utc_datetime.astimezone(timezone)
+    if hasattr(timezone, 'normalize'):
+        # the same normalization as skyfield.timelib.Time.astimezone
+        local_datetime = timezone.normalize(local_datetime)
+    return local_datetime
+
+
+def epoch_us_to_datetimes(values, timezone):
+    """
+    Vectorized epoch_us_to_datetime.
+    """
+    utc_datetimes = np.asarray(values, dtype=np.int64).astype('datetime64[us]').astype(datetime.datetime)
+    local_datetimes = [
+        utc_datetime.replace(tzinfo=datetime.timezone.utc).astimezone(timezone) for utc_datetime in utc_datetimes
+    ]
+    if hasattr(timezone, 'normalize'):
+        local_datetimes = [timezone.normalize(local_datetime) for local_datetime in local_datetimes]
+    return local_datetimes
+
+
+def epoch_us_to_skyfield_times(ts, values):
+    """
+    Vectorized conversion of epoch microseconds to a Skyfield Time. The epoch microseconds do not count
+    the leap seconds, so they are split into UTC days and seconds of the day.
+    """
+    days, seconds_of_day = np.divmod(np.asarray(values, dtype=np.float64) / 1e6, 86400.0)
+    return ts.utc(1970, 1, 1 + days.astype(np.int64), 0, 0, seconds_of_day)
+
+
+def skyfield_times_to_epoch_us(times):
+    if len(times) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.array([datetime_to_epoch_us(value) for value in times.utc_datetime()], dtype=np.int64)
+
+
+class EventTable:
+    """
+    Sorted events of a single event family (e.g. the Sun meridian transits) covering the [start, end) interval.
+    Event times are stored as int64 microseconds since the Unix epoch, event codes as small integers.
+    """
+
+    times_dtype = np.int64
+    codes_dtype = np.int16
+
+    def __init__(self, times=None, codes=None, start=None, end=None):
+        self.times = np.asarray(times if times is not None else [], dtype=self.times_dtype)
+        self.codes = np.asarray(codes if codes is not None else [], dtype=self.codes_dtype)
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def is_empty(self):
+        return self.start is None
+
+    def covers(self, start, end):
+        return not self.is_empty and self.start <= start and end <= self.end
+
+    def missing_ranges(self, start, end, max_gap=0):
+        """
+        Return the ranges which have to be computed so that [start, end) is covered.
+        Ranges further than max_gap from the covered interval are not bridged, the table is replaced instead.
+        """
+        if self.is_empty or end < self.start - max_gap or start > self.end + max_gap:
+            return [(start, end)]
+        missing_ranges = []
+        if start < self.start:
+            missing_ranges.append((start, self.start))
+        if end > self.end:
+            missing_ranges.append((self.end, end))
+        return missing_ranges
+
+    def merge(self, times, codes, start, end):
+        times = np.asarray(times, dtype=self.times_dtype)
+        codes = np.asarray(codes, dtype=self.codes_dtype)
+        if self.is_empty or end < self.start or start > self.end:
+            self.times, self.codes, self.start, self.end = times, codes, start, end
+            return
+        keep_before = self.times < start
+        keep_after = self.times >= end
+        self.times = np.concatenate((self.times[keep_before], times, self.times[keep_after]))
+        self.codes = np.concatenate((self.codes[keep_before], codes, self.codes[keep_after]))
+        self.start = min(self.start, start)
+        self.end = max(self.end, end)
+
+    def index(self, t):
+        """
+        :return: number of the events at or before t
+        """
+        return int(np.searchsorted(self.times, t, side='right'))
+
+    def events_between(self, start, end):
+        """
+        :return: times and codes of the events in the (start, end] interval, an event at start is not included
+                 (as in a search window starting at start, e.g. the next t0 at the Sun meridian transit)
+        """
+        i = self.index(start)
+        j = self.index(end)
+        return self.times[i:j], self.codes[i:j]
@@ -0,0 +1,260 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+import time
+
+import schedule
+
+from . import metrics
+
+
+class InlineJobExecutor:
+    """
+    Runs the job function on the scheduler thread (the default behaviour).
+    The timeout cannot be enforced, a job running longer than the timeout is only logged.
+    """
+
+    def __init__(self, timeout=None, logger=None):
+        self.timeout = timeout
+        self.logger = logger if logger else logging.getLogger('JobExecutor')
+
+    def submit(self, job, func, on_success=None):
+        tic = time.monotonic()
+        ret = func()
+        duration = time.monotonic() - tic
+        metrics.job_duration_seconds.observe(duration)
+        if self.timeout is not None and duration > self.timeout:
+            self.logger.error('Job %s exceeded the timeout of %s s (%.1f s)', job, self.timeout, duration)
+        if on_success is not None:
+            on_success()
+        return ret
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class _JobRun:
+
+    def __init__(self, job, func, on_success=None):
+        self.job = job
+        self.func = func
+        self.on_success = on_success
+        self.future = None
+        self.process = None
+        self.timer = None
+        self.started = None
+        self.finished = False
+
+
+class PoolJobExecutor:
+    """
+    Base class of the executors running the job functions outside of the scheduler thread.
+
+    At most `max_concurrency_per_job` runs of a single job can be in flight. When a job is due while it is
+    still running, the `overlap_policy` decides whether the new run is skipped ('skip'), started after the previous
+    run finishes ('queue') or whether the previous run is cancelled ('cancel_previous').
+    Runs exceeding `timeout` seconds are cancelled and logged.
+    `on_success` (e.g. journaling the run) is called when the run finishes without an error,
+    not when it is skipped, cancelled, timed out or fails.
+    """
+
+    overlap_policies = ('skip', 'queue', 'cancel_previous')
+
+    def __init__(
+            self,
+            max_workers=4,
+            max_concurrency_per_job=1,
+            overlap_policy='skip',
+            timeout=None,
+            logger=None,
+    ):
+        if overlap_policy not in self.overlap_policies:
+            raise ValueError(f'Unknown overlap policy {overlap_policy}, expected one of {self.overlap_policies}.')
+        self.max_workers = max_workers
+        self.max_concurrency_per_job = max_concurrency_per_job
+        self.overlap_policy = overlap_policy
+        self.timeout = timeout
+        self.logger = logger if logger else logging.getLogger('JobExecutor')
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=type(self).__name__
+        )
+        self._lock = threading.Lock()
+        self._running_runs = collections.defaultdict(list)
+        self._queued_funcs = collections.defaultdict(collections.deque)
+
+    def submit(self, job, func, on_success=None):
+        with self._lock:
+            running_runs = self._running_runs[job]
+            if len(running_runs) >= self.max_concurrency_per_job:
+                if self.overlap_policy == 'skip':
+                    self.logger.warning('Job %s is still running, skipping this run', job)
+                    return None
+                elif self.overlap_policy == 'queue':
+                    self.logger.info('Job %s is still running, queueing this run', job)
+                    self._queued_funcs[job].append((func, on_success))
+                    return None
+                elif self.overlap_policy == 'cancel_previous':
+                    for run in running_runs[:len(running_runs) - self.max_concurrency_per_job + 1]:
+                        self.logger.warning('Job %s is still running, cancelling the previous run', job)
+                        self._cancel_run(run)
+            self._start_run(job, func, on_success)
+        return None
+
+    def _is_saturated(self):
+        return False
+
+    def _start_run(self, job, func, on_success=None):
+        if self._is_saturated():
+            self.logger.error(
+                'Job %s is not run, all the %d workers are occupied by runs abandoned after the timeout',
+                job, self.max_workers,
+            )
+            return
+        run = _JobRun(job, func, on_success)
+        self._running_runs[job].append(run)
+        run.future = self._pool.submit(self._execute_run, run)
+        if self.timeout is not None:
+            run.timer = threading.Timer(self.timeout, self._on_timeout, args=(run,))
+            run.timer.daemon = True
+            run.timer.start()
+
+    def _execute_run(self, run):
+        raise NotImplementedError
+
+    def _cancel_run(self, run):
+        run.future.cancel()
+        self._finish_run(run, locked=True)
+
+    def _on_timeout(self, run):
+        with self._lock:
+            if run.finished:
+                return
+            self.logger.error('Job %s exceeded the hard timeout of %s s, cancelling it', run.job, self.timeout)
+            self._cancel_run(run)
+
+    def _run_succeeded(self, run):
+        if run.on_success is None:
+            return
+        try:
+            run.on_success()
+        except Exception as e:
+            self.logger.exception('Error after the run of job %s [%s]: %s', run.job, type(e).__name__, str(e))
+
+    def _finish_run(self, run, ret=None, locked=False):
+        """
+        :return: whether the run was finished by this call (False if it was already cancelled)
+        """
+        if not locked:
+            with self._lock:
+                return self._finish_run(run, ret=ret, locked=True)
+        if run.finished:
+            # already cancelled, the result is ignored
+            return False
+        run.finished = True
+        if run.started is not None:
+            metrics.job_duration_seconds.observe(time.monotonic() - run.started)
+        if run.timer is not None:
+            run.timer.cancel()
+        self._running_runs[run.job].remove(run)
+        if not self._running_runs[run.job]:
+            del self._running_runs[run.job]
+        if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+            run.job.request_cancel()
+        queued_funcs = self._queued_funcs.get(run.job)
+        if queued_funcs:
+            self._start_run(run.job, *queued_funcs.popleft())
+            if not queued_funcs:
+                del self._queued_funcs[run.job]
+        return True
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._queued_funcs.clear()
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class ThreadPoolJobExecutor(PoolJobExecutor):
+    """
+    Runs the job functions in a thread pool.
+    A thread cannot be stopped, so the timeout is soft: a run exceeding it is abandoned (logged, its concurrency
+    slot is released and its result is ignored), but its thread keeps a pool worker until the job function returns.
+    When all the `max_workers` workers are occupied by abandoned runs, the new runs are refused and logged.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._abandoned_runs = set()
+
+    def _is_saturated(self):
+        return len(self._abandoned_runs) >= self.max_workers
+
+    def _execute_run(self, run):
+        ret = None
+        succeeded = False
+        run.started = time.monotonic()
+        try:
+            ret = run.func()
+            succeeded = True
+        except Exception as e:
+            self.logger.exception('Error in job %s [%s]: %s', run.job, type(e).__name__, str(e))
+        finally:
+            finished = self._finish_run(run, ret=ret)
+            with self._lock:
+                if run in self._abandoned_runs:
+                    self._abandoned_runs.remove(run)
+                    self.logger.info('Abandoned run of job %s returned, its worker is free again', run.job)
+        if finished and succeeded:
+            self._run_succeeded(run)
+
+    def _cancel_run(self, run):
+        if not run.future.cancel() and not run.future.done():
+            # the thread keeps running, it occupies its pool worker until the job function returns
+            self._abandoned_runs.add(run)
+        super()._cancel_run(run)
+
+
+class ProcessPoolJobExecutor(PoolJobExecutor):
+    """
+    Runs every job function in a separate process, which is killed when the run exceeds the timeout.
+    The job function has to be picklable with the spawn/forkserver start methods, its return value is not passed back.
+    """
+
+    def __init__(self, *args, mp_context=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mp_context = mp_context if mp_context is not None else multiprocessing.get_context()
+
+    def _execute_run(self, run):
+        succeeded = False
+        try:
+            with self._lock:
+                if run.finished:
+                    return
+            # starting a process can take long (spawn, forkserver), it does not block submit and the timeouts
+            process = self.mp_context.Process(target=run.func, daemon=True)
+            process.start()
+            with self._lock:
+                run.process = process
+                run.started = time.monotonic()
+                cancelled = run.finished
+            if cancelled:
+                # cancelled (e.g. timed out) while the process was starting
+                process.kill()
+                process.join()
+                return
+            process.join()
+            succeeded = process.exitcode == 0
+            if process.exitcode not in (0, None) and not run.finished:
+                self.logger.error('Job %s process exited with code %s', run.job, process.exitcode)
+        except Exception as e:
+            self.logger.exception('Error in job %s [%s]: %s', run.job, type(e).__name__, str(e))
+        finally:
+            finished = self._finish_run(run)
+        if finished and succeeded:
+            self._run_succeeded(run)
+
+    def _cancel_run(self, run):
+        if run.process is not None and run.process.is_alive():
+            run.process.kill()
+        super()._cancel_run(run)
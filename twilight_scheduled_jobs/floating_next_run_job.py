@@ -1,38 +1,121 @@
 import datetime
+import functools
 import logging
+import threading
 import typing
 
 import schedule
-import tzlocal
+
+from . import metrics
+from .clock import SYSTEM_CLOCK
+from .defaults import DEFAULTS
+from .parser import MissingEventError
+
+# keywords of the settings job functions that differ between the jobs of one schedule
+COALESCED_JOB_FUNC_KEYWORDS = ('settings_dict', 'logger', 'run_once')
+
+
+def coalescing_key(job):
+    """
+    :return: key of the jobs whose job functions differ only in the settings (None if the job cannot be coalesced)
+    """
+    job_func = job.job_func
+    if not isinstance(job_func, functools.partial) or 'settings_dict' not in job_func.keywords:
+        return None
+    return (
+        job_func.func,
+        id(job.executor),
+        tuple(id(arg) for arg in job_func.args),
+        tuple(sorted(
+            (name, id(value))
+            for name, value in job_func.keywords.items()
+            if name not in COALESCED_JOB_FUNC_KEYWORDS
+        )),
+    )
+
+
+def coalesce_job_funcs(jobs):
+    """
+    Job function of the first job with the settings dicts of all the `jobs` merged in order
+    (the settings of the later jobs override the earlier ones).
+    """
+    settings_dict = dict()
+    for job in jobs:
+        settings_dict.update(job.job_func.keywords['settings_dict'])
+    return functools.partial(jobs[0].job_func, settings_dict=settings_dict)
+
+
+def _call_all(funcs):
+    for func in funcs:
+        func()
 
 
 class FloatingNextRunJob(schedule.Job):
 
+    # cycles skipped in a row because of missing events before the error is raised
+    max_skipped_cycles = 200
+
     def __init__(
             self, interval, scheduler,
             t0_datetime: datetime.datetime,
             resolve_next_t0_datetime_func: typing.Callable,
             resolve_operation_datetime_func: typing.Callable,
             logger: logging.Logger = None,
+            executor=None,
+            run_once: bool = False,
+            clock=None,
+            journal=None,
+            journal_key: str = None,
             **kwargs
     ):
         super().__init__(interval, scheduler)
 
         self.logger = logger if logger else logging.getLogger('FloatingNextRunJob')
+        self.executor = executor if executor is not None else getattr(scheduler, 'executor', None)
+        self.run_once = run_once
+        # the clock of the scheduler (the system clock by default, a virtual clock in simulations)
+        self.clock = clock if clock is not None else getattr(scheduler, 'clock', SYSTEM_CLOCK)
+        self.cancel_requested = False
+        # run journal (see the journal module) recording the runs by the journal key
+        self.journal = journal
+        self.journal_key = journal_key
 
         self.next_t0_datetime = t0_datetime
+        # cycle t0 and operation datetime of the next run
+        self.t0_datetime = None
+        self.operation_datetime = None
         self.resolve_next_t0_func = resolve_next_t0_datetime_func
         self.resolve_operation_datetime_func = resolve_operation_datetime_func
 
     def _schedule_next_run(self) -> None:
+        with metrics.job_schedule_seconds.time():
+            self._resolve_next_run()
+
+    def _resolve_next_run(self) -> None:
 
         t0_datetime = self.next_t0_datetime
-        operation_datetime = self.resolve_operation_datetime_func(t0_datetime=t0_datetime)
+        for skipped_cycles in range(self.max_skipped_cycles + 1):
+            try:
+                operation_datetime = self.resolve_operation_datetime_func(t0_datetime=t0_datetime)
+                break
+            except MissingEventError as e:
+                if skipped_cycles == self.max_skipped_cycles:
+                    raise
+                metrics.skipped_cycles_total.inc()
+                # skip the job in this cycle (e.g. no astronomical night at high latitudes in summer)
+                self.logger.info('Skipping cycle starting at %s: %s', t0_datetime, str(e))
+                t0_datetime = self.resolve_next_t0_func(
+                    t0_datetime=t0_datetime,
+                    operation_datetime=t0_datetime,
+                    interval_timedelta=datetime.timedelta(seconds=self.interval),
+                )
 
-        local_tz = tzlocal.get_localzone()
+        local_tz = self.clock.local_timezone()
         operation_datetime_local = operation_datetime.astimezone(local_tz).replace(tzinfo=None)
 
         self.next_run = operation_datetime_local
+        self.t0_datetime = t0_datetime
+        self.operation_datetime = operation_datetime
 
         self.next_t0_datetime = self.resolve_next_t0_func(
             t0_datetime=t0_datetime,
@@ -44,9 +127,58 @@ class FloatingNextRunJob(schedule.Job):
             'Scheduled job for %s (system timezone)',
             self.next_run.strftime('%Y-%m-%d %H:%M'),
         )
-    def run(self):
+
+    def record_run(self, operation_datetime, done=False):
+        """
+        Journal the run at `operation_datetime` with the cycle t0 of the next run (None if the job is `done`).
+        """
+        if self.journal is not None:
+            self.journal.record(self.journal_key, operation_datetime, None if done else self.t0_datetime)
+
+    def _pending_run_record_func(self):
+        """
+        :return: function journaling the due run (before the job is rescheduled) when it succeeds, None without
+                 a journal. The next cycle t0 is the one the job is rescheduled from.
+        """
+        if self.journal is None:
+            return None
+        return functools.partial(
+            self.journal.record,
+            self.journal_key,
+            self.operation_datetime,
+            None if self.run_once else self.next_t0_datetime,
+        )
+
+    @property
+    def should_run(self) -> bool:
+        return self.clock.now() >= self.next_run
+
+    def request_cancel(self):
+        """
+        Cancel the job on the next run_pending call (thread-safe, used by the executors).
+        """
+        self.cancel_requested = True
+        if isinstance(self.scheduler, CustomizableScheduler):
+            self.scheduler.notify_jobs_changed()
+
+    def replace_job_func(self, job_func: typing.Callable, *args, **kwargs):
+        """
+        Replace the job function (as .do() does) without rescheduling the job.
+        """
+        self.job_func = functools.partial(job_func, *args, **kwargs)
+        functools.update_wrapper(self.job_func, job_func)
+
+    def do(self, job_func: typing.Callable, *args, **kwargs):
+        job = super().do(job_func, *args, **kwargs)
+        if isinstance(self.scheduler, CustomizableScheduler):
+            self.scheduler.notify_jobs_changed()
+        return job
+
+    def run(self, job_func=None, coalesced_jobs=()):
         """
-        Run the job and immediately reschedule it.
+        Run the job (or `job_func` instead of the job function, see coalesce_job_funcs) and immediately reschedule it.
+        With an executor, the run (and the runs of the `coalesced_jobs` applied by `job_func`, see run_coalesced)
+        is journaled by the executor when it succeeds, not when it is submitted.
         If the job's deadline is reached (configured using .until()), the job is not
         run and CancelJob is returned immediately. If the next scheduled run exceeds
         the job's deadline, CancelJob is returned after the execution. In this latter
@@ -56,31 +188,159 @@ class FloatingNextRunJob(schedule.Job):
                  deadline is reached.
 
         """
-        if self._is_overdue(datetime.datetime.now()):
+        now = self.clock.now()
+        if self._is_overdue(now):
             self.logger.debug("Cancelling job %s", self)
             return schedule.CancelJob
 
         self.logger.debug("Running job %s", self)
-        ret = self.job_func()
-        self.last_run = datetime.datetime.now()
+        if self.next_run is not None:
+            metrics.job_dispatch_lateness_seconds.observe(max(0., (now - self.next_run).total_seconds()))
+        metrics.jobs_run_total.inc()
+        job_func = job_func if job_func is not None else self.job_func
+        operation_datetime = self.operation_datetime
+        if self.executor is None:
+            with metrics.job_duration_seconds.time():
+                ret = job_func()
+        else:
+            record_funcs = [
+                record_func for record_func in (job._pending_run_record_func() for job in (self, *coalesced_jobs))
+                if record_func is not None
+            ]
+            ret = self.executor.submit(
+                self, job_func,
+                on_success=functools.partial(_call_all, record_funcs) if record_funcs else None,
+            )
+            if ret is None and self.run_once:
+                # the job has been dispatched, the result of a pool executor is not awaited
+                ret = schedule.CancelJob
+        self.last_run = self.clock.now()
 
         if not (isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob):
             # this condition is a change from the original implementation
             self._schedule_next_run()
+            if self.executor is None:
+                self.record_run(operation_datetime)
 
             if self._is_overdue(self.next_run):
                 self.logger.debug("Cancelling job %s", self)
                 return schedule.CancelJob
+        elif self.executor is None:
+            self.record_run(operation_datetime, done=True)
 
         return ret
 
+    def run_coalesced(self, lead_job):
+        """
+        Record the run of the job whose settings were applied by the job function call of `lead_job`
+        and reschedule it.
+
+        :return: None, or CancelJob if the job runs once or its deadline is reached
+        """
+        now = self.clock.now()
+        if self._is_overdue(now):
+            self.logger.debug("Cancelling job %s", self)
+            return schedule.CancelJob
+
+        self.logger.info('Running job coalesced with %s', lead_job.logger.name)
+        metrics.jobs_run_total.inc()
+        metrics.jobs_coalesced_total.inc()
+        self.last_run = now
+        operation_datetime = self.operation_datetime
+        # with an executor, the run is journaled by the executor of the lead job when it succeeds
+        record = getattr(lead_job, 'executor', None) is None
+        if self.run_once:
+            if record:
+                self.record_run(operation_datetime, done=True)
+            return schedule.CancelJob
+
+        self._schedule_next_run()
+        if record:
+            self.record_run(operation_datetime)
+        if self._is_overdue(self.next_run):
+            self.logger.debug("Cancelling job %s", self)
+            return schedule.CancelJob
+        return None
+
 
 class CustomizableScheduler(schedule.Scheduler):
-    def __init__(self, job_class=FloatingNextRunJob):
+    def __init__(
+            self, job_class=FloatingNextRunJob, executor=None, clock=None,
+            coalesce_window=DEFAULTS['coalesce_window'],
+    ):
         super().__init__()
         self.job_class = job_class
+        # job executor (see the executors module), None runs the jobs inline
+        self.executor = executor
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        # seconds, the jobs due within the window are run by one job function call with merged settings
+        self.coalesce_window = coalesce_window
+        # set when the set of jobs changes, so that a loop sleeping until the next run can re-evaluate it
+        self.wakeup_event = threading.Event()
 
     def every(self, interval=1, **kwargs):
         job = self.job_class(interval, self, **kwargs)
         return job
 
+    @property
+    def idle_seconds(self):
+        if not self.next_run:
+            return None
+        return (self.next_run - self.clock.now()).total_seconds()
+
+    def notify_jobs_changed(self):
+        self.wakeup_event.set()
+
+    def cancel_requested_jobs(self):
+        for job in [job for job in self.jobs if getattr(job, 'cancel_requested', False)]:
+            self.cancel_job(job)
+
+    def runnable_job_groups(self):
+        """
+        Group the runnable jobs with the jobs of the same job function due within the coalescing window.
+
+        :return: list of the lists of the jobs to run together, ordered by their next run and the schedule order
+        """
+        if not self.coalesce_window:
+            return [[job] for job in sorted(job for job in self.jobs if job.should_run)]
+        if not any(job.should_run for job in self.jobs):
+            return []
+
+        window_end = self.clock.now() + datetime.timedelta(seconds=self.coalesce_window)
+        job_order = {job: i for i, job in enumerate(self.jobs)}
+        groups = dict()
+        for job in sorted(
+                (job for job in self.jobs if job.next_run is not None and job.next_run <= window_end),
+                key=lambda job: (job.next_run, job_order[job]),
+        ):
+            key = coalescing_key(job)
+            groups.setdefault(key if key is not None else job, []).append(job)
+        # the jobs coalesced with none of the due jobs run at their own next run
+        return [jobs for jobs in groups.values() if any(job.should_run for job in jobs)]
+
+    def run_pending(self) -> None:
+        self.cancel_requested_jobs()
+        for jobs in self.runnable_job_groups():
+            self._run_coalesced_jobs(jobs)
+
+    def _run_coalesced_jobs(self, jobs) -> None:
+        if len(jobs) == 1:
+            self._run_job(jobs[0])
+            return
+        lead_job = jobs[0]
+        ret = lead_job.run(job_func=coalesce_job_funcs(jobs), coalesced_jobs=jobs[1:])
+        if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+            self.cancel_job(lead_job)
+        for job in jobs[1:]:
+            ret = job.run_coalesced(lead_job)
+            if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+                self.cancel_job(job)
+
+    def cancel_job(self, job: schedule.Job) -> None:
+        super().cancel_job(job)
+        self.notify_jobs_changed()
+
+    def clear(self, tag=None) -> None:
+        super().clear(tag)
+        self.notify_jobs_changed()
+
@@ -2,18 +2,141 @@ import datetime
 import hashlib
 import json
 import logging
-import time
+import threading
 from functools import partial
 
 import pytimeparse.timeparse
 import schedule
 
-from .safe_termination import terminate_flag as safe_termination_terminate_flag
+from . import metrics, safe_termination
+from .clock import SYSTEM_CLOCK
 from .next_job_datetime import resolve_next_t0_datetime, resolve_operation_datetime
-from .parser import slugify_datetime_expression, find_variables
+from .parser import datetime_expression_key, slugify_datetime_expression, find_variables
+from .planner import ScheduleGroupPlanner
 from .defaults import DEFAULTS
 
 
+def _create_planner(
+        datetime_expressions,
+        next_t0_datetime_expression,
+        create_dict_func,
+        t0_step,
+):
+    return ScheduleGroupPlanner(
+        datetime_expressions=datetime_expressions,
+        next_t0_datetime_expression=next_t0_datetime_expression,
+        create_dict_func=create_dict_func,
+        t0_step=t0_step,
+    )
+
+
+def get_settings_hash(settings_dict):
+    settings_dict_json_str = json.dumps(settings_dict)
+    return hashlib.md5(settings_dict_json_str.encode('utf-8')).hexdigest()[:8]
+
+
+def _initialize_job(
+        datetime_expression,
+        settings_dict,
+        next_t0_datetime_expression,
+        start_t0,
+        settings_job_func,
+        create_dict_func,
+        logger,
+        scheduler,
+        apply_settings_job_logger_name_format,
+        t0_step,
+        planner,
+        journal=None,
+        resume=False,
+):
+    journal_key = datetime_expression_key(datetime_expression)
+    journal_record = journal.get(journal_key) if journal is not None and resume else None
+    if journal_record is not None:
+        _, next_t0_datetime = journal_record
+        # the job continues with the cycle after its last run (its missed runs are caught up by the caller)
+        if next_t0_datetime is not None:
+            start_t0 = next_t0_datetime.astimezone(start_t0.tzinfo)
+
+    if planner is not None:
+        resolve_next_t0_datetime_partial_func = planner.resolve_next_t0_datetime
+        resolve_operation_datetime_partial_func = partial(
+            planner.resolve_operation_datetime,
+            operation_datetime_expression=datetime_expression,
+        )
+    else:
+        resolve_next_t0_datetime_partial_func = partial(
+            resolve_next_t0_datetime,
+            next_t0_datetime_expression=next_t0_datetime_expression,
+            create_dict_func=create_dict_func,
+        )
+        resolve_operation_datetime_partial_func = partial(
+            resolve_operation_datetime,
+            operation_datetime_expression=datetime_expression,
+            create_dict_func=create_dict_func,
+        )
+
+    settings_hash = get_settings_hash(settings_dict)
+    apply_settings_job_partial_func, job_logger, run_once = _settings_job_func(
+        datetime_expression, settings_dict, settings_hash, settings_job_func, logger,
+        apply_settings_job_logger_name_format,
+    )
+    change_camera_settings_job = scheduler.every(
+        interval=int(t0_step.total_seconds()),
+        t0_datetime=start_t0,
+        resolve_next_t0_datetime_func=resolve_next_t0_datetime_partial_func,
+        resolve_operation_datetime_func=resolve_operation_datetime_partial_func,
+        logger=job_logger,
+        run_once=run_once,
+        journal=journal,
+        journal_key=journal_key,
+    ).seconds.do(apply_settings_job_partial_func)
+    # used to diff the jobs when the schedule file is reloaded
+    change_camera_settings_job.settings_hash = settings_hash
+    change_camera_settings_job.planner = planner
+    change_camera_settings_job.resumed = journal_record is not None
+    if journal_record is not None and journal_record[1] is None:
+        job_logger.info('Run-once job already run (run journal), cancelling it')
+        scheduler.cancel_job(change_camera_settings_job)
+
+    return change_camera_settings_job
+
+
+def _settings_job_func(
+        datetime_expression,
+        settings_dict,
+        settings_hash,
+        settings_job_func,
+        logger,
+        apply_settings_job_logger_name_format,
+):
+    datetime_expression_slug = slugify_datetime_expression(datetime_expression)
+
+    settings_dict_json_str = json.dumps(settings_dict)
+    settings_dict_json_str_truncated = settings_dict_json_str[:100] + '...' if len(settings_dict_json_str) > 100 else settings_dict_json_str
+
+    logger.info(
+        'Initializing camera settings job for. %s: %s',  #
+        settings_hash,
+        settings_dict_json_str_truncated,
+    )
+
+    logger_name = apply_settings_job_logger_name_format.format(
+        datetime_expression=datetime_expression_slug,
+        settings_hash=settings_hash
+    )
+    job_logger = logging.getLogger(logger_name)
+
+    run_once = len(find_variables(datetime_expression)) == 0
+    apply_settings_job_partial_func = partial(
+        settings_job_func,
+        logger=job_logger,
+        settings_dict=settings_dict,
+        run_once=run_once
+    )
+    return apply_settings_job_partial_func, job_logger, run_once
+
+
 def initialize_jobs(
         datetime_expression,
         next_t0_datetime_expression,
@@ -24,76 +147,179 @@ def initialize_jobs(
         scheduler,
         apply_settings_job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
         t0_step=datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(DEFAULTS['t0_step'])),
+        group_planning=DEFAULTS['group_planning'],
+        journal=None,
 ):
     scheduled_camera_settings_jobs_dict = dict()
     # scheduled_job_datetimes = set()
 
-    resolve_next_t0_datetime_partial_func = partial(
-        resolve_next_t0_datetime,
+    # one variable values dict per cycle for all the jobs
+    planner = _create_planner(
+        datetime_expressions=datetime_expression.keys(),
         next_t0_datetime_expression=next_t0_datetime_expression,
         create_dict_func=create_dict_func,
-    )
+        t0_step=t0_step,
+    ) \
+        if group_planning \
+        else None
 
     for datetime_expression, settings_dict in datetime_expression.items():
-        resolve_operation_datetime_partial_func = partial(
-            resolve_operation_datetime,
-            operation_datetime_expression=datetime_expression,
+        scheduled_camera_settings_jobs_dict[datetime_expression] = _initialize_job(
+            datetime_expression=datetime_expression,
+            settings_dict=settings_dict,
+            next_t0_datetime_expression=next_t0_datetime_expression,
+            start_t0=start_t0,
+            settings_job_func=settings_job_func,
             create_dict_func=create_dict_func,
+            logger=logger,
+            scheduler=scheduler,
+            apply_settings_job_logger_name_format=apply_settings_job_logger_name_format,
+            t0_step=t0_step,
+            planner=planner,
+            journal=journal,
+            resume=True,
         )
 
-        datetime_expression_slug = slugify_datetime_expression(datetime_expression)
+    return scheduled_camera_settings_jobs_dict
 
-        settings_dict_json_str = json.dumps(settings_dict)
-        settings_dict_json_str_truncated = settings_dict_json_str[:100] + '...' if len(settings_dict_json_str) > 100 else settings_dict_json_str
-        settings_hash = hashlib.md5(settings_dict_json_str.encode('utf-8')).hexdigest()[:8]
 
-        logger.info(
-            'Initializing camera settings job for. %s: %s',  #
-            settings_hash,
-            settings_dict_json_str_truncated,
-        )
+def update_jobs(
+        scheduled_camera_settings_jobs_dict,
+        datetime_expression,
+        next_t0_datetime_expression,
+        start_t0,
+        settings_job_func,
+        create_dict_func,
+        logger,
+        scheduler,
+        apply_settings_job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
+        t0_step=datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(DEFAULTS['t0_step'])),
+        group_planning=DEFAULTS['group_planning'],
+        journal=None,
+):
+    """
+    Apply a reloaded schedule to the jobs returned by initialize_jobs (the dict is updated in place):
+    the jobs of removed expressions are cancelled, the jobs of new expressions are added (planned from `start_t0`)
+    and the jobs with changed settings (settings hash) keep their next run and get the new settings.
+    Unchanged jobs are not touched.
 
-        logger_name = apply_settings_job_logger_name_format.format(
-            datetime_expression=datetime_expression_slug,
-            settings_hash=settings_hash
-        )
-        job_logger = logging.getLogger(logger_name)
+    :return: (added, removed, replaced) lists of datetime expressions
+    """
+    added, removed, replaced = [], [], []
 
-        apply_settings_job_partial_func = partial(
-            settings_job_func,
-            logger=job_logger,
-            settings_dict=settings_dict,
-            run_once=len(find_variables(datetime_expression)) == 0
+    for job_datetime_expression in list(scheduled_camera_settings_jobs_dict.keys()):
+        if job_datetime_expression not in datetime_expression:
+            scheduler.cancel_job(scheduled_camera_settings_jobs_dict.pop(job_datetime_expression))
+            removed.append(job_datetime_expression)
+
+    for job_datetime_expression, settings_dict in datetime_expression.items():
+        job = scheduled_camera_settings_jobs_dict.get(job_datetime_expression)
+        if job is None:
+            added.append(job_datetime_expression)
+            continue
+        settings_hash = get_settings_hash(settings_dict)
+        if settings_hash != job.settings_hash:
+            apply_settings_job_partial_func, job_logger, _ = _settings_job_func(
+                job_datetime_expression, settings_dict, settings_hash, settings_job_func, logger,
+                apply_settings_job_logger_name_format,
+            )
+            job.replace_job_func(apply_settings_job_partial_func)
+            job.logger = job_logger
+            job.settings_hash = settings_hash
+            replaced.append(job_datetime_expression)
+
+    planner = None
+    if group_planning:
+        planner = next(
+            (job.planner for job in scheduled_camera_settings_jobs_dict.values() if job.planner is not None),
+            None
         )
-        change_camera_settings_job = scheduler.every(
-            interval=int(t0_step.total_seconds()),
-            t0_datetime=start_t0,
-            resolve_next_t0_datetime_func=resolve_next_t0_datetime_partial_func,
-            resolve_operation_datetime_func=resolve_operation_datetime_partial_func,
-            logger=job_logger,
-        ).seconds.do(apply_settings_job_partial_func)
+        if planner is None:
+            planner = _create_planner(
+                datetime_expressions=datetime_expression.keys(),
+                next_t0_datetime_expression=next_t0_datetime_expression,
+                create_dict_func=create_dict_func,
+                t0_step=t0_step,
+            )
+        elif added or removed:
+            planner.set_datetime_expressions(datetime_expression.keys())
 
-        scheduled_camera_settings_jobs_dict[datetime_expression] = change_camera_settings_job
+    for job_datetime_expression in added:
+        scheduled_camera_settings_jobs_dict[job_datetime_expression] = _initialize_job(
+            datetime_expression=job_datetime_expression,
+            settings_dict=datetime_expression[job_datetime_expression],
+            next_t0_datetime_expression=next_t0_datetime_expression,
+            start_t0=start_t0,
+            settings_job_func=settings_job_func,
+            create_dict_func=create_dict_func,
+            logger=logger,
+            scheduler=scheduler,
+            apply_settings_job_logger_name_format=apply_settings_job_logger_name_format,
+            t0_step=t0_step,
+            planner=planner,
+            journal=journal,
+        )
 
-    return scheduled_camera_settings_jobs_dict
+    return added, removed, replaced
 
 
 def run_pending_loop(
         scheduler,
         logger,
         schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        deadline_driven=DEFAULTS['deadline_driven'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        clock=None,
+        watchers=None,
 ):
     logger.debug('Starting scheduled camera settings loop')
-    while not safe_termination_terminate_flag:
-        try:
-            scheduler.run_pending()
-        except KeyboardInterrupt:
-            logger.info('Keyboard interrupt received. Exiting.')
-            break
-        except Exception as e:
-            logger.exception('Error in scheduled camera settings loop [%s]: %s', type(e).__name__, str(e))
-
-        time.sleep(schedule_pending_check_interval)
+    if clock is None:
+        clock = getattr(scheduler, 'clock', SYSTEM_CLOCK)
+    wakeup_event = getattr(scheduler, 'wakeup_event', None)
+    if wakeup_event is None:
+        wakeup_event = threading.Event()
+    safe_termination.register_wakeup_event(wakeup_event)
+    try:
+        while not safe_termination.terminate_flag:
+            wakeup_event.clear()
+            metrics.loop_wakeups_total.inc()
+            for watcher in watchers or []:
+                watcher.poll()
+            run_pending_failed = False
+            try:
+                scheduler.run_pending()
+            except KeyboardInterrupt:
+                logger.info('Keyboard interrupt received. Exiting.')
+                break
+            except Exception as e:
+                run_pending_failed = True
+                metrics.loop_errors_total.inc()
+                logger.exception('Error in scheduled camera settings loop [%s]: %s', type(e).__name__, str(e))
+            metrics.REGISTRY.export_if_due()
+
+            if deadline_driven:
+                # sleep until the earliest next run, the wakeup event interrupts the sleep
+                # when the jobs change or the safe termination flag is set
+                idle_seconds = scheduler.idle_seconds
+                sleep_interval = max_sleep_interval \
+                    if idle_seconds is None \
+                    else min(max(idle_seconds, 0), max_sleep_interval)
+            else:
+                sleep_interval = schedule_pending_check_interval
+            if run_pending_failed:
+                # a failed job is not rescheduled (it is still due), it is retried after the check interval
+                sleep_interval = max(sleep_interval, schedule_pending_check_interval)
+            sleep_interval = min([sleep_interval] + [watcher.poll_interval for watcher in watchers or []])
+            metrics.loop_sleep_seconds.observe(sleep_interval)
+
+            try:
+                clock.sleep(sleep_interval, wakeup_event)
+            except KeyboardInterrupt:
+                logger.info('Keyboard interrupt received. Exiting.')
+                break
+    finally:
+        safe_termination.unregister_wakeup_event(wakeup_event)
+        metrics.REGISTRY.export()
 
 
 def run_job_wrapper(
@@ -0,0 +1,198 @@
+import datetime
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from .floating_next_run_job import coalesce_job_funcs, coalescing_key
+
+CATCH_UP_POLICIES = ('latest', 'all', 'skip')
+
+
+class RunJournal:
+    """
+    Append-only journal (JSON lines) of the executed jobs: the datetime of the run and the t0 of the job's next cycle
+    (None when a run-once job is done), by the job key (the canonical string of its datetime expression,
+    see datetime_expression_key).
+    The records are flushed immediately and fsynced in batches: it is polled by run_pending_loop as a watcher
+    and syncs the file at most `fsync_interval` seconds after a record.
+    A truncated last line (a crash while writing) is ignored, the file is compacted when it is opened.
+    """
+
+    def __init__(self, pathname, fsync_interval=1., logger=None):
+        self.pathname = os.path.expanduser(pathname)
+        self.fsync_interval = fsync_interval
+        self.logger = logger if logger else logging.getLogger('RunJournal')
+        self._lock = threading.Lock()
+        self._sync_pending = False
+        self.records = self._load()
+        self._compact()
+        self._file = open(self.pathname, 'a')
+
+    def _load(self):
+        records = dict()
+        if not os.path.exists(self.pathname):
+            return records
+        with open(self.pathname, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.warning(
+                        'Ignoring the invalid line %d of the run journal %s', line_number, self.pathname,
+                    )
+                    continue
+                records[record['key']] = record
+        return records
+
+    def _compact(self):
+        directory = os.path.dirname(os.path.abspath(self.pathname))
+        file_descriptor, temporary_pathname = tempfile.mkstemp(dir=directory, prefix='.journal', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_pathname, self.pathname)
+        except BaseException:
+            if os.path.exists(temporary_pathname):
+                os.remove(temporary_pathname)
+            raise
+
+    def get(self, key):
+        """
+        :return: (datetime of the last run, t0 of the next cycle or None if the job is done), None if not journaled
+        """
+        record = self.records.get(key)
+        if record is None:
+            return None
+        return (
+            datetime.datetime.fromisoformat(record['run']),
+            datetime.datetime.fromisoformat(record['next_t0']) if record['next_t0'] is not None else None,
+        )
+
+    def record(self, key, run_datetime, next_t0_datetime):
+        record = dict(
+            key=key,
+            run=run_datetime.isoformat(),
+            next_t0=next_t0_datetime.isoformat() if next_t0_datetime is not None else None,
+        )
+        with self._lock:
+            self.records[key] = record
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            self._sync_pending = True
+
+    def sync(self):
+        with self._lock:
+            if self._sync_pending and not self._file.closed:
+                os.fsync(self._file.fileno())
+                self._sync_pending = False
+
+    @property
+    def poll_interval(self):
+        return self.fsync_interval if self._sync_pending else float('inf')
+
+    def poll(self):
+        self.sync()
+        return False
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+
+def _run_func(job, func, on_success):
+    if job.executor is None:
+        ret = func()
+        on_success()
+        return ret
+    # journaled when the executor completes the run successfully
+    return job.executor.submit(job, func, on_success=on_success)
+
+
+def catch_up_missed_runs(scheduler, jobs, policy, logger):
+    """
+    Handle the runs of the `jobs` resumed from the run journal that were missed while the scheduler was not running
+    (their next run is already due):
+
+    * `'latest'` - the settings of all the missed runs are merged in order (the latest value of every setting key)
+      and applied by one job function call per settings job function, the jobs are rescheduled after the missed runs,
+    * `'all'` - the missed runs are left due, so every one of them is run in order by the pending jobs loop,
+    * `'skip'` - the jobs are rescheduled after the missed runs without running them.
+
+    :return: number of the missed runs
+    """
+    if policy not in CATCH_UP_POLICIES:
+        raise ValueError(f'Unknown catch-up policy {policy}, expected one of {", ".join(CATCH_UP_POLICIES)}.')
+
+    job_order = {job: i for i, job in enumerate(scheduler.jobs)}
+    jobs = [job for job in jobs if job in job_order]
+    if policy == 'all':
+        return sum(_count_missed_runs(job) for job in jobs)
+
+    missed_runs = []
+    for job in jobs:
+        while job.should_run:
+            missed_runs.append((job.operation_datetime, job_order[job], job))
+            if job.run_once:
+                scheduler.cancel_job(job)
+                break
+            job._schedule_next_run()
+    missed_runs.sort(key=lambda missed_run: missed_run[:2])
+
+    if policy == 'skip':
+        for operation_datetime, _, job in missed_runs:
+            job.logger.info('Skipping the run missed at %s', operation_datetime)
+        return len(missed_runs)
+
+    job_groups = dict()
+    for operation_datetime, _, job in missed_runs:
+        key = coalescing_key(job)
+        job_groups.setdefault(key if key is not None else job, []).append((operation_datetime, job))
+    for missed_job_runs in job_groups.values():
+        group_jobs = [job for _, job in missed_job_runs]
+        job_func = coalesce_job_funcs(group_jobs) \
+            if coalescing_key(group_jobs[0]) is not None \
+            else group_jobs[0].job_func
+        logger.info(
+            'Catching up %d missed runs with the latest settings: %s',
+            len(group_jobs), json.dumps(getattr(job_func, 'keywords', {}).get('settings_dict'), default=str)[:100],
+        )
+        try:
+            _run_func(group_jobs[0], job_func, functools.partial(_record_caught_up_runs, missed_job_runs))
+        except Exception as e:
+            # the missed runs are not journaled, so they are caught up again after the next restart
+            logger.exception('Could not catch up the missed runs [%s]: %s', type(e).__name__, str(e))
+    return len(missed_runs)
+
+
+def _count_missed_runs(job):
+    """
+    Number of the due runs of the job, counted by resolving its next runs until one is not due yet
+    (the job is left due at its first missed run).
+    """
+    state = job.next_run, job.t0_datetime, job.operation_datetime, job.next_t0_datetime
+    count = 0
+    try:
+        while job.should_run:
+            count += 1
+            if job.run_once:
+                break
+            job._schedule_next_run()
+    finally:
+        job.next_run, job.t0_datetime, job.operation_datetime, job.next_t0_datetime = state
+    return count
+
+
+def _record_caught_up_runs(missed_job_runs):
+    latest_missed_runs = dict()
+    for operation_datetime, job in missed_job_runs:
+        job.logger.info('Caught up the run missed at %s', operation_datetime)
+        latest_missed_runs[job] = operation_datetime
+    for job, operation_datetime in latest_missed_runs.items():
+        job.record_run(operation_datetime, done=job.run_once)
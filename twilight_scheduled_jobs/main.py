@@ -6,16 +6,148 @@ import dateutil.parser
 import pytimeparse.timeparse
 import pytz as pytz
 
+from .clock import SYSTEM_CLOCK
 from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob
 from .datetime_variables import DatetimeVariableValuesDictFactory
-from .parser import load_job_settings_dict_yaml, parse_timestamp_syntax
+from .parser import load_job_settings_dict_yaml, parse_timestamp_syntax, compile_datetime_expression
 
-from .jobs import run_job_wrapper, initialize_jobs, run_pending_loop
+from .jobs import run_job_wrapper, initialize_jobs, run_pending_loop, update_jobs
 from .defaults import DEFAULTS
+from .journal import RunJournal, catch_up_missed_runs
+from .metrics import configure_metrics
+from .schedule_file_watcher import ScheduleFileWatcher
 
 DEFAULT_LOGGER_NAME = 'scheduled_twilight_operation'
 
 
+def initialize_schedule_file_jobs(
+        scheduler,
+        schedule_file,
+        datetime_variable_values_dict_factory,
+        settings_job_func,
+        current_datetime,
+        timezone,
+        variable_marker,
+        next_t0_expression,
+        t0_step,
+        job_logger_name_format,
+        logger,
+        run_job_wrapper_func=run_job_wrapper,
+        group_planning=DEFAULTS['group_planning'],
+        scheduled_jobs_dict=None,
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        shard=None,
+        journal=None,
+        catch_up_policy=DEFAULTS['catch_up_policy'],
+):
+    """
+    Load the schedule file and initialize its jobs. With `scheduled_jobs_dict` (the jobs returned
+    by a previous call), the reloaded schedule is applied to the running jobs instead (see update_jobs).
+    With `shard` (shard index, shard count), only every shard count-th key of the file is initialized.
+    With a run `journal`, the jobs are resumed from their last journaled runs and the runs missed
+    since then are handled by the `catch_up_policy` (see catch_up_missed_runs).
+    """
+    job_settings_by_datetime_expression = load_job_settings_dict_yaml(
+        pathname=schedule_file,
+        fallback_timezone=timezone,
+        timestamp_variables=dict(
+            parse_time=current_datetime
+        ),
+        replace_variables=True,
+        skip_missing_variables=True,
+        variable_marker=variable_marker,
+        cache_dir=schedule_cache_dir,
+    )
+    if shard is not None:
+        shard_index, shard_count = shard
+        job_settings_by_datetime_expression = dict(
+            list(job_settings_by_datetime_expression.items())[shard_index::shard_count]
+        )
+
+    next_t0_datetime_expression = compile_datetime_expression(parse_timestamp_syntax(next_t0_expression))
+
+    run_job_wrapper_partial_func = partial(
+        run_job_wrapper_func,
+        settings_job_func=settings_job_func,
+        datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+    )
+
+    create_dict_partial_func = partial(
+        datetime_variable_values_dict_factory.create_dict,
+        use_cache=True,
+    )
+
+    if scheduled_jobs_dict is not None:
+        added, removed, replaced = update_jobs(
+            scheduled_camera_settings_jobs_dict=scheduled_jobs_dict,
+            scheduler=scheduler,
+            start_t0=current_datetime,
+            datetime_expression=job_settings_by_datetime_expression,
+            next_t0_datetime_expression=next_t0_datetime_expression,
+            settings_job_func=run_job_wrapper_partial_func,
+            t0_step=t0_step,
+            create_dict_func=create_dict_partial_func,
+            logger=logger,
+            apply_settings_job_logger_name_format=job_logger_name_format,
+            group_planning=group_planning,
+            journal=journal,
+        )
+        logger.info(
+            'Reloaded %s: %d jobs added, %d removed, %d with changed settings',
+            schedule_file, len(added), len(removed), len(replaced),
+        )
+        return scheduled_jobs_dict
+
+    scheduled_jobs_dict = initialize_jobs(
+        scheduler=scheduler,
+        start_t0=current_datetime,
+        datetime_expression=job_settings_by_datetime_expression,
+        next_t0_datetime_expression=next_t0_datetime_expression,
+        settings_job_func=run_job_wrapper_partial_func,
+        t0_step=t0_step,
+        create_dict_func=create_dict_partial_func,
+        logger=logger,
+        apply_settings_job_logger_name_format=job_logger_name_format,
+        group_planning=group_planning,
+        journal=journal,
+    )
+    if journal is not None:
+        missed_run_count = catch_up_missed_runs(
+            scheduler,
+            [job for job in scheduled_jobs_dict.values() if job.resumed],
+            policy=catch_up_policy,
+            logger=logger,
+        )
+        if missed_run_count:
+            logger.info(
+                '%d runs missed since the last journaled runs (catch-up policy %s)', missed_run_count, catch_up_policy,
+            )
+    return scheduled_jobs_dict
+
+
+def create_schedule_file_watcher(
+        initialize_schedule_file_jobs_func,
+        schedule_file,
+        scheduled_jobs_dict,
+        timezone,
+        poll_interval=DEFAULTS['watch_poll_interval'],
+        logger=None,
+        clock=SYSTEM_CLOCK,
+):
+    """
+    Watcher reloading the schedule file into the running jobs, `initialize_schedule_file_jobs_func` is
+    initialize_schedule_file_jobs with all the arguments except current_datetime and scheduled_jobs_dict.
+    The reloaded jobs start at the current time of `clock` (the clock of the scheduler).
+    """
+    def reload_schedule_file():
+        initialize_schedule_file_jobs_func(
+            current_datetime=clock.now_aware().astimezone(timezone),
+            scheduled_jobs_dict=scheduled_jobs_dict,
+        )
+
+    return ScheduleFileWatcher(schedule_file, reload_schedule_file, poll_interval=poll_interval, logger=logger)
+
+
 def twilight_scheduled_jobs_main(
         schedule_file,
         station_geographic_position,
@@ -26,7 +158,26 @@ def twilight_scheduled_jobs_main(
         next_t0_expression=DEFAULTS['next_t0_expression'],
         delta_t=DEFAULTS['delta_t'],
         t0_step=DEFAULTS['t0_step'],
+        group_planning=DEFAULTS['group_planning'],
+        horizon=DEFAULTS['horizon'],
+        event_store_dir=DEFAULTS['event_store_dir'],
+        ephemeris=DEFAULTS['ephemeris'],
+        lazy_ephemeris=DEFAULTS['lazy_ephemeris'],
+        engine=DEFAULTS['engine'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        journal_file=DEFAULTS['journal_file'],
+        journal_fsync_interval=DEFAULTS['journal_fsync_interval'],
+        catch_up_policy=DEFAULTS['catch_up_policy'],
         schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        deadline_driven=DEFAULTS['deadline_driven'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        coalesce_window=DEFAULTS['coalesce_window'],
+        executor=None,
+        metrics_sinks=None,
+        metrics_export_interval=DEFAULTS['metrics_export_interval'],
+        watch_schedule_file=DEFAULTS['watch_schedule_file'],
+        watch_poll_interval=DEFAULTS['watch_poll_interval'],
         job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
         logger=None,
 ):
@@ -42,58 +193,78 @@ def twilight_scheduled_jobs_main(
         else current_datetime
 
     timezone = pytz.timezone(timezone)
-    job_settings_by_datetime_expression = load_job_settings_dict_yaml(
-        pathname=schedule_file,
-        fallback_timezone=timezone,
-        timestamp_variables=dict(
-            parse_time=datetime.datetime.now(timezone)
-        ),
-        replace_variables=True,
-        skip_missing_variables=True,
-        variable_marker=variable_marker,
-    )
-
-    next_t0_datetime_expression = parse_timestamp_syntax(next_t0_expression)
     delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
     t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+    horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon)) \
+        if horizon is not None \
+        else None
 
     datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
         station_geographic_position=station_geographic_position,
         timezone=timezone,
-        delta_t=delta_t
+        delta_t=delta_t,
+        horizon=horizon,
+        event_store=event_store_dir,
+        eph=ephemeris,
+        lazy_ephemeris=lazy_ephemeris,
+        engine=engine,
+        missing_event_policy=missing_event_policy,
     )
 
-    run_job_wrapper_partial_func = partial(
-        run_job_wrapper,
-        settings_job_func=settings_job_func,
-        datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+    scheduler = CustomizableScheduler(
+        job_class=FloatingNextRunJob, executor=executor, coalesce_window=coalesce_window,
     )
+    journal = RunJournal(journal_file, fsync_interval=journal_fsync_interval, logger=logger) \
+        if journal_file is not None \
+        else None
 
-    create_dict_partial_func = partial(
-        datetime_variable_values_dict_factory.create_dict,
-        use_cache=True,
+    initialize_schedule_file_jobs_partial_func = partial(
+        initialize_schedule_file_jobs,
+        scheduler=scheduler,
+        schedule_file=schedule_file,
+        datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+        settings_job_func=settings_job_func,
+        timezone=timezone,
+        variable_marker=variable_marker,
+        next_t0_expression=next_t0_expression,
+        t0_step=t0_step,
+        group_planning=group_planning,
+        schedule_cache_dir=schedule_cache_dir,
+        job_logger_name_format=job_logger_name_format,
+        logger=logger,
+        journal=journal,
+    )
+    scheduled_camera_settings_jobs_dict = initialize_schedule_file_jobs_partial_func(
+        current_datetime=current_datetime,
+        catch_up_policy=catch_up_policy,
     )
 
-    scheduler = CustomizableScheduler(job_class=FloatingNextRunJob)
+    watchers = [
+        create_schedule_file_watcher(
+            initialize_schedule_file_jobs_partial_func, schedule_file, scheduled_camera_settings_jobs_dict, timezone,
+            poll_interval=watch_poll_interval, logger=logger, clock=scheduler.clock,
+        )
+    ] \
+        if watch_schedule_file \
+        else []
+    if journal is not None:
+        # fsyncs the journaled runs in batches
+        watchers.append(journal)
 
-    scheduled_camera_settings_jobs_dict = \
-        initialize_jobs(
+    configure_metrics(sinks=metrics_sinks, export_interval=metrics_export_interval)
+
+    try:
+        run_pending_loop(
             scheduler=scheduler,
-            start_t0=current_datetime,
-            datetime_expression=job_settings_by_datetime_expression,
-            next_t0_datetime_expression=next_t0_datetime_expression,
-            settings_job_func=run_job_wrapper_partial_func,
-            t0_step=t0_step,
-            create_dict_func=create_dict_partial_func,
             logger=logger,
-            apply_settings_job_logger_name_format=job_logger_name_format,
+            schedule_pending_check_interval=schedule_pending_check_interval,
+            deadline_driven=deadline_driven,
+            max_sleep_interval=max_sleep_interval,
+            watchers=watchers,
         )
-
-    run_pending_loop(
-        scheduler=scheduler,
-        logger=logger,
-        schedule_pending_check_interval=schedule_pending_check_interval,
-    )
+    finally:
+        if journal is not None:
+            journal.close()
 
     # returns when safe termination flag is set or KeyboardInterrupt caught in run_pending_loop
     return scheduled_camera_settings_jobs_dict
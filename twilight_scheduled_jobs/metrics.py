@@ -0,0 +1,229 @@
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300.)
+
+
+class Counter:
+
+    type_name = 'counter'
+
+    def __init__(self, name, help_text=''):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return dict(type=self.type_name, help=self.help_text, value=self.value)
+
+
+class Histogram:
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _HistogramTimer(self)
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative_counts = []
+        cumulative_count = 0
+        for bucket_count in counts:
+            cumulative_count += bucket_count
+            cumulative_counts.append(cumulative_count)
+        return dict(
+            type=self.type_name, help=self.help_text,
+            buckets=dict(zip([*self.buckets, float('inf')], cumulative_counts)),
+            sum=total, count=count,
+        )
+
+
+class _HistogramTimer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.tic)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Metrics of the scheduler, exported to the sinks every `export_interval` seconds by run_pending_loop.
+    """
+
+    def __init__(self, export_interval=60.):
+        self.metrics = dict()
+        self.sinks = []
+        self.export_interval = export_interval
+        self.last_export = None
+        self.logger = logging.getLogger('twilight_scheduled_jobs.metrics')
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text=''):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def export(self):
+        self.last_export = time.monotonic()
+        if not self.sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in list(self.sinks):
+            try:
+                sink.export(snapshot)
+            except Exception as e:
+                self.logger.exception('Could not export metrics to %s [%s]: %s', sink, type(e).__name__, str(e))
+
+    def export_if_due(self):
+        if not self.sinks:
+            return
+        if self.last_export is None or time.monotonic() - self.last_export >= self.export_interval:
+            self.export()
+
+
+class CallbackSink:
+    """
+    Passes the metrics snapshot (a dict keyed by the metric name) to a callback.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, snapshot):
+        self.callback(snapshot)
+
+
+def _format_prometheus_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_prometheus_text(snapshot):
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        if metric['type'] == Histogram.type_name:
+            for bucket, cumulative_count in metric['buckets'].items():
+                lines.append(f'{name}_bucket{{le="{_format_prometheus_value(bucket)}"}} {cumulative_count}')
+            lines.append(f'{name}_sum {_format_prometheus_value(metric["sum"])}')
+            lines.append(f'{name}_count {metric["count"]}')
+        else:
+            lines.append(f'{name} {_format_prometheus_value(metric["value"])}')
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextfileSink:
+    """
+    Writes the metrics in the Prometheus text format (e.g. for the node_exporter textfile collector).
+    The file is replaced atomically.
+    """
+
+    def __init__(self, pathname):
+        self.pathname = os.path.expanduser(pathname)
+
+    def export(self, snapshot):
+        directory = os.path.dirname(os.path.abspath(self.pathname))
+        file_descriptor, temporary_pathname = tempfile.mkstemp(dir=directory, prefix='.metrics', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                f.write(format_prometheus_text(snapshot))
+            os.chmod(temporary_pathname, 0o644)
+            os.replace(temporary_pathname, self.pathname)
+        except BaseException:
+            if os.path.exists(temporary_pathname):
+                os.remove(temporary_pathname)
+            raise
+
+
+REGISTRY = MetricsRegistry()
+
+job_dispatch_lateness_seconds = REGISTRY.histogram(
+    'twilight_job_dispatch_lateness_seconds', 'Delay between the scheduled next_run and the actual job run.',
+)
+job_duration_seconds = REGISTRY.histogram(
+    'twilight_job_duration_seconds', 'Duration of the job function.',
+)
+jobs_run_total = REGISTRY.counter('twilight_jobs_run_total', 'Jobs run.')
+jobs_coalesced_total = REGISTRY.counter(
+    'twilight_jobs_coalesced_total', 'Jobs run by the job function call of a job due within the coalescing window.',
+)
+job_schedule_seconds = REGISTRY.histogram(
+    'twilight_job_schedule_seconds', 'Duration of the job rescheduling (_schedule_next_run).',
+)
+skipped_cycles_total = REGISTRY.counter('twilight_skipped_cycles_total', 'Cycles skipped because of missing events.')
+create_dict_compute_seconds = REGISTRY.histogram(
+    'twilight_create_dict_compute_seconds', 'Duration of the create_dict calls not served from the cache.',
+)
+event_compute_seconds = REGISTRY.histogram(
+    'twilight_event_compute_seconds', 'Duration of the ephemeris event searches (find_discrete or an engine).',
+)
+variable_cache_hits_total = REGISTRY.counter('twilight_variable_cache_hits_total', 'Variable values cache hits.')
+variable_cache_misses_total = REGISTRY.counter('twilight_variable_cache_misses_total', 'Variable values cache misses.')
+loop_wakeups_total = REGISTRY.counter('twilight_loop_wakeups_total', 'Iterations of the pending jobs loop.')
+loop_sleep_seconds = REGISTRY.histogram(
+    'twilight_loop_sleep_seconds', 'Sleep intervals requested by the pending jobs loop.',
+)
+loop_errors_total = REGISTRY.counter('twilight_loop_errors_total', 'Errors caught by the pending jobs loop.')
+
+
+def configure_metrics(sinks=None, export_interval=None, registry=REGISTRY):
+    """
+    Add the sinks (e.g. from the main functions' metrics_sinks argument) to the registry.
+    """
+    if export_interval is not None:
+        registry.export_interval = export_interval
+    for sink in sinks or []:
+        if sink not in registry.sinks:
+            registry.add_sink(sink)
+    return registry
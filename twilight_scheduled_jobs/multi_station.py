@@ -0,0 +1,347 @@
+import datetime
+import logging
+import threading
+from functools import partial
+
+import dateutil.parser
+import numpy as np
+import pytimeparse.timeparse
+import pytz
+import skyfield.api
+from skyfield import almanac
+from skyfield.nutationlib import iau2000b_radians
+
+from .datetime_variables import DatetimeVariableValuesDictFactory
+from .defaults import DEFAULTS
+from .engines import (
+    TWILIGHT_THRESHOLDS_DEGREES, EventEngine, skyfield_altitudes, skyfield_moon_illuminations,
+)
+from .ephemeris import DEFAULT_EPHEMERIS, load_ephemeris
+from .event_table import (
+    EventTable, ONE_MICROSECOND, epoch_us_to_datetime, epoch_us_to_skyfield_times, skyfield_times_to_epoch_us,
+)
+from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob
+from .jobs import run_pending_loop
+from .main import DEFAULT_LOGGER_NAME, create_schedule_file_watcher, initialize_schedule_file_jobs
+from .metrics import configure_metrics
+from .skyfield_demo_calculaton import station_locations as default_station_locations
+from .variables import SUN
+
+EARTH_RADIUS_KM = 6378.137
+
+
+class StationGroupEvents:
+    """
+    Sun transits and twilight transitions computed for a group of stations at once.
+    The apparent position of the Sun is evaluated once per time sample for all the stations,
+    the changes found on the sampling grid are refined by a vectorized bisection of all brackets together.
+    """
+
+    families = (
+        DatetimeVariableValuesDictFactory.sun_transit_family,
+        DatetimeVariableValuesDictFactory.twilight_family,
+    )
+
+    def __init__(
+            self, station_geographic_positions,
+            eph=None,
+            ts=None,
+            step=datetime.timedelta(minutes=30),
+            epsilon=datetime.timedelta(milliseconds=1),
+            max_gap=datetime.timedelta(days=2),
+    ):
+        self.station_names = list(station_geographic_positions.keys())
+        self.station_geographic_positions = station_geographic_positions
+        self.eph = load_ephemeris(eph if eph is not None else DEFAULT_EPHEMERIS)
+        self.ts = ts if ts is not None else skyfield.api.load.timescale()
+        self.step = step
+        self.epsilon = epsilon
+        self.max_gap = max_gap
+
+        self.latitudes_radians = np.array([
+            station_geographic_positions[station_name].latitude.radians
+            for station_name in self.station_names
+        ])
+        self.longitudes_degrees = np.array([
+            station_geographic_positions[station_name].longitude.degrees
+            for station_name in self.station_names
+        ])
+
+        self.event_tables = {
+            station_name: {family: EventTable() for family in self.families}
+            for station_name in self.station_names
+        }
+        self._coverage = EventTable()
+        self._lock = threading.Lock()
+
+    def _sun_position(self, t):
+        t._nutation_angles_radians = iau2000b_radians(t)
+        ra, dec, distance = (self.eph['earth']).at(t).observe(self.eph['sun']).apparent().radec(epoch='date')
+        # Greenwich hour angle in degrees, the local hour angle is obtained by adding the station longitude
+        greenwich_hour_angle_degrees = (t.gast - ra.hours) * 15.0
+        horizontal_parallax = np.arcsin(EARTH_RADIUS_KM / distance.km)
+        return greenwich_hour_angle_degrees, dec.radians, horizontal_parallax
+
+    def _sun_altitude_degrees(self, sun_position, latitudes, longitudes_degrees):
+        greenwich_hour_angle_degrees, declination, horizontal_parallax = sun_position
+        hour_angle = np.radians(greenwich_hour_angle_degrees + longitudes_degrees)
+        sin_altitude = (
+                np.sin(latitudes) * np.sin(declination) +
+                np.cos(latitudes) * np.cos(declination) * np.cos(hour_angle)
+        )
+        geocentric_altitude = np.arcsin(np.clip(sin_altitude, -1.0, 1.0))
+        # topocentric altitude as used by almanac.dark_twilight_day
+        return np.degrees(geocentric_altitude - horizontal_parallax * np.cos(geocentric_altitude))
+
+    @staticmethod
+    def _west_of_meridian(sun_position, longitudes_degrees):
+        greenwich_hour_angle_degrees = sun_position[0]
+        return (greenwich_hour_angle_degrees + longitudes_degrees) % 360.0 < 180.0
+
+    def _bisect(self, lo_tt, hi_tt, hi_state, state_func):
+        epsilon_days = self.epsilon / datetime.timedelta(days=1)
+        while len(lo_tt) > 0 and np.max(hi_tt - lo_tt) > epsilon_days:
+            mid_tt = (lo_tt + hi_tt) / 2.0
+            is_hi_state = state_func(self._sun_position(self.ts.tt_jd(mid_tt))) == hi_state
+            hi_tt = np.where(is_hi_state, mid_tt, hi_tt)
+            lo_tt = np.where(is_hi_state, lo_tt, mid_tt)
+        return hi_tt
+
+    def _compute_range(self, start_us, end_us):
+        t_start = self.ts.from_datetime(epoch_us_to_datetime(start_us, pytz.UTC))
+        t_end = self.ts.from_datetime(epoch_us_to_datetime(end_us, pytz.UTC))
+        step_days = self.step / datetime.timedelta(days=1)
+        sample_count = max(int(np.ceil((t_end.tt - t_start.tt) / step_days)), 1) + 1
+        grid_tt = np.linspace(t_start.tt, t_end.tt, sample_count)
+
+        sun_position = self._sun_position(self.ts.tt_jd(grid_tt))
+
+        # shape (stations, samples)
+        latitudes = self.latitudes_radians[:, None]
+        longitudes = self.longitudes_degrees[:, None]
+        altitudes = self._sun_altitude_degrees(sun_position, latitudes, longitudes)
+        west_of_meridian = self._west_of_meridian(sun_position, longitudes)
+
+        # transits: brackets where the west of meridian flag changes
+        station_i, sample_i = np.nonzero(west_of_meridian[:, 1:] != west_of_meridian[:, :-1])
+        transit_hi_state = west_of_meridian[station_i, sample_i + 1]
+        transit_tt = self._bisect(
+            grid_tt[sample_i], grid_tt[sample_i + 1], transit_hi_state,
+            lambda position, s=station_i: self._west_of_meridian(position, self.longitudes_degrees[s]),
+        )
+        transit_station_i = station_i
+        transit_codes = transit_hi_state.astype(int)  # 1 meridian transit, 0 antimeridian transit
+
+        # twilight: brackets where the Sun crosses any of the thresholds, refined all at once
+        above = altitudes[:, :, None] >= TWILIGHT_THRESHOLDS_DEGREES[None, None, :]
+        station_i, sample_i, threshold_i = np.nonzero(above[:, 1:, :] != above[:, :-1, :])
+        twilight_hi_state = above[station_i, sample_i + 1, threshold_i]
+        twilight_tt = self._bisect(
+            grid_tt[sample_i], grid_tt[sample_i + 1], twilight_hi_state,
+            lambda position, s=station_i, h=threshold_i: self._sun_altitude_degrees(
+                position, self.latitudes_radians[s], self.longitudes_degrees[s],
+            ) >= TWILIGHT_THRESHOLDS_DEGREES[h],
+        )
+        twilight_station_i = station_i
+        # crossing the threshold h separates the states h and h + 1
+        previous_states = np.where(twilight_hi_state, threshold_i, threshold_i + 1)
+        states = np.where(twilight_hi_state, threshold_i + 1, threshold_i)
+        twilight_codes = previous_states * len(almanac.TWILIGHTS) + states
+
+        transit_us = skyfield_times_to_epoch_us(self.ts.tt_jd(transit_tt))
+        twilight_us = skyfield_times_to_epoch_us(self.ts.tt_jd(twilight_tt))
+
+        events = dict()
+        for station_index, station_name in enumerate(self.station_names):
+            station_events = dict()
+            for family, times_us, codes, station_indices in (
+                    (self.families[0], transit_us, transit_codes, transit_station_i),
+                    (self.families[1], twilight_us, twilight_codes, twilight_station_i),
+            ):
+                selected = station_indices == station_index
+                order = np.argsort(times_us[selected], kind='stable')
+                station_events[family] = (times_us[selected][order], codes[selected][order])
+            events[station_name] = station_events
+        return events
+
+    def compute_events(self, station_name, family, start_us, end_us):
+        with self._lock:
+            if not self._coverage.covers(start_us, end_us):
+                max_gap_us = self.max_gap // ONE_MICROSECOND
+                for missing_start_us, missing_end_us in self._coverage.missing_ranges(
+                        start_us, end_us, max_gap=max_gap_us):
+                    events = self._compute_range(missing_start_us, missing_end_us)
+                    for events_station_name, station_events in events.items():
+                        for events_family, (times_us, codes) in station_events.items():
+                            self.event_tables[events_station_name][events_family].merge(
+                                times_us, codes, missing_start_us, missing_end_us
+                            )
+                    self._coverage.merge([], [], missing_start_us, missing_end_us)
+            return self.event_tables[station_name][family].events_between(start_us, end_us)
+
+    def engine(self, station_name):
+        return StationEventEngine(self, station_name)
+
+
+class StationEventEngine(EventEngine):
+    """
+    Events of a single station of a StationGroupEvents, to be used as the DatetimeVariableValuesDictFactory engine.
+    """
+
+    name = 'station_group'
+
+    def __init__(self, station_group_events, station_name):
+        self.station_group_events = station_group_events
+        self.station_name = station_name
+
+    def compute_events(self, family, start_us, end_us):
+        return self.station_group_events.compute_events(self.station_name, family, start_us, end_us)
+
+    def altitudes(self, body, times_us):
+        station_group_events = self.station_group_events
+        if body != SUN:
+            return skyfield_altitudes(
+                station_group_events.eph, station_group_events.ts,
+                station_group_events.station_geographic_positions[self.station_name], body, times_us,
+            )
+        station_index = station_group_events.station_names.index(self.station_name)
+        t = epoch_us_to_skyfield_times(station_group_events.ts, times_us)
+        return station_group_events._sun_altitude_degrees(
+            station_group_events._sun_position(t),
+            station_group_events.latitudes_radians[station_index],
+            station_group_events.longitudes_degrees[station_index],
+        )
+
+    def moon_illuminations(self, times_us):
+        station_group_events = self.station_group_events
+        return skyfield_moon_illuminations(
+            station_group_events.eph, station_group_events.ts,
+            station_group_events.station_geographic_positions[self.station_name], times_us,
+        )
+
+
+def twilight_scheduled_jobs_multi_station_main(
+        schedule_files,
+        settings_job_func,
+        station_geographic_positions=None,
+        current_datetime=None,
+        timezone=DEFAULTS['timezone'],
+        variable_marker=DEFAULTS['variable_marker'],
+        next_t0_expression=DEFAULTS['next_t0_expression'],
+        delta_t=DEFAULTS['delta_t'],
+        t0_step=DEFAULTS['t0_step'],
+        group_planning=DEFAULTS['group_planning'],
+        horizon=DEFAULTS['horizon'],
+        ephemeris=DEFAULTS['ephemeris'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        deadline_driven=DEFAULTS['deadline_driven'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        coalesce_window=DEFAULTS['coalesce_window'],
+        executor=None,
+        metrics_sinks=None,
+        metrics_export_interval=DEFAULTS['metrics_export_interval'],
+        watch_schedule_file=DEFAULTS['watch_schedule_file'],
+        watch_poll_interval=DEFAULTS['watch_poll_interval'],
+        job_logger_name_format=DEFAULTS['multi_station_scheduled_job_logger_name_format'],
+        logger=None,
+):
+    """
+    Run the jobs of several stations in a single scheduler.
+    `schedule_files` maps station names to schedule files, the station positions are looked up
+    in `station_geographic_positions` (skyfield_demo_calculaton.station_locations by default).
+    The settings job function receives the station name as the `station_name` keyword argument.
+    """
+    if station_geographic_positions is None:
+        station_geographic_positions = default_station_locations
+
+    current_datetime = dateutil.parser.parse(current_datetime) \
+        if isinstance(current_datetime, str) \
+        else current_datetime
+
+    if logger is None:
+        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+    current_datetime = datetime.datetime.now(pytz.timezone(timezone)) \
+        if current_datetime is None \
+        else current_datetime
+
+    timezone = pytz.timezone(timezone)
+    delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
+    t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+    horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon)) \
+        if horizon is not None \
+        else None
+
+    ts = skyfield.api.load.timescale()
+    station_group_events = StationGroupEvents(
+        station_geographic_positions={
+            station_name: station_geographic_positions[station_name]
+            for station_name in schedule_files
+        },
+        eph=ephemeris,
+        ts=ts,
+        max_gap=max(delta_t, horizon or datetime.timedelta(0)),
+    )
+
+    scheduler = CustomizableScheduler(
+        job_class=FloatingNextRunJob, executor=executor, coalesce_window=coalesce_window,
+    )
+
+    scheduled_camera_settings_jobs_dicts = dict()
+    watchers = []
+    for station_name, schedule_file in schedule_files.items():
+        datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+            station_geographic_position=station_geographic_positions[station_name],
+            timezone=timezone,
+            delta_t=delta_t,
+            ts=ts,
+            horizon=horizon,
+            eph=station_group_events.eph,
+            lazy_ephemeris=True,
+            engine=station_group_events.engine(station_name),
+            missing_event_policy=missing_event_policy,
+        )
+        initialize_schedule_file_jobs_partial_func = partial(
+            initialize_schedule_file_jobs,
+            scheduler=scheduler,
+            schedule_file=schedule_file,
+            datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+            settings_job_func=partial(settings_job_func, station_name=station_name),
+            timezone=timezone,
+            variable_marker=variable_marker,
+            next_t0_expression=next_t0_expression,
+            t0_step=t0_step,
+            group_planning=group_planning,
+            schedule_cache_dir=schedule_cache_dir,
+            job_logger_name_format=job_logger_name_format.format(
+                station_name=station_name,
+                datetime_expression='{datetime_expression}',
+                settings_hash='{settings_hash}',
+            ),
+            logger=logger,
+        )
+        scheduled_camera_settings_jobs_dicts[station_name] = initialize_schedule_file_jobs_partial_func(
+            current_datetime=current_datetime
+        )
+        if watch_schedule_file:
+            watchers.append(create_schedule_file_watcher(
+                initialize_schedule_file_jobs_partial_func, schedule_file,
+                scheduled_camera_settings_jobs_dicts[station_name], timezone,
+                poll_interval=watch_poll_interval, logger=logger, clock=scheduler.clock,
+            ))
+
+    configure_metrics(sinks=metrics_sinks, export_interval=metrics_export_interval)
+
+    run_pending_loop(
+        scheduler=scheduler,
+        logger=logger,
+        schedule_pending_check_interval=schedule_pending_check_interval,
+        deadline_driven=deadline_driven,
+        max_sleep_interval=max_sleep_interval,
+        watchers=watchers,
+    )
+
+    # returns when safe termination flag is set or KeyboardInterrupt caught in run_pending_loop
+    return scheduled_camera_settings_jobs_dicts
@@ -21,7 +21,10 @@ def resolve_next_t0_datetime(
         next_t0_datetime_expression,
         datetime_variable_values
     )
-    if operation_datetime > next_t0_datetime:
+    # the event can be found several cycles ahead (e.g. at the edge of the polar day),
+    # the job continues with the cycle after it
+    while operation_datetime > next_t0_datetime:
+        previous_next_t0_datetime = next_t0_datetime
         datetime_variable_values = create_dict_func(
             t0_datetime=next_t0_datetime + interval_timedelta,
             required_variable_names=required_variable_names
@@ -30,9 +33,9 @@ def resolve_next_t0_datetime(
             next_t0_datetime_expression,
             datetime_variable_values
         )
-        if next_t0_datetime < operation_datetime:
+        if next_t0_datetime <= previous_next_t0_datetime:
             # Unexpected state, should not happen
-            raise RuntimeError('Cannot continue. next_t0_datetime < operation_datetime.')
+            raise RuntimeError('Cannot continue. next_t0_datetime does not advance.')
 
     return next_t0_datetime
 
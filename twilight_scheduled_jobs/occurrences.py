@@ -0,0 +1,209 @@
+import csv
+import datetime
+import heapq
+import itertools
+import json
+from functools import partial
+
+import dateutil.parser
+import pytimeparse.timeparse
+import pytz
+
+from .datetime_variables import DatetimeVariableValuesDictFactory
+from .defaults import DEFAULTS
+from .floating_next_run_job import FloatingNextRunJob
+from .parser import (
+    MissingEventError, compile_datetime_expression, find_variables, load_job_settings_dict_yaml, parse_timestamp_syntax,
+    slugify_datetime_expression,
+)
+from .planner import ScheduleGroupPlanner
+
+OCCURRENCE_FIELD_NAMES = ('datetime', 'datetime_expression', 'settings')
+
+
+def _iter_expression_occurrences(planner, datetime_expression, start_datetime, end_datetime):
+    """
+    Operation datetimes of one expression from the cycle starting at `start_datetime`,
+    resolved as by FloatingNextRunJob (the cycles with a missing event are skipped).
+    """
+    run_once = len(find_variables(datetime_expression)) == 0
+    t0_datetime = start_datetime
+    while True:
+        for skipped_cycles in range(FloatingNextRunJob.max_skipped_cycles + 1):
+            try:
+                operation_datetime = planner.resolve_operation_datetime(t0_datetime, datetime_expression)
+                break
+            except MissingEventError:
+                if skipped_cycles == FloatingNextRunJob.max_skipped_cycles:
+                    raise
+                # skip the job in this cycle (e.g. no astronomical night at high latitudes in summer)
+                t0_datetime = planner.resolve_next_t0_datetime(t0_datetime, t0_datetime)
+                if t0_datetime >= end_datetime:
+                    return
+        if operation_datetime >= end_datetime:
+            return
+        if operation_datetime >= start_datetime:
+            yield operation_datetime
+        if run_once:
+            return
+        t0_datetime = planner.resolve_next_t0_datetime(t0_datetime, operation_datetime)
+
+
+def iter_occurrences(
+        job_settings_by_datetime_expression,
+        station_geographic_position,
+        start_datetime,
+        end_datetime,
+        timezone=DEFAULTS['timezone'],
+        next_t0_expression=DEFAULTS['next_t0_expression'],
+        delta_t=DEFAULTS['delta_t'],
+        t0_step=DEFAULTS['t0_step'],
+        horizon=None,
+        event_store_dir=DEFAULTS['event_store_dir'],
+        ephemeris=DEFAULTS['ephemeris'],
+        engine=DEFAULTS['engine'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        datetime_variable_values_dict_factory=None,
+):
+    """
+    Lazy generator of the occurrences of the jobs of a schedule (as returned by load_job_settings_dict_yaml)
+    between `start_datetime` and `end_datetime`, without running a scheduler:
+    (operation datetime in `timezone`, datetime expression, settings dict) tuples in time order
+    (the jobs due at the same time in the order of the schedule).
+
+    The events of the whole range are computed at once unless `horizon` is set (then in chunks of the horizon)
+    and all the expressions of a cycle are evaluated with one variable values dict (see ScheduleGroupPlanner).
+    Occurrences resolved before `start_datetime` (that a started scheduler would run late) are not included.
+    """
+    start_datetime, end_datetime = [
+        dateutil.parser.parse(value) if isinstance(value, str) else value
+        for value in (start_datetime, end_datetime)
+    ]
+    timezone = pytz.timezone(timezone)
+    start_datetime, end_datetime = [
+        timezone.localize(value) if value.tzinfo is None else value
+        for value in (start_datetime, end_datetime)
+    ]
+    t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+
+    if datetime_variable_values_dict_factory is None:
+        delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
+        horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon)) \
+            if horizon is not None \
+            else end_datetime - start_datetime + 2 * delta_t
+        datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+            station_geographic_position=station_geographic_position,
+            timezone=timezone,
+            delta_t=delta_t,
+            horizon=horizon,
+            event_store=event_store_dir,
+            eph=ephemeris,
+            engine=engine,
+            missing_event_policy=missing_event_policy,
+            # the occurrences are computed on the critical path anyway
+            background_extension=False,
+        )
+
+    datetime_expressions = [
+        compile_datetime_expression(datetime_expression) for datetime_expression in job_settings_by_datetime_expression
+    ]
+    planner = ScheduleGroupPlanner(
+        datetime_expressions=datetime_expressions,
+        next_t0_datetime_expression=parse_timestamp_syntax(next_t0_expression),
+        create_dict_func=partial(datetime_variable_values_dict_factory.create_dict, use_cache=True),
+        t0_step=t0_step,
+    )
+    settings_dicts = list(job_settings_by_datetime_expression.values())
+
+    # the chains of the expressions advance together in time, so they share the planned cycles
+    occurrences = heapq.merge(*(
+        zip(
+            _iter_expression_occurrences(planner, datetime_expression, start_datetime, end_datetime),
+            itertools.repeat(expression_index),
+        )
+        for expression_index, datetime_expression in enumerate(datetime_expressions)
+    ))
+    for operation_datetime, expression_index in occurrences:
+        yield (
+            operation_datetime.astimezone(timezone),
+            datetime_expressions[expression_index],
+            settings_dicts[expression_index],
+        )
+
+
+def schedule_file_occurrences(
+        schedule_file,
+        station_geographic_position,
+        start_datetime,
+        end_datetime,
+        timezone=DEFAULTS['timezone'],
+        variable_marker=DEFAULTS['variable_marker'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        **kwargs
+):
+    """
+    Lazy generator of the occurrences of the jobs of a schedule file (see iter_occurrences),
+    the file is loaded as by the scheduler started at `start_datetime`.
+    """
+    if isinstance(start_datetime, str):
+        start_datetime = dateutil.parser.parse(start_datetime)
+    if start_datetime.tzinfo is None:
+        start_datetime = pytz.timezone(timezone).localize(start_datetime)
+    job_settings_by_datetime_expression = load_job_settings_dict_yaml(
+        pathname=schedule_file,
+        fallback_timezone=timezone,
+        timestamp_variables=dict(
+            parse_time=start_datetime
+        ),
+        replace_variables=True,
+        skip_missing_variables=True,
+        variable_marker=variable_marker,
+        cache_dir=schedule_cache_dir,
+    )
+    return iter_occurrences(
+        job_settings_by_datetime_expression,
+        station_geographic_position=station_geographic_position,
+        start_datetime=start_datetime,
+        end_datetime=end_datetime,
+        timezone=timezone,
+        **kwargs
+    )
+
+
+def _occurrence_row(occurrence):
+    operation_datetime, datetime_expression, settings_dict = occurrence
+    return operation_datetime.isoformat(), slugify_datetime_expression(datetime_expression), settings_dict
+
+
+def write_occurrences_csv(occurrences, f):
+    """
+    Write the occurrences to the text file `f` as CSV rows of the datetime (ISO 8601), the slug of the datetime
+    expression and the settings dict (JSON), as they are generated.
+
+    :return: number of the written occurrences
+    """
+    writer = csv.writer(f)
+    writer.writerow(OCCURRENCE_FIELD_NAMES)
+    count = 0
+    for occurrence in occurrences:
+        operation_datetime_str, datetime_expression_slug, settings_dict = _occurrence_row(occurrence)
+        writer.writerow((operation_datetime_str, datetime_expression_slug, json.dumps(settings_dict, default=str)))
+        count += 1
+    return count
+
+
+def write_occurrences_json(occurrences, f):
+    """
+    Write the occurrences to the text file `f` as a JSON list of objects with the datetime (ISO 8601),
+    the slug of the datetime expression and the settings dict, as they are generated.
+
+    :return: number of the written occurrences
+    """
+    f.write('[')
+    count = 0
+    for occurrence in occurrences:
+        f.write(',\n' if count else '\n')
+        f.write(json.dumps(dict(zip(OCCURRENCE_FIELD_NAMES, _occurrence_row(occurrence))), default=str))
+        count += 1
+    f.write('\n]\n' if count else ']\n')
+    return count
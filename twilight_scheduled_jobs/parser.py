@@ -1,10 +1,36 @@
 import datetime
+import functools
 import operator
 
-import dateutil.parser
 import pytimeparse.timeparse
 import pytz
-import yaml
+
+from .schedule_cache import CompiledScheduleCache
+from .variables import NUMBER_VARIABLE_NAMES
+
+# numpy, dateutil and yaml are imported by the functions using them, so that parsing the timestamp syntax
+# (e.g. in validation tools) does not import them
+
+
+def _yaml_loader():
+    import yaml
+
+    # the C (libyaml) loader is several times faster than the pure Python one
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class MissingEventError(ValueError):
+    """
+    The event of a variable does not occur in the searched window (e.g. no astronomical night at high latitudes).
+    """
+    pass
+
+
+def _missing_variable_error(variable_name, variable_values_dict):
+    if variable_name in getattr(variable_values_dict, 'skipped_variable_names', ()):
+        return MissingEventError(f'Event of variable {variable_name} does not occur in the searched window.')
+    return ValueError(f'Variable {variable_name} not found in timestamp variables.')
+
 
 def parse_timestamp_syntax(
         settings_operation_key,
@@ -31,6 +57,8 @@ def parse_timestamp_syntax(
                 if base_time_present:
                     raise ValueError(f'Variable {subpart_stripped} found after base time was already recognized.')
                 variable_name = subpart_stripped[1:]
+                if variable_name in NUMBER_VARIABLE_NAMES:
+                    raise ValueError(f'Variable {variable_name} is a number, it cannot be the base of a datetime.')
                 if replace_variables:
                     if timestamp_variables is None:
                         raise ValueError('Timestamp variables must be specified if replace_variables is True.')
@@ -44,21 +72,136 @@ def parse_timestamp_syntax(
                     parsed_timestamp_expression.append(variable_name)
                 base_time_present = True
             else:
-                maybe_seconds = pytimeparse.timeparse.timeparse(subpart_stripped)
-                if maybe_seconds is not None:
-                    parsed_timestamp_expression.append(datetime.timedelta(seconds=maybe_seconds))
-                else:
-                    try:
-                        base_time = dateutil.parser.parse(subpart_stripped)
-                        if base_time.tzinfo is None:
-                            base_time = fallback_timezone.localize(base_time)
-                    except Exception as e:
-                        raise ValueError(f'Could not parse {subpart_stripped} as a datetime.') from e
-                    parsed_timestamp_expression.append(base_time)
+                parsed_timestamp_expression.append(_parse_constant(subpart_stripped, fallback_timezone))
     return tuple(parsed_timestamp_expression)
 
 
+def _parse_datetime(value):
+    if len(value) >= 10 and value[4] == '-':
+        # fast path of ISO 8601 timestamps (e.g. generated schedules)
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    import dateutil.parser
+
+    return dateutil.parser.parse(value)
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_constant(value, fallback_timezone):
+    """
+    Parse a constant part of a datetime expression (a duration or a datetime), memoized.
+    """
+    maybe_seconds = pytimeparse.timeparse.timeparse(value)
+    if maybe_seconds is not None:
+        return datetime.timedelta(seconds=maybe_seconds)
+    try:
+        base_time = _parse_datetime(value)
+        if base_time.tzinfo is None:
+            base_time = fallback_timezone.localize(base_time)
+    except Exception as e:
+        raise ValueError(f'Could not parse {value} as a datetime.') from e
+    return base_time
+
+
+def _replace_expression_variables(datetime_expression, timestamp_variables, skip_missing_variables=True):
+    """
+    Replace the variables of a parsed expression (as parse_timestamp_syntax with replace_variables=True).
+    """
+    if timestamp_variables is None:
+        raise ValueError('Timestamp variables must be specified if replace_variables is True.')
+    replaced_expression = list(datetime_expression)
+    for i, part in enumerate(datetime_expression):
+        if isinstance(part, str):
+            if part in timestamp_variables:
+                replaced_expression[i] = timestamp_variables[part]
+            elif not skip_missing_variables:
+                raise ValueError(f'Variable {part} not found in timestamp variables.')
+    return tuple(replaced_expression)
+
+
+class CompiledDatetimeExpression(tuple):
+    """
+    Parsed datetime expression (a tuple equal to the one returned by parse_timestamp_syntax)
+    with the variable names and the folded constant offset precomputed,
+    e.g. `@nautical_twilight_start + 10m + 5m` is evaluated as nautical_twilight_start + 15m.
+    """
+
+    def __new__(cls, datetime_expression):
+        if isinstance(datetime_expression, str):
+            datetime_expression = (datetime_expression,)
+        return super().__new__(cls, datetime_expression)
+
+    def __init__(self, datetime_expression):
+        super().__init__()
+        self.variables = frozenset(part for part in self if isinstance(part, str))
+        self.base = self[0] if len(self) > 0 else None
+        # the expression is foldable when all operands following the base are timedeltas
+        self.offset = datetime.timedelta(0)
+        self.foldable = len(self) > 0
+        for i in range(1, len(self), 2):
+            operator_func = self[i]
+            operand = self[i + 1]
+            if not isinstance(operand, datetime.timedelta) or operator_func not in (operator.add, operator.sub):
+                self.foldable = False
+                self.offset = None
+                break
+            self.offset = operator_func(self.offset, operand)
+
+    def evaluate(self, variable_values_dict):
+        if not self.foldable:
+            return evaluate_resolved_expression(resolve_variables(self, variable_values_dict))
+        base = self.base
+        if isinstance(base, str):
+            if base not in variable_values_dict:
+                raise _missing_variable_error(base, variable_values_dict)
+            base = variable_values_dict[base]
+        return base + self.offset
+
+    def evaluate_array(self, variable_values_arrays):
+        """
+        Evaluate the expression for arrays of variable values (e.g. one element per day),
+        given as numpy datetime64 or object arrays keyed by the variable name.
+        """
+        import numpy as np
+
+        if not self.foldable:
+            size = len(next(iter(variable_values_arrays.values()))) if variable_values_arrays else 1
+            return np.array([
+                self.evaluate({name: values[i] for name, values in variable_values_arrays.items()})
+                for i in range(size)
+            ])
+        base = self.base
+        if isinstance(base, str):
+            if base not in variable_values_arrays:
+                raise ValueError(f'Variable {base} not found in timestamp variables.')
+            base = variable_values_arrays[base]
+        base = np.asarray(base)
+        if base.dtype.kind == 'M':
+            return base + np.timedelta64(self.offset // datetime.timedelta(microseconds=1), 'us')
+        return base + self.offset
+
+
+def compile_datetime_expression(datetime_expression):
+    if isinstance(datetime_expression, CompiledDatetimeExpression):
+        return datetime_expression
+    return CompiledDatetimeExpression(datetime_expression)
+
+
+def evaluate_datetime_expressions(datetime_expressions, variable_values_dict):
+    """
+    Evaluate many datetime expressions against one variable values dict.
+    """
+    return {
+        datetime_expression: compile_datetime_expression(datetime_expression).evaluate(variable_values_dict)
+        for datetime_expression in datetime_expressions
+    }
+
+
 def find_variables(datetime_expression):
+    if isinstance(datetime_expression, CompiledDatetimeExpression):
+        return datetime_expression.variables
     variables = set()
     if isinstance(datetime_expression, str):
         datetime_expression = (datetime_expression,)
@@ -77,7 +220,7 @@ def resolve_variables(datetime_expression, variable_values_dict):
             if part in variable_values_dict:
                 complete_timestamp_expression[i] = variable_values_dict[part]
             else:
-                raise ValueError(f'Variable {part} not found in timestamp variables.')
+                raise _missing_variable_error(part, variable_values_dict)
     return tuple(complete_timestamp_expression)
 
 
@@ -96,6 +239,8 @@ def evaluate_datetime_expression(
         datetime_expression,
         variable_values_dict
 ):
+    if isinstance(datetime_expression, CompiledDatetimeExpression):
+        return datetime_expression.evaluate(variable_values_dict)
     datetime_expression = resolve_variables(
         datetime_expression, variable_values_dict
     )
@@ -134,26 +279,90 @@ def slugify_datetime_expression(datetime_expression, separator='_'):
     return slugified_str
 
 
+def datetime_expression_key(datetime_expression):
+    """
+    Canonical string of a datetime expression, equal for the equal expressions only
+    (e.g. `@sunset + 10m` and `@sunset + 600s`, or the same instant in different timezones)
+    unlike the slug, which drops the timezones and the microseconds.
+    """
+    if isinstance(datetime_expression, str):
+        datetime_expression = (datetime_expression,)
+    key = []
+    for part in datetime_expression:
+        if isinstance(part, str):
+            key.append(part.strip())
+        elif isinstance(part, datetime.datetime):
+            if part.tzinfo is not None:
+                part = part.astimezone(pytz.UTC)
+            key.append(part.isoformat())
+        elif isinstance(part, datetime.timedelta):
+            key.append(f'{part.total_seconds()}s')
+        elif part is operator.add:
+            key.append('+')
+        elif part is operator.sub:
+            key.append('-')
+        else:
+            raise ValueError(f'Unknown part {part} in datetime expression.')
+    return ' '.join(key)
+
+
 def load_job_settings_dict_yaml(
         pathname,
         timestamp_variables=None, replace_variables=False,
         skip_missing_variables=True,
         fallback_timezone='UTC',
         variable_marker='@',
+        compile_expressions=True,
+        cache_dir=None,
 ):
-    with open(pathname) as f:
-        yaml_data = yaml.safe_load(f)
+    """
+    Load a schedule file as a dict of the parsed datetime expressions and their settings.
+    With `cache_dir`, the parsed schedule is cached by the file content (see CompiledScheduleCache),
+    the variables are replaced after the cached parsing.
+    """
+    if isinstance(fallback_timezone, str):
+        fallback_timezone = pytz.timezone(fallback_timezone)
 
-    parsed_data = {}
-    for key, value in yaml_data.items():
-        parsed_key = parse_timestamp_syntax(
-            settings_operation_key=key,
-            timestamp_variables=timestamp_variables,
-            replace_variables=replace_variables,
+    with open(pathname, 'rb') as f:
+        content = f.read()
+
+    cache = CompiledScheduleCache(cache_dir) \
+        if cache_dir is not None \
+        else None
+    cache_key = None
+    parsed_items = None
+    if cache is not None:
+        cache_key = cache.create_key(
+            content,
+            fallback_timezone=getattr(fallback_timezone, 'zone', str(fallback_timezone)),
             variable_marker=variable_marker,
-            fallback_timezone=fallback_timezone,
-            skip_missing_variables=skip_missing_variables
         )
+        parsed_items = cache.load(cache_key)
+
+    if parsed_items is None:
+        import yaml
+
+        yaml_data = yaml.load(content, Loader=_yaml_loader())
+        parsed_items = [
+            (
+                parse_timestamp_syntax(
+                    settings_operation_key=key,
+                    variable_marker=variable_marker,
+                    fallback_timezone=fallback_timezone,
+                ),
+                value
+            )
+            for key, value in yaml_data.items()
+        ]
+        if cache is not None:
+            cache.save(cache_key, parsed_items)
+
+    parsed_data = {}
+    for parsed_key, value in parsed_items:
+        if replace_variables:
+            parsed_key = _replace_expression_variables(parsed_key, timestamp_variables, skip_missing_variables)
+        if compile_expressions:
+            parsed_key = CompiledDatetimeExpression(parsed_key)
         parsed_data[parsed_key] = value
 
     return parsed_data
@@ -0,0 +1,118 @@
+import collections
+import threading
+
+from .parser import compile_datetime_expression
+
+
+class _PlanningCycle:
+
+    def __init__(self, t0_datetime, next_t0_datetime, operation_datetimes, errors):
+        self.t0_datetime = t0_datetime
+        self.next_t0_datetime = next_t0_datetime
+        self.operation_datetimes = operation_datetimes
+        self.errors = errors
+
+
+class ScheduleGroupPlanner:
+    """
+    Plans the jobs of a whole schedule file together. For every cycle t0, the variable values dict is created once
+    (with the variables of all the expressions) and the operation datetimes of all the jobs are evaluated in one pass.
+
+    The cycle t0 datetimes form a chain resolved by the next t0 expression. A job advances to the next cycle t0
+    (or the one after it, if its operation datetime is later), as with the per-job resolve_next_t0_datetime,
+    so all jobs share the cycles (and the create_dict cache keys).
+    """
+
+    def __init__(
+            self,
+            datetime_expressions,
+            next_t0_datetime_expression,
+            create_dict_func,
+            t0_step,
+            max_cycles=16,
+    ):
+        self.next_t0_datetime_expression = compile_datetime_expression(next_t0_datetime_expression)
+        self.create_dict_func = create_dict_func
+        self.t0_step = t0_step
+        self.max_cycles = max_cycles
+
+        self.cycles = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+        self.set_datetime_expressions(datetime_expressions)
+
+    def set_datetime_expressions(self, datetime_expressions):
+        """
+        Replace the planned expressions (e.g. after the schedule file is reloaded), the planned cycles are dropped.
+        """
+        with self.lock:
+            self.datetime_expressions = [
+                compile_datetime_expression(datetime_expression) for datetime_expression in datetime_expressions
+            ]
+            self.required_variable_names = frozenset(self.next_t0_datetime_expression.variables).union(
+                *(datetime_expression.variables for datetime_expression in self.datetime_expressions)
+            )
+            self.cycles.clear()
+
+    def _create_dict(self, t0_datetime):
+        return self.create_dict_func(
+            t0_datetime=t0_datetime,
+            required_variable_names=self.required_variable_names
+        )
+
+    def _plan_cycle(self, t0_datetime):
+        datetime_variable_values = self._create_dict(t0_datetime)
+
+        operation_datetimes = {}
+        errors = {}
+        for datetime_expression in self.datetime_expressions:
+            try:
+                operation_datetimes[datetime_expression] = datetime_expression.evaluate(datetime_variable_values)
+            except ValueError as e:
+                errors[datetime_expression] = e
+
+        next_t0_datetime = self.next_t0_datetime_expression.evaluate(datetime_variable_values)
+        if next_t0_datetime <= t0_datetime:
+            next_t0_datetime = self.next_t0_datetime_expression.evaluate(
+                self._create_dict(next_t0_datetime + self.t0_step)
+            )
+            if next_t0_datetime <= t0_datetime:
+                # Unexpected state, should not happen
+                raise RuntimeError('Cannot continue. next_t0_datetime <= t0_datetime.')
+
+        return _PlanningCycle(t0_datetime, next_t0_datetime, operation_datetimes, errors)
+
+    def get_cycle(self, t0_datetime):
+        with self.lock:
+            cycle = self.cycles.get(t0_datetime)
+            if cycle is None:
+                cycle = self._plan_cycle(t0_datetime)
+                self.cycles[t0_datetime] = cycle
+                while len(self.cycles) > self.max_cycles:
+                    self.cycles.popitem(last=False)
+            else:
+                self.cycles.move_to_end(t0_datetime)
+            return cycle
+
+    def resolve_operation_datetime(
+            self,
+            t0_datetime,
+            operation_datetime_expression,
+    ):
+        cycle = self.get_cycle(t0_datetime)
+        if operation_datetime_expression in cycle.errors:
+            raise cycle.errors[operation_datetime_expression]
+        return cycle.operation_datetimes[operation_datetime_expression]
+
+    def resolve_next_t0_datetime(
+            self,
+            t0_datetime,
+            operation_datetime,
+            interval_timedelta=None,
+    ):
+        next_t0_datetime = self.get_cycle(t0_datetime).next_t0_datetime
+        # the event can be found several cycles ahead (e.g. at the edge of the polar day),
+        # the job continues with the cycle after it (the cycle t0 datetimes are increasing)
+        while operation_datetime > next_t0_datetime:
+            next_t0_datetime = self.get_cycle(next_t0_datetime).next_t0_datetime
+        return next_t0_datetime
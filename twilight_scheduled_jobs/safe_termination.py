@@ -3,13 +3,35 @@ import signal
 
 terminate_flag = False
 print_terminate_message_files = None
+# events (objects with a set() method) set together with the terminate flag, e.g. to wake up a sleeping loop
+wakeup_events = set()
 
 
-def set_terminate_flag(signum, frame):
+def register_wakeup_event(event):
+    wakeup_events.add(event)
+    if terminate_flag:
+        event.set()
+
+
+def unregister_wakeup_event(event):
+    wakeup_events.discard(event)
+
+
+def request_terminate():
+    """
+    Set the terminate flag without a signal (e.g. when a worker process is stopped by its parent).
+    """
     global terminate_flag
-    global print_terminate_message_files
     terminate_flag = True
 
+    for event in list(wakeup_events):
+        event.set()
+
+
+def set_terminate_flag(signum, frame):
+    global print_terminate_message_files
+    request_terminate()
+
     if print_terminate_message_files:
         for f in print_terminate_message_files:
             print('\n\nTerminate signal received ({:d}), processing will be terminated when current task finishes.\n'.format(
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+
+class CompiledScheduleCache:
+    """
+    Persistent cache of parsed schedule files, keyed by the hash of the file content and of the parsing options.
+    Every entry is a single pickle of the parsed (datetime expression, settings) items, loaded in one deserialization.
+    The cache directory must not be writable by untrusted users (pickle).
+    """
+
+    format_version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def create_key(cls, content, **options):
+        key_hash = hashlib.sha1(content)
+        key_hash.update(json.dumps(
+            dict(options, format_version=cls.format_version), sort_keys=True, default=str
+        ).encode('utf-8'))
+        return key_hash.hexdigest()[:16]
+
+    def _pathname(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def load(self, key):
+        pathname = self._pathname(key)
+        if not os.path.exists(pathname):
+            return None
+        try:
+            with open(pathname, 'rb') as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # a corrupted or incompatible entry is parsed again
+            return None
+
+    def save(self, key, items):
+        os.makedirs(self.directory, exist_ok=True)
+        pathname = self._pathname(key)
+        fd, tmp_pathname = tempfile.mkstemp(dir=self.directory, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_pathname, pathname)
+        except BaseException:
+            if os.path.exists(tmp_pathname):
+                os.remove(tmp_pathname)
+            raise
@@ -0,0 +1,51 @@
+import logging
+import os
+import time
+
+
+class ScheduleFileWatcher:
+    """
+    Polls the modification time (and size) of a schedule file and calls `reload_func` when it changes.
+    It is polled by run_pending_loop on the scheduler thread, so the reload can modify the jobs safely.
+    A failed reload (e.g. invalid YAML being edited) is logged and the running jobs are kept.
+    """
+
+    def __init__(self, schedule_file, reload_func, poll_interval=5., logger=None):
+        self.schedule_file = schedule_file
+        self.reload_func = reload_func
+        self.poll_interval = poll_interval
+        self.logger = logger if logger else logging.getLogger('ScheduleFileWatcher')
+        self.last_file_state = self._file_state()
+        self.next_poll = time.monotonic() + poll_interval
+
+    def _file_state(self):
+        try:
+            stat = os.stat(self.schedule_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        """
+        :return: True if the file changed and was reloaded
+        """
+        now = time.monotonic()
+        if now < self.next_poll:
+            return False
+        self.next_poll = now + self.poll_interval
+
+        file_state = self._file_state()
+        if file_state is None or file_state == self.last_file_state:
+            # a missing file (e.g. replaced by an editor) is reloaded once it is written again
+            return False
+        self.last_file_state = file_state
+
+        self.logger.info('Schedule file %s changed, reloading it', self.schedule_file)
+        try:
+            self.reload_func()
+        except Exception as e:
+            self.logger.exception(
+                'Could not reload %s, keeping the running jobs [%s]: %s', self.schedule_file, type(e).__name__, str(e)
+            )
+            return False
+        return True
@@ -0,0 +1,140 @@
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_DEVICE_KEY = 'default'
+
+
+class DifferentialSettingsApplier:
+    """
+    Wrapper of a settings job function calling it with only the settings whose values differ from the last
+    successfully applied values (the call is skipped when nothing changed).
+    The applied values are kept per station (the `station_name` keyword argument of the multi-station jobs)
+    and persisted in the JSON `state_file` (if set), so they survive restarts.
+    Every `resync_interval` seconds (if set), the next call gets the full settings dict of its job.
+    The state is kept in the calling process, so it cannot be used with ProcessPoolJobExecutor.
+    """
+
+    def __init__(self, settings_job_func, state_file=None, resync_interval=None, logger=None, time_func=time.time):
+        self.settings_job_func = settings_job_func
+        self.state_file = os.path.expanduser(state_file) if state_file is not None else None
+        self.resync_interval = resync_interval
+        self.logger = logger if logger else logging.getLogger('DifferentialSettingsApplier')
+        self.time_func = time_func
+        self._lock = threading.Lock()
+        # device key -> dict(settings=applied settings dict, last_resync=timestamp of the last full resync)
+        self.devices = self._load()
+
+    def _load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return dict()
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)['devices']
+        except (ValueError, KeyError, TypeError) as e:
+            # the settings are applied in full again
+            self.logger.warning('Ignoring the settings state file %s [%s]: %s', self.state_file, type(e).__name__, e)
+            return dict()
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        file_descriptor, temporary_pathname = tempfile.mkstemp(dir=directory, prefix='.settings_state', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump(dict(devices=self.devices), f, indent=1, sort_keys=True, default=str)
+            os.replace(temporary_pathname, self.state_file)
+        except BaseException:
+            if os.path.exists(temporary_pathname):
+                os.remove(temporary_pathname)
+            raise
+
+    def applied_settings(self, station_name=None):
+        """
+        :return: copy of the last successfully applied settings of the station
+        """
+        with self._lock:
+            device = self.devices.get(station_name or DEFAULT_DEVICE_KEY)
+            return dict(device['settings']) if device is not None else dict()
+
+    def request_resync(self, station_name=None):
+        """
+        Apply the full settings dict on the next call, e.g. after the camera has been restarted.
+        The state of all the stations is dropped if `station_name` is None.
+        """
+        with self._lock:
+            if station_name is None:
+                self.devices.clear()
+            else:
+                self.devices.pop(station_name, None)
+            self._save()
+
+    def settings_delta(self, settings_dict, station_name=None):
+        """
+        :return: (settings to apply, whether it is a full resync)
+        """
+        with self._lock:
+            device = self.devices.get(station_name or DEFAULT_DEVICE_KEY)
+            if device is None or (
+                    self.resync_interval is not None
+                    and self.time_func() - device['last_resync'] >= self.resync_interval
+            ):
+                return dict(settings_dict), True
+            applied_settings = device['settings']
+            return {
+                key: value
+                for key, value in settings_dict.items()
+                if key not in applied_settings or applied_settings[key] != value
+            }, False
+
+    def _commit(self, settings_delta, full_resync, station_name, success):
+        with self._lock:
+            device = self.devices.setdefault(
+                station_name or DEFAULT_DEVICE_KEY,
+                dict(settings=dict(), last_resync=self.time_func()),
+            )
+            if success:
+                # compared with the JSON round trip of the values, as after a restart
+                device['settings'].update(json.loads(json.dumps(settings_delta, default=str)))
+                if full_resync:
+                    device['last_resync'] = self.time_func()
+            else:
+                # the failed settings may or may not have been applied, they are applied again on the next call
+                for key in settings_delta:
+                    device['settings'].pop(key, None)
+            self._save()
+
+    def __call__(self, settings_dict, logger, **kwargs):
+        station_name = kwargs.get('station_name')
+        settings_delta, full_resync = self.settings_delta(settings_dict, station_name=station_name)
+        if not settings_delta:
+            logger.info('Settings already applied, skipping: %s', json.dumps(settings_dict, default=str)[:100])
+            return None
+        if full_resync:
+            logger.info('Applying all the settings (resync)')
+        elif len(settings_delta) < len(settings_dict):
+            logger.info('Applying the changed settings: %s', ', '.join(settings_delta))
+
+        try:
+            ret = self.settings_job_func(settings_dict=settings_delta, logger=logger, **kwargs)
+        except BaseException:
+            self._commit(settings_delta, full_resync, station_name, success=False)
+            raise
+        if inspect.isawaitable(ret):
+            return self._await_and_commit(ret, settings_delta, full_resync, station_name)
+        self._commit(settings_delta, full_resync, station_name, success=True)
+        return ret
+
+    async def _await_and_commit(self, awaitable, settings_delta, full_resync, station_name):
+        try:
+            ret = await awaitable
+        except BaseException:
+            self._commit(settings_delta, full_resync, station_name, success=False)
+            raise
+        self._commit(settings_delta, full_resync, station_name, success=True)
+        return ret
@@ -0,0 +1,503 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from functools import partial
+from multiprocessing import shared_memory
+
+import dateutil.parser
+import numpy as np
+import pytimeparse.timeparse
+import pytz
+
+from . import safe_termination
+from .datetime_variables import DatetimeVariableValuesDictFactory
+from .defaults import DEFAULTS
+from .engines import EventEngine, create_engine
+from .event_table import EventTable, datetime_to_epoch_us
+from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob
+from .jobs import run_pending_loop
+from .main import DEFAULT_LOGGER_NAME, initialize_schedule_file_jobs
+from .parser import compile_datetime_expression, find_variables, load_job_settings_dict_yaml, parse_timestamp_syntax
+
+
+def publish_event_tables(event_tables, since_us=None):
+    """
+    Copy the event tables to shared memory, one block per family with the int64 epoch microseconds
+    followed by the int16 event codes. The events before `since_us` are left out.
+
+    :return: (descriptor, shared memory blocks), the descriptor (plain values) is passed to attach_event_tables
+    """
+    descriptor = {}
+    blocks = []
+    for family, table in event_tables.items():
+        if table.is_empty:
+            continue
+        start = table.start
+        times, codes = table.times, table.codes
+        if since_us is not None and since_us > start:
+            i = table.index(since_us)
+            start, times, codes = since_us, times[i:], codes[i:]
+        count = len(times)
+        times_size = count * np.dtype(EventTable.times_dtype).itemsize
+        block = shared_memory.SharedMemory(
+            create=True, size=max(times_size + count * np.dtype(EventTable.codes_dtype).itemsize, 1)
+        )
+        np.ndarray(count, dtype=EventTable.times_dtype, buffer=block.buf)[:] = times
+        np.ndarray(count, dtype=EventTable.codes_dtype, buffer=block.buf, offset=times_size)[:] = codes
+        descriptor[family] = dict(name=block.name, count=count, start=int(start), end=int(table.end))
+        blocks.append(block)
+    return descriptor, blocks
+
+
+def attach_event_tables(descriptor):
+    """
+    Attach the event tables published by publish_event_tables, the arrays are read-only views of the shared memory.
+
+    :return: (event tables by family, shared memory blocks)
+    """
+    event_tables = {}
+    blocks = []
+    for family, table_descriptor in descriptor.items():
+        block = shared_memory.SharedMemory(name=table_descriptor['name'])
+        count = table_descriptor['count']
+        times = np.ndarray(count, dtype=EventTable.times_dtype, buffer=block.buf)
+        codes = np.ndarray(
+            count, dtype=EventTable.codes_dtype, buffer=block.buf,
+            offset=count * np.dtype(EventTable.times_dtype).itemsize,
+        )
+        times.flags.writeable = False
+        codes.flags.writeable = False
+        event_tables[family] = EventTable(times, codes, table_descriptor['start'], table_descriptor['end'])
+        blocks.append(block)
+    return event_tables, blocks
+
+
+def _close_blocks(blocks, unlink=False):
+    """
+    :return: the blocks which cannot be closed yet (their arrays are still referenced)
+    """
+    open_blocks = []
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            open_blocks.append(block)
+            continue
+        if unlink:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+    return open_blocks
+
+
+class SharedEventTableEngine(EventEngine):
+    """
+    Engine of the shard workers: the events are only looked up in the tables published by the parent process.
+    The Sun altitudes at the transits (missing event policy) and the Moon illumination are single point
+    evaluations delegated to `point_engine` (e.g. the reference engine with a lazily loaded ephemeris).
+    """
+
+    name = 'shared'
+
+    def __init__(self, point_engine=None):
+        self.point_engine = point_engine
+
+    def compute_events(self, family, start_us, end_us):
+        raise ValueError(
+            f'The {family} events between {start_us} and {end_us} (epoch microseconds) '
+            f'have not been published by the parent process.'
+        )
+
+    def compute_events_many(self, families, start_us, end_us):
+        return {family: self.compute_events(family, start_us, end_us) for family in families}
+
+    def altitudes(self, body, times_us):
+        return self.point_engine.altitudes(body, times_us)
+
+    def moon_illuminations(self, times_us):
+        return self.point_engine.moon_illuminations(times_us)
+
+
+class SharedEventTablesPublisher:
+    """
+    Computes the events of the schedule variables in the parent process and publishes them in shared memory.
+    The tables are extended (and published again) when less than half of the horizon is left.
+    The previous generation is unlinked only when the next one is published, so a worker can still attach it.
+    """
+
+    def __init__(self, datetime_variable_values_dict_factory, variable_names, horizon, logger=None):
+        self.datetime_variable_values_dict_factory = datetime_variable_values_dict_factory
+        self.variable_names = frozenset(variable_names)
+        self.horizon = horizon
+        self.logger = logger if logger else logging.getLogger('SharedEventTablesPublisher')
+        self.descriptor = None
+        self.end_datetime = None
+        self._generations = []
+        self._closing_blocks = []
+
+    def publish(self, now_datetime):
+        end_datetime = now_datetime + self.horizon
+        factory = self.datetime_variable_values_dict_factory
+        factory.ensure_events(now_datetime, end_datetime, variable_names=self.variable_names)
+        with factory._events_lock:
+            # the past events are not needed by the workers
+            self.descriptor, blocks = publish_event_tables(
+                factory.event_tables, since_us=datetime_to_epoch_us(now_datetime - factory.delta_t)
+            )
+        self.end_datetime = end_datetime
+        self._generations.append(blocks)
+        while len(self._generations) > 2:
+            self._closing_blocks.extend(self._generations.pop(0))
+        self._closing_blocks = _close_blocks(self._closing_blocks, unlink=True)
+        self.logger.info(
+            'Published the events until %s (%s)', end_datetime,
+            ', '.join(f'{family}: {table["count"]}' for family, table in self.descriptor.items()),
+        )
+        return self.descriptor
+
+    def extend_if_needed(self, now_datetime):
+        """
+        :return: the new descriptor if the tables were published again, None otherwise
+        """
+        if self.end_datetime is not None and self.end_datetime - now_datetime >= self.horizon / 2:
+            return None
+        return self.publish(now_datetime)
+
+    def close(self):
+        for blocks in self._generations:
+            self._closing_blocks.extend(blocks)
+        self._generations = []
+        self._closing_blocks = _close_blocks(self._closing_blocks, unlink=True)
+
+
+class SharedEventTablesWatcher:
+    """
+    Polled by run_pending_loop in a shard worker: attaches the tables published again by the parent process.
+    """
+
+    def __init__(self, datetime_variable_values_dict_factory, descriptor_queue, poll_interval=5., logger=None):
+        self.datetime_variable_values_dict_factory = datetime_variable_values_dict_factory
+        self.descriptor_queue = descriptor_queue
+        self.poll_interval = poll_interval
+        self.logger = logger if logger else logging.getLogger('SharedEventTablesWatcher')
+        self._blocks = []
+        self._closing_blocks = []
+
+    def attach(self, descriptor):
+        event_tables, blocks = attach_event_tables(descriptor)
+        self.datetime_variable_values_dict_factory.replace_event_tables(event_tables)
+        self._closing_blocks.extend(self._blocks)
+        self._blocks = blocks
+        self._closing_blocks = _close_blocks(self._closing_blocks)
+
+    def poll(self):
+        descriptor = None
+        while True:
+            try:
+                descriptor = self.descriptor_queue.get_nowait()
+            except queue.Empty:
+                break
+        if descriptor is None:
+            return False
+        self.logger.debug('Attaching the published events')
+        self.attach(descriptor)
+        return True
+
+    def close(self):
+        self._closing_blocks = _close_blocks(self._closing_blocks + self._blocks)
+        self._blocks = []
+
+
+def _wait_for_stop(stop_event):
+    stop_event.wait()
+    safe_termination.request_terminate()
+
+
+def run_shard_worker(
+        shard_index,
+        shard_count,
+        descriptor,
+        descriptor_queue,
+        stop_event,
+        schedule_file,
+        station_geographic_position,
+        settings_job_func,
+        timezone,
+        variable_marker,
+        next_t0_expression,
+        delta_t,
+        t0_step,
+        group_planning,
+        ephemeris,
+        engine,
+        missing_event_policy,
+        schedule_cache_dir,
+        schedule_pending_check_interval,
+        deadline_driven,
+        max_sleep_interval,
+        coalesce_window,
+        job_logger_name_format,
+        logger_name,
+):
+    """
+    Entry point of a shard worker process: runs the jobs of every shard count-th key of the schedule file
+    with the events published by the parent process, until `stop_event` is set.
+    """
+    # Ctrl+C is handled by the parent, which stops the workers, SIGTERM stops the worker safely
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    safe_termination.init(print_term_message_files=[])
+
+    logger = logging.getLogger(f'{logger_name}.shard_{shard_index}')
+
+    datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+        station_geographic_position=station_geographic_position,
+        timezone=timezone,
+        delta_t=delta_t,
+        engine=SharedEventTableEngine(
+            point_engine=create_engine(engine, station_geographic_position, eph=ephemeris, lazy_ephemeris=True)
+        ),
+        missing_event_policy=missing_event_policy,
+        background_extension=False,
+        logger=logger,
+    )
+    watcher = SharedEventTablesWatcher(datetime_variable_values_dict_factory, descriptor_queue, logger=logger)
+    watcher.attach(descriptor)
+
+    threading.Thread(target=_wait_for_stop, args=(stop_event,), name='shard_stop', daemon=True).start()
+
+    scheduler = CustomizableScheduler(job_class=FloatingNextRunJob, coalesce_window=coalesce_window)
+    try:
+        scheduled_camera_settings_jobs_dict = initialize_schedule_file_jobs(
+            scheduler=scheduler,
+            schedule_file=schedule_file,
+            datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+            settings_job_func=settings_job_func,
+            current_datetime=datetime.datetime.now(timezone),
+            timezone=timezone,
+            variable_marker=variable_marker,
+            next_t0_expression=next_t0_expression,
+            t0_step=t0_step,
+            group_planning=group_planning,
+            schedule_cache_dir=schedule_cache_dir,
+            job_logger_name_format=job_logger_name_format,
+            logger=logger,
+            shard=(shard_index, shard_count),
+        )
+        logger.info('Shard %d/%d running %d jobs', shard_index, shard_count, len(scheduled_camera_settings_jobs_dict))
+
+        run_pending_loop(
+            scheduler=scheduler,
+            logger=logger,
+            schedule_pending_check_interval=schedule_pending_check_interval,
+            deadline_driven=deadline_driven,
+            max_sleep_interval=max_sleep_interval,
+            watchers=[watcher],
+        )
+    finally:
+        scheduler.clear()
+        watcher.close()
+
+
+def get_schedule_variable_names(
+        schedule_file,
+        current_datetime,
+        timezone,
+        variable_marker,
+        next_t0_expression,
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+):
+    """
+    Variables of all the keys of the schedule file and of the next t0 expression.
+    """
+    job_settings_by_datetime_expression = load_job_settings_dict_yaml(
+        pathname=schedule_file,
+        fallback_timezone=timezone,
+        timestamp_variables=dict(
+            parse_time=current_datetime
+        ),
+        replace_variables=True,
+        skip_missing_variables=True,
+        variable_marker=variable_marker,
+        cache_dir=schedule_cache_dir,
+    )
+    next_t0_datetime_expression = compile_datetime_expression(parse_timestamp_syntax(next_t0_expression))
+    return frozenset(next_t0_datetime_expression.variables).union(*(
+        find_variables(datetime_expression) for datetime_expression in job_settings_by_datetime_expression
+    ))
+
+
+class _ShardWorker:
+
+    def __init__(self, shard_index, mp_context, target):
+        self.shard_index = shard_index
+        self.mp_context = mp_context
+        self.target = target
+        self.descriptor_queue = None
+        self.stop_event = None
+        self.process = None
+
+    def start(self, descriptor):
+        # a new event per process: a multiprocessing.Event waited on by a killed process
+        # blocks its set() forever (the count of the sleepers is never decremented)
+        self.stop_event = self.mp_context.Event()
+        self.descriptor_queue = self.mp_context.Queue()
+        self.process = self.mp_context.Process(
+            target=self.target,
+            kwargs=dict(
+                shard_index=self.shard_index,
+                descriptor=descriptor,
+                descriptor_queue=self.descriptor_queue,
+                stop_event=self.stop_event,
+            ),
+            name=f'shard_{self.shard_index}',
+        )
+        self.process.start()
+
+
+def twilight_scheduled_jobs_sharded_main(
+        schedule_file,
+        station_geographic_position,
+        settings_job_func,
+        worker_count=DEFAULTS['shard_worker_count'],
+        current_datetime=None,
+        timezone=DEFAULTS['timezone'],
+        variable_marker=DEFAULTS['variable_marker'],
+        next_t0_expression=DEFAULTS['next_t0_expression'],
+        delta_t=DEFAULTS['delta_t'],
+        t0_step=DEFAULTS['t0_step'],
+        group_planning=DEFAULTS['group_planning'],
+        horizon=DEFAULTS['shard_horizon'],
+        event_store_dir=DEFAULTS['event_store_dir'],
+        ephemeris=DEFAULTS['ephemeris'],
+        engine=DEFAULTS['engine'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        schedule_pending_check_interval=DEFAULTS['schedule_pending_check_interval'],
+        deadline_driven=DEFAULTS['deadline_driven'],
+        max_sleep_interval=DEFAULTS['max_sleep_interval'],
+        coalesce_window=DEFAULTS['coalesce_window'],
+        supervise_interval=DEFAULTS['shard_supervise_interval'],
+        stop_timeout=DEFAULTS['shard_stop_timeout'],
+        mp_context=None,
+        job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
+        logger=None,
+):
+    """
+    Run the jobs of a schedule file sharded across `worker_count` processes (the CPU count by default).
+    The parent process computes the events for the `horizon` and publishes them in shared memory,
+    the workers only look them up and dispatch their jobs. A worker exiting unexpectedly is restarted.
+    When the safe termination flag is set (or on KeyboardInterrupt), the workers are stopped and joined.
+    `settings_job_func` (and `ephemeris` if it is not a file name) has to be picklable with the spawn
+    and forkserver start methods.
+
+    :return: dict of the exit codes of the workers by the shard index
+    """
+    current_datetime = dateutil.parser.parse(current_datetime) \
+        if isinstance(current_datetime, str) \
+        else current_datetime
+
+    if logger is None:
+        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+    current_datetime = datetime.datetime.now(pytz.timezone(timezone)) \
+        if current_datetime is None \
+        else current_datetime
+
+    worker_count = worker_count if worker_count is not None else os.cpu_count()
+    mp_context = mp_context if mp_context is not None else multiprocessing.get_context()
+    timezone = pytz.timezone(timezone)
+    delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
+    t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+    horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon))
+
+    datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+        station_geographic_position=station_geographic_position,
+        timezone=timezone,
+        delta_t=delta_t,
+        event_store=event_store_dir,
+        eph=ephemeris,
+        engine=engine,
+        missing_event_policy=missing_event_policy,
+        background_extension=False,
+    )
+    variable_names = get_schedule_variable_names(
+        schedule_file, current_datetime, timezone, variable_marker, next_t0_expression,
+        schedule_cache_dir=schedule_cache_dir,
+    )
+    publisher = SharedEventTablesPublisher(
+        datetime_variable_values_dict_factory,
+        # the Sun transits are used by the missing event policy
+        variable_names | {DatetimeVariableValuesDictFactory.sun_antimeridian_transit_key},
+        horizon,
+        logger=logger,
+    )
+
+    target = partial(
+        run_shard_worker,
+        shard_count=worker_count,
+        schedule_file=schedule_file,
+        station_geographic_position=station_geographic_position,
+        settings_job_func=settings_job_func,
+        timezone=timezone,
+        variable_marker=variable_marker,
+        next_t0_expression=next_t0_expression,
+        delta_t=delta_t,
+        t0_step=t0_step,
+        group_planning=group_planning,
+        ephemeris=ephemeris,
+        engine=engine,
+        missing_event_policy=missing_event_policy,
+        schedule_cache_dir=schedule_cache_dir,
+        schedule_pending_check_interval=schedule_pending_check_interval,
+        deadline_driven=deadline_driven,
+        max_sleep_interval=max_sleep_interval,
+        coalesce_window=coalesce_window,
+        job_logger_name_format=job_logger_name_format,
+        logger_name=logger.name,
+    )
+    workers = [_ShardWorker(shard_index, mp_context, target) for shard_index in range(worker_count)]
+
+    wakeup_event = threading.Event()
+    safe_termination.register_wakeup_event(wakeup_event)
+    try:
+        descriptor = publisher.publish(current_datetime)
+        for worker in workers:
+            worker.start(descriptor)
+
+        while not safe_termination.terminate_flag:
+            wakeup_event.clear()
+            new_descriptor = publisher.extend_if_needed(datetime.datetime.now(timezone))
+            if new_descriptor is not None:
+                for worker in workers:
+                    worker.descriptor_queue.put(new_descriptor)
+            for worker in workers:
+                if not worker.process.is_alive() and not safe_termination.terminate_flag:
+                    logger.error(
+                        'Shard %d worker exited with code %s, restarting it',
+                        worker.shard_index, worker.process.exitcode,
+                    )
+                    worker.start(publisher.descriptor)
+            wakeup_event.wait(supervise_interval)
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt received. Stopping the shard workers.')
+    finally:
+        safe_termination.unregister_wakeup_event(wakeup_event)
+        for worker in workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.stop_event.set()
+        for worker in workers:
+            if worker.process is None:
+                continue
+            worker.process.join(stop_timeout)
+            if worker.process.is_alive():
+                logger.error('Shard %d worker did not stop in %s s, terminating it', worker.shard_index, stop_timeout)
+                worker.process.terminate()
+                worker.process.join()
+        publisher.close()
+
+    return {worker.shard_index: worker.process.exitcode for worker in workers if worker.process is not None}
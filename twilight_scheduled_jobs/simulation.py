@@ -0,0 +1,158 @@
+import datetime
+import logging
+
+import dateutil.parser
+import pytimeparse.timeparse
+import pytz
+
+from .clock import VirtualClock
+from .datetime_variables import DatetimeVariableValuesDictFactory
+from .defaults import DEFAULTS
+from .floating_next_run_job import CustomizableScheduler, FloatingNextRunJob, coalesce_job_funcs
+from .main import DEFAULT_LOGGER_NAME, initialize_schedule_file_jobs
+
+
+def _record_settings_job(settings_dict, logger, **kwargs):
+    pass
+
+
+def run_simulation(scheduler, scheduled_jobs_dict, end_datetime, timezone, logger):
+    """
+    Fast-forward the virtual clock of the scheduler from one next_run to the next until `end_datetime`
+    and run the due jobs in order.
+
+    :return: list of the dispatches, dicts with the dispatch datetime (in `timezone`), the datetime expression
+             and the settings of the job (merged with the settings of the `coalesced_datetime_expressions`
+             within the coalescing window of the scheduler), and the error raised by the job function (None on success)
+    """
+    clock = scheduler.clock
+    datetime_expression_by_job = {job: datetime_expression for datetime_expression, job in scheduled_jobs_dict.items()}
+
+    dispatches = []
+    while scheduler.jobs:
+        scheduler.cancel_requested_jobs()
+        next_run = scheduler.next_run
+        if next_run is None:
+            break
+        clock.advance_to(next_run)
+        if clock.now_aware() >= end_datetime:
+            break
+
+        for jobs in scheduler.runnable_job_groups():
+            job = jobs[0]
+            job_func = coalesce_job_funcs(jobs) \
+                if len(jobs) > 1 \
+                else job.job_func
+            dispatch = dict(
+                datetime=clock.now_aware().astimezone(timezone),
+                datetime_expression=datetime_expression_by_job.get(job),
+                settings_dict=job_func.keywords.get('settings_dict'),
+                coalesced_datetime_expressions=[datetime_expression_by_job.get(job) for job in jobs[1:]],
+                error=None,
+            )
+            next_runs = [job.next_run for job in jobs]
+            try:
+                scheduler._run_coalesced_jobs(jobs)
+            except Exception as e:
+                logger.exception('Error in simulated job %s [%s]: %s', job, type(e).__name__, str(e))
+                dispatch['error'] = e
+                # the failed jobs would be retried by run_pending in a loop, they are rescheduled instead
+                for job, next_run in zip(jobs, next_runs):
+                    if job.next_run == next_run:
+                        job._schedule_next_run()
+            dispatches.append(dispatch)
+
+    return dispatches
+
+
+def twilight_scheduled_jobs_simulate(
+        schedule_file,
+        station_geographic_position,
+        start_datetime,
+        end_datetime,
+        settings_job_func=None,
+        timezone=DEFAULTS['timezone'],
+        variable_marker=DEFAULTS['variable_marker'],
+        next_t0_expression=DEFAULTS['next_t0_expression'],
+        delta_t=DEFAULTS['delta_t'],
+        t0_step=DEFAULTS['t0_step'],
+        group_planning=DEFAULTS['group_planning'],
+        horizon=None,
+        coalesce_window=DEFAULTS['coalesce_window'],
+        event_store_dir=DEFAULTS['event_store_dir'],
+        ephemeris=DEFAULTS['ephemeris'],
+        lazy_ephemeris=DEFAULTS['lazy_ephemeris'],
+        engine=DEFAULTS['engine'],
+        missing_event_policy=DEFAULTS['missing_event_policy'],
+        schedule_cache_dir=DEFAULTS['schedule_cache_dir'],
+        job_logger_name_format=DEFAULTS['scheduled_job_logger_name_format'],
+        logger=None,
+):
+    """
+    Replay a schedule file between `start_datetime` and `end_datetime` on a virtual clock, as fast as the events
+    can be computed, e.g. to validate schedule changes without waiting for the actual twilight.
+    The settings jobs are executed with `settings_job_func` (only recorded if None).
+    The events of the whole range are computed at once unless `horizon` is set.
+
+    :return: list of the dispatches (see run_simulation)
+    """
+    start_datetime, end_datetime = [
+        dateutil.parser.parse(value) if isinstance(value, str) else value
+        for value in (start_datetime, end_datetime)
+    ]
+
+    if logger is None:
+        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+    timezone = pytz.timezone(timezone)
+    start_datetime, end_datetime = [
+        timezone.localize(value) if value.tzinfo is None else value
+        for value in (start_datetime, end_datetime)
+    ]
+    delta_t = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(delta_t))
+    t0_step = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(t0_step))
+    # by default, the events of the whole simulated range are computed at once (vectorized over the range)
+    horizon = datetime.timedelta(seconds=pytimeparse.timeparse.timeparse(horizon)) \
+        if horizon is not None \
+        else end_datetime - start_datetime + 2 * delta_t
+
+    datetime_variable_values_dict_factory = DatetimeVariableValuesDictFactory(
+        station_geographic_position=station_geographic_position,
+        timezone=timezone,
+        delta_t=delta_t,
+        horizon=horizon,
+        event_store=event_store_dir,
+        eph=ephemeris,
+        lazy_ephemeris=lazy_ephemeris,
+        engine=engine,
+        missing_event_policy=missing_event_policy,
+        # the simulation computes the events on the critical path anyway
+        background_extension=False,
+    )
+
+    clock = VirtualClock(start_datetime)
+    scheduler = CustomizableScheduler(job_class=FloatingNextRunJob, clock=clock, coalesce_window=coalesce_window)
+
+    scheduled_camera_settings_jobs_dict = initialize_schedule_file_jobs(
+        scheduler=scheduler,
+        schedule_file=schedule_file,
+        datetime_variable_values_dict_factory=datetime_variable_values_dict_factory,
+        settings_job_func=settings_job_func if settings_job_func is not None else _record_settings_job,
+        current_datetime=start_datetime,
+        timezone=timezone,
+        variable_marker=variable_marker,
+        next_t0_expression=next_t0_expression,
+        t0_step=t0_step,
+        group_planning=group_planning,
+        schedule_cache_dir=schedule_cache_dir,
+        job_logger_name_format=job_logger_name_format,
+        logger=logger,
+    )
+
+    return run_simulation(
+        scheduler=scheduler,
+        scheduled_jobs_dict=scheduled_camera_settings_jobs_dict,
+        end_datetime=end_datetime,
+        timezone=timezone,
+        logger=logger,
+    )
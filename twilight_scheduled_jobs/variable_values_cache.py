@@ -0,0 +1,114 @@
+import bisect
+import collections
+import threading
+import time
+
+
+class IntervalCache:
+    """
+    LRU cache of values keyed by (lo, hi] intervals of int64 microseconds, any point inside an interval is a hit.
+    Entries are evicted when the cache exceeds `max_size` entries or when they are older than `ttl` seconds.
+    """
+
+    def __init__(self, max_size=5, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._sorted_keys = []
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compute_count = 0
+        self.compute_time = 0.
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _find_key(self, t):
+        # intervals starting before t, the closest first
+        for i in range(bisect.bisect_left(self._sorted_keys, (t,)) - 1, -1, -1):
+            key = self._sorted_keys[i]
+            if t <= key[1]:
+                return key
+        return None
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._sorted_keys.pop(bisect.bisect_left(self._sorted_keys, key))
+
+    def _is_expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, t, count=True):
+        with self._lock:
+            key = self._find_key(t)
+            if key is not None:
+                created, value = self._entries[key]
+                if not self._is_expired(created, self.clock()):
+                    self._entries.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                self._remove(key)
+                self.evictions += 1
+            if count:
+                self.misses += 1
+            return None
+
+    def put(self, lo, hi, value):
+        key = (lo, hi)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock(), value)
+            bisect.insort(self._sorted_keys, key)
+            self.evict()
+
+    def record_compute_time(self, duration):
+        with self._lock:
+            self.compute_count += 1
+            self.compute_time += duration
+
+    def evict(self):
+        with self._lock:
+            if self.ttl is not None:
+                now = self.clock()
+                for key, (created, _) in list(self._entries.items()):
+                    if self._is_expired(created, now):
+                        self._remove(key)
+                        self.evictions += 1
+            while len(self._entries) > self.max_size:
+                key = next(iter(self._entries))
+                self._remove(key)
+                self.evictions += 1
+
+    def retain(self, points):
+        """
+        Remove the entries not containing any of the points.
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if not any(key[0] < t <= key[1] for t in points):
+                    self._remove(key)
+                    self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sorted_keys.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                size=len(self._entries),
+                hits=self.hits,
+                misses=self.misses,
+                hit_ratio=self.hits / lookups if lookups else None,
+                evictions=self.evictions,
+                compute_count=self.compute_count,
+                compute_time=self.compute_time,
+            )
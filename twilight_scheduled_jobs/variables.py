@@ -0,0 +1,71 @@
+import re
+
+SUN = 'sun'
+MOON = 'moon'
+
+# e.g. sun_alt_-9deg_start (the Sun descends below -9 degrees) and sun_alt_-9deg_end (it rises above again)
+ALTITUDE_VARIABLE_PATTERN = re.compile(
+    r'^(?P<body>sun|moon)_alt_(?P<altitude>[+-]?\d+(?:\.\d+)?)deg_(?P<boundary>start|end)$'
+)
+ALTITUDE_FAMILY_PATTERN = re.compile(r'^(?P<body>sun|moon)_alt_(?P<altitude>[+-]?\d+(?:\.\d+)?)deg$')
+
+# the upper limb of the Moon at the horizon with the standard refraction, as the -0.8333 degrees of the sunrise
+MOON_HORIZON_DEGREES = -0.8333
+MOONRISE = 'moonrise'
+MOONSET = 'moonset'
+# illuminated fraction of the Moon disc (0 to 1) at the Sun antimeridian transit following t0
+MOON_ILLUMINATION = 'moon_illumination'
+
+# the variables whose values are numbers, they cannot be the base of a datetime expression
+NUMBER_VARIABLE_NAMES = frozenset((MOON_ILLUMINATION,))
+
+# event codes of the altitude families
+ALTITUDE_DESCENDING = 0
+ALTITUDE_ASCENDING = 1
+
+
+def altitude_family(body, altitude_degrees):
+    """
+    Event family of the crossings of an altitude by a body, e.g. sun_alt_-9deg.
+    """
+    return f'{body}_alt_{float(altitude_degrees):g}deg'
+
+
+def parse_altitude_family(family):
+    """
+    :return: (body, altitude in degrees) of an altitude family, None for the other families
+    """
+    match = ALTITUDE_FAMILY_PATTERN.match(family)
+    if match is None:
+        return None
+    return match.group('body'), float(match.group('altitude'))
+
+
+def parse_altitude_variable(variable_name):
+    """
+    :return: (body, altitude in degrees, descending) of an altitude crossing variable
+             (including moonrise and moonset), None for the other variables
+    """
+    if variable_name == MOONRISE:
+        return MOON, MOON_HORIZON_DEGREES, False
+    if variable_name == MOONSET:
+        return MOON, MOON_HORIZON_DEGREES, True
+    match = ALTITUDE_VARIABLE_PATTERN.match(variable_name)
+    if match is None:
+        return None
+    # the period below the altitude starts when the body descends and ends when it rises
+    return match.group('body'), float(match.group('altitude')), match.group('boundary') == 'start'
+
+
+def altitude_variable_names(family):
+    """
+    :return: dict of the canonical variable names of an altitude family and whether their events are descending
+    """
+    body, altitude_degrees = parse_altitude_family(family)
+    variable_names = {
+        f'{family}_start': True,
+        f'{family}_end': False,
+    }
+    if body == MOON and altitude_degrees == MOON_HORIZON_DEGREES:
+        variable_names.update({MOONSET: True, MOONRISE: False})
+    return variable_names